@@ -0,0 +1,7 @@
+"""
+Benchmarks of the anonymization on a deterministic synthetic corpus.
+
+    python -m benchmarks --output results.json
+    python -m benchmarks compare before.json after.json
+    python -m benchmarks startup --budget-ms 30
+"""
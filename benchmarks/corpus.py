@@ -0,0 +1,222 @@
+"""
+Deterministic synthetic DICOM corpus: the same seed and scale always give the same files.
+"""
+import os
+import random
+
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, PYDICOM_IMPLEMENTATION_UID, generate_uid
+
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+ENHANCED_CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2.1'
+SECONDARY_CAPTURE_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.7'
+
+# Number of files and size parameters of each kind of file, by scale
+SCALES = {
+    'small': {
+        'ct': {'count': 20, 'rows': 512, 'columns': 512},
+        'multiframe': {'count': 2, 'rows': 512, 'columns': 512, 'frames': 20},
+        'nested': {'count': 10, 'depth': 4, 'items': 3},
+        'private': {'count': 10, 'blocks': 20, 'elements': 50},
+        'repeating': {'count': 10, 'groups': 16},
+    },
+    'full': {
+        'ct': {'count': 200, 'rows': 512, 'columns': 512},
+        'multiframe': {'count': 3, 'rows': 512, 'columns': 512, 'frames': 200},
+        'nested': {'count': 50, 'depth': 6, 'items': 3},
+        'private': {'count': 50, 'blocks': 100, 'elements': 200},
+        'repeating': {'count': 50, 'groups': 16},
+    },
+}
+KINDS = tuple(SCALES['small'])
+
+# Pixel data is made of a repeated random block, its content does not matter to the anonymization
+_PIXEL_BLOCK_SIZE = 64 * 1024
+
+
+def _pixel_bytes(rng: random.Random, size: int) -> bytes:
+    block = rng.getrandbits(8 * _PIXEL_BLOCK_SIZE).to_bytes(_PIXEL_BLOCK_SIZE, 'little')
+    return (block * (size // _PIXEL_BLOCK_SIZE + 1))[:size]
+
+
+def _uid(seed: int, *names) -> str:
+    return generate_uid(entropy_srcs=[str(seed)] + [str(name) for name in names])
+
+
+def _add_patient_study(dataset: Dataset, rng: random.Random, seed: int, study: int) -> None:
+    """
+    Identifying attributes of the patient, study and equipment
+    """
+    dataset.PatientName = 'Synthetic^Patient{:04d}'.format(study)
+    dataset.PatientID = 'PID{:08d}'.format(rng.randrange(10 ** 8))
+    dataset.PatientBirthDate = '19{:02d}{:02d}{:02d}'.format(rng.randrange(100), rng.randrange(1, 13), rng.randrange(1, 29))
+    dataset.PatientSex = rng.choice(['F', 'M', 'O'])
+    dataset.PatientAge = '{:03d}Y'.format(rng.randrange(1, 100))
+    dataset.StudyDate = '2020{:02d}{:02d}'.format(rng.randrange(1, 13), rng.randrange(1, 29))
+    dataset.StudyTime = '{:02d}{:02d}{:02d}'.format(rng.randrange(24), rng.randrange(60), rng.randrange(60))
+    dataset.AccessionNumber = 'ACC{:06d}'.format(rng.randrange(10 ** 6))
+    dataset.StudyID = str(study)
+    dataset.ReferringPhysicianName = 'Referring^Physician'
+    dataset.OperatorsName = 'Operator^Name'
+    dataset.InstitutionName = 'Synthetic Hospital'
+    dataset.InstitutionAddress = '1 Synthetic Street'
+    dataset.StationName = 'STATION{:02d}'.format(rng.randrange(100))
+    dataset.DeviceSerialNumber = str(rng.randrange(10 ** 6))
+    dataset.StudyInstanceUID = _uid(seed, 'study', study)
+    dataset.FrameOfReferenceUID = _uid(seed, 'frame of reference', study)
+
+
+def _new_file(path: str, sop_class_uid: str, sop_instance_uid: str) -> FileDataset:
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = sop_class_uid
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+
+    dataset = FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+    dataset.SOPClassUID = sop_class_uid
+    dataset.SOPInstanceUID = sop_instance_uid
+    return dataset
+
+
+def _add_image(dataset: Dataset, rng: random.Random, rows: int, columns: int, frames: int = 1) -> None:
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.Rows = rows
+    dataset.Columns = columns
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 12
+    dataset.HighBit = 11
+    dataset.PixelRepresentation = 0
+    if frames > 1:
+        dataset.NumberOfFrames = frames
+    dataset.PixelData = _pixel_bytes(rng, rows * columns * 2 * frames)
+
+
+def _make_ct(path, rng, seed, index, rows, columns):
+    dataset = _new_file(path, CT_IMAGE_STORAGE, _uid(seed, 'ct', index))
+    _add_patient_study(dataset, rng, seed, index // 10)
+    dataset.Modality = 'CT'
+    dataset.SeriesInstanceUID = _uid(seed, 'ct series', index // 10)
+    dataset.InstanceNumber = index % 10 + 1
+    dataset.SliceThickness = '1.0'
+    dataset.ImagePositionPatient = [0, 0, index % 10]
+    _add_image(dataset, rng, rows, columns)
+    return dataset
+
+
+def _make_multiframe(path, rng, seed, index, rows, columns, frames):
+    dataset = _new_file(path, ENHANCED_CT_IMAGE_STORAGE, _uid(seed, 'multiframe', index))
+    _add_patient_study(dataset, rng, seed, index)
+    dataset.Modality = 'CT'
+    dataset.SeriesInstanceUID = _uid(seed, 'multiframe series', index)
+    frame_items = []
+    for frame in range(frames):
+        item = Dataset()
+        position = Dataset()
+        position.ImagePositionPatient = [0, 0, frame]
+        item.PlanePositionSequence = Sequence([position])
+        frame_items.append(item)
+    dataset.PerFrameFunctionalGroupsSequence = Sequence(frame_items)
+    _add_image(dataset, rng, rows, columns, frames)
+    return dataset
+
+
+def _nested_items(rng, seed, depth, items, path):
+    sequence_items = []
+    for item_index in range(items):
+        item = Dataset()
+        item.PatientName = 'Nested^Person{}'.format('.'.join(map(str, path + (item_index,))))
+        item.ReferencedSOPInstanceUID = _uid(seed, 'nested', path, item_index)
+        item.InstitutionName = 'Nested Hospital'
+        if depth > 1:
+            item.ContentSequence = Sequence(_nested_items(rng, seed, depth - 1, items, path + (item_index,)))
+        sequence_items.append(item)
+    return sequence_items
+
+
+def _make_nested(path, rng, seed, index, depth, items):
+    dataset = _new_file(path, SECONDARY_CAPTURE_IMAGE_STORAGE, _uid(seed, 'nested', index))
+    _add_patient_study(dataset, rng, seed, index)
+    dataset.Modality = 'OT'
+    dataset.SeriesInstanceUID = _uid(seed, 'nested series', index)
+    dataset.ContentSequence = Sequence(_nested_items(rng, seed, depth, items, (index,)))
+    _add_image(dataset, rng, 64, 64)
+    return dataset
+
+
+def _make_private(path, rng, seed, index, blocks, elements):
+    dataset = _new_file(path, CT_IMAGE_STORAGE, _uid(seed, 'private', index))
+    _add_patient_study(dataset, rng, seed, index)
+    dataset.Modality = 'CT'
+    dataset.SeriesInstanceUID = _uid(seed, 'private series', index)
+    for block_index in range(blocks):
+        # Up to 0xF0 blocks of 256 elements per odd group
+        group = 0x0009 + 2 * (block_index // 0xF0)
+        block = dataset.private_block(group, 'SYNTHETIC {:03d}'.format(block_index), create=True)
+        for element in range(min(elements, 0x100)):
+            block.add_new(element, 'LO', 'Private value {} {}'.format(block_index, element))
+    _add_image(dataset, rng, 64, 64)
+    return dataset
+
+
+def _make_repeating(path, rng, seed, index, groups):
+    dataset = _new_file(path, CT_IMAGE_STORAGE, _uid(seed, 'repeating', index))
+    _add_patient_study(dataset, rng, seed, index)
+    dataset.Modality = 'CT'
+    dataset.SeriesInstanceUID = _uid(seed, 'repeating series', index)
+    for overlay in range(groups):
+        group = 0x6000 + 2 * overlay
+        dataset.add_new((group, 0x0010), 'US', 64)
+        dataset.add_new((group, 0x0011), 'US', 64)
+        dataset.add_new((group, 0x0040), 'CS', 'G')
+        dataset.add_new((group, 0x0050), 'SS', [1, 1])
+        dataset.add_new((group, 0x0100), 'US', 1)
+        dataset.add_new((group, 0x0102), 'US', 0)
+        dataset.add_new((group, 0x3000), 'OW', _pixel_bytes(rng, 64 * 64 // 8))
+        dataset.add_new((group, 0x4000), 'LT', 'Overlay comment {}'.format(overlay))
+    for curve in range(groups):
+        dataset.add_new((0x5000 + 2 * curve, 0x3000), 'OW', _pixel_bytes(rng, 256))
+    _add_image(dataset, rng, 64, 64)
+    return dataset
+
+
+_MAKERS = {
+    'ct': _make_ct,
+    'multiframe': _make_multiframe,
+    'nested': _make_nested,
+    'private': _make_private,
+    'repeating': _make_repeating,
+}
+
+
+def generate_corpus(folder: str, scale: str = 'small', seed: int = 0, kinds=KINDS) -> dict:
+    """
+    Write the synthetic corpus in folder/<scale>-<seed>/<kind>/, existing files are kept
+
+    :param folder: Root of the corpus
+    :param scale: Key of SCALES
+    :param seed: Seed of the random values and UIDs
+    :param kinds: Kinds of files to generate
+    :return: kind -> list of file paths
+    """
+    corpus = {}
+    for kind in kinds:
+        parameters = dict(SCALES[scale][kind])
+        count = parameters.pop('count')
+        kind_folder = os.path.join(folder, '{}-{}'.format(scale, seed), kind)
+        os.makedirs(kind_folder, exist_ok=True)
+        rng = random.Random('{}-{}'.format(seed, kind))
+        paths = []
+        for index in range(count):
+            path = os.path.join(kind_folder, '{}_{:04d}.dcm'.format(kind, index))
+            # The random state is drawn even for existing files so that the others do not change
+            file_rng = random.Random(rng.getrandbits(64))
+            if not os.path.exists(path):
+                _MAKERS[kind](path, file_rng, seed, index, **parameters).save_as(path, write_like_original=False)
+            paths.append(path)
+        corpus[kind] = paths
+    return corpus
@@ -0,0 +1,342 @@
+"""
+Benchmark runner: measures the anonymization paths on the synthetic corpus and writes JSON results.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import pydicom
+
+from dicomanonymizer.anonymizer import anonymize
+from dicomanonymizer.engine import Anonymizer
+
+from .corpus import KINDS, SCALES, generate_corpus
+
+PATHS = ('file', 'dataset', 'cli', 'gui')
+
+# Commands timed by the startup benchmark. Importing pydicom is the floor of any anonymization, the budget
+# applies to the time the command line adds to it
+STARTUP_BASELINE = 'pydicom'
+STARTUP_COMMANDS = (
+    (STARTUP_BASELINE, ['-c', 'import pydicom']),
+    ('package', ['-c', 'import dicomanonymizer']),
+    ('help', ['-m', 'dicomanonymizer', '--help']),
+    ('cli-file', ['-m', 'dicomanonymizer', '{input}', '{output}']),
+)
+STARTUP_BUDGET_COMMAND = 'cli-file'
+DEFAULT_STARTUP_BUDGET_MS = 30.
+
+
+def _percentiles(latencies: list) -> dict:
+    """
+    Latency percentiles in milliseconds
+    """
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    return {'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99), 'max': ordered[-1] * 1000}
+
+
+def _result(path: str, kind: str, files: list, seconds: float, latencies: list = None, peak_memory: int = None) -> dict:
+    size = sum(os.path.getsize(f) for f in files)
+    return {
+        'path': path,
+        'kind': kind,
+        'files': len(files),
+        'bytes': size,
+        'seconds': seconds,
+        'files_per_second': len(files) / seconds if seconds else None,
+        'mb_per_second': size / 1e6 / seconds if seconds else None,
+        'latency_ms': _percentiles(latencies or []),
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def _peak_memory(function, *args) -> int:
+    """
+    Peak of the memory allocated by Python while running function, measured apart as tracing is slow
+    """
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_file(anonymizer: Anonymizer, kind: str, files: list, output_folder: str, repeat: int) -> dict:
+    """
+    Anonymizer.anonymize_dicom_file, file by file
+    """
+    latencies = []
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for f in files:
+            file_start = time.perf_counter()
+            anonymizer.anonymize_dicom_file(f, os.path.join(output_folder, os.path.basename(f)))
+            latencies.append(time.perf_counter() - file_start)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = max(_peak_memory(anonymizer.anonymize_dicom_file, f, os.path.join(output_folder, os.path.basename(f)))
+               for f in files)
+    return _result('file', kind, files, best, latencies, peak)
+
+
+def bench_dataset(anonymizer: Anonymizer, kind: str, files: list, repeat: int) -> dict:
+    """
+    Anonymizer.anonymize_dataset on datasets read from memory, reading is not measured
+    """
+    contents = []
+    for f in files:
+        with open(f, 'rb') as dicom_file:
+            contents.append(dicom_file.read())
+
+    latencies = []
+    best = None
+    for _ in range(repeat):
+        elapsed = 0.
+        for content in contents:
+            dataset = pydicom.dcmread(io.BytesIO(content))
+            dataset_start = time.perf_counter()
+            anonymizer.anonymize_dataset(dataset)
+            latency = time.perf_counter() - dataset_start
+            latencies.append(latency)
+            elapsed += latency
+        best = elapsed if best is None else min(best, elapsed)
+    peak = max(_peak_memory(anonymizer.anonymize_dataset, pydicom.dcmread(io.BytesIO(content))) for content in contents)
+    return _result('dataset', kind, files, best, latencies, peak)
+
+
+def bench_cli(kind: str, files: list, output_folder: str, repeat: int, workers: int) -> dict:
+    """
+    anonymize() on the folder of the kind, as the command line does
+    """
+    input_folder = os.path.dirname(files[0])
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        # Hide the progress bar
+        with contextlib.redirect_stderr(io.StringIO()):
+            anonymize(input_folder, output_folder, {}, True, workers=workers)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return _result('cli', kind, files, best)
+
+
+def bench_gui(anonymizer: Anonymizer, kind: str, files: list, output_folder: str, repeat: int, workers: int) -> dict:
+    """
+    The background worker of the GUI, run in the current thread
+    """
+    try:
+        from dicomanonymizer.gui import RunWorker
+    except ImportError as e:
+        return {'path': 'gui', 'kind': kind, 'skipped': str(e)}
+
+    paths = [(f, os.path.join(output_folder, os.path.basename(f))) for f in files]
+    best = None
+    for _ in range(repeat):
+        worker = RunWorker(anonymizer, paths, workers)
+        start = time.perf_counter()
+        worker.run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return _result('gui', kind, files, best)
+
+
+def bench_startup(input_file: str, output_folder: str, repeat: int) -> list:
+    """
+    Wall time of new Python processes running each of STARTUP_COMMANDS, as when the command line is called per file
+
+    The commands are run in turn so that a slower period of the machine affects them all.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    commands = [(name, [sys.executable] + [argument.format(input=input_file, output=os.path.join(output_folder, 'out.dcm'))
+                                           for argument in arguments])
+                for name, arguments in STARTUP_COMMANDS]
+    timings = {name: [] for name, _ in commands}
+    for _ in range(repeat):
+        for name, command in commands:
+            start = time.perf_counter()
+            subprocess.run(command, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            timings[name].append(time.perf_counter() - start)
+
+    baseline = statistics.median(timings[STARTUP_BASELINE]) * 1000
+    results = []
+    for name, _ in commands:
+        median = statistics.median(timings[name]) * 1000
+        results.append({
+            'path': 'startup',
+            'kind': name,
+            'runs': repeat,
+            'median_ms': median,
+            'min_ms': min(timings[name]) * 1000,
+            'overhead_ms': median - baseline,
+        })
+    return results
+
+
+def run(corpus: dict, paths=PATHS, repeat: int = 3, workers: int = 1) -> list:
+    """
+    Run the benchmarks of the given paths on each kind of file of the corpus
+
+    :param corpus: kind -> list of files, see corpus.generate_corpus
+    :param paths: Anonymization paths to measure, see PATHS
+    :param repeat: Number of runs, the fastest one is kept for the throughput
+    :param workers: Number of worker processes of the cli and gui paths
+    """
+    anonymizer = Anonymizer()
+    results = []
+    for kind, files in corpus.items():
+        output_folder = tempfile.mkdtemp(prefix='dicomanonymizer-benchmark-')
+        try:
+            for path in paths:
+                if path == 'file':
+                    result = bench_file(anonymizer, kind, files, output_folder, repeat)
+                elif path == 'dataset':
+                    result = bench_dataset(anonymizer, kind, files, repeat)
+                elif path == 'cli':
+                    result = bench_cli(kind, files, output_folder, repeat, workers)
+                else:
+                    result = bench_gui(anonymizer, kind, files, output_folder, repeat, workers)
+                results.append(result)
+                print(_format_result(result))
+        finally:
+            shutil.rmtree(output_folder, ignore_errors=True)
+    return results
+
+
+def _format_result(result: dict) -> str:
+    if 'median_ms' in result:
+        return '{path:>8} {kind:<11} {median_ms:8.1f} ms median {min_ms:8.1f} ms min   {overhead_ms:+.1f} ms'.format(**result)
+    if 'skipped' in result:
+        return '{path:>8} {kind:<11} skipped: {skipped}'.format(**result)
+    latency = result['latency_ms']
+    return '{:>8} {:<11} {:8.1f} files/s {:8.1f} MB/s   p50 {:>9} ms   p99 {:>9} ms'.format(
+        result['path'], result['kind'], result['files_per_second'], result['mb_per_second'],
+        '{:.2f}'.format(latency['p50']) if latency else '-', '{:.2f}'.format(latency['p99']) if latency else '-')
+
+
+def _environment() -> dict:
+    environment = {
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'pydicom': pydicom.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+    try:
+        import resource
+        # Kilobytes on Linux
+        environment['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
+    return environment
+
+
+def compare(before_file: str, after_file: str) -> None:
+    """
+    Print the throughput ratio of each (path, kind) of two result files
+    """
+    with open(before_file) as f:
+        before = {(r['path'], r['kind']): r for r in json.load(f)['results'] if 'skipped' not in r}
+    with open(after_file) as f:
+        after = {(r['path'], r['kind']): r for r in json.load(f)['results'] if 'skipped' not in r}
+    for key in sorted(set(before) & set(after)):
+        if 'median_ms' in before[key]:
+            print('{:>8} {:<11} {:8.1f} -> {:8.1f} ms       x{:.2f}'.format(
+                key[0], key[1], before[key]['median_ms'], after[key]['median_ms'],
+                after[key]['median_ms'] / before[key]['median_ms']))
+            continue
+        ratio = after[key]['files_per_second'] / before[key]['files_per_second']
+        print('{:>8} {:<11} {:8.1f} -> {:8.1f} files/s  x{:.2f}'.format(
+            key[0], key[1], before[key]['files_per_second'], after[key]['files_per_second'], ratio))
+
+
+def _write_results(args: argparse.Namespace, results: list) -> None:
+    options = {key: value for key, value in vars(args).items() if key != 'output'}
+    with open(args.output, 'w') as f:
+        json.dump({'environment': _environment(), 'options': options, 'results': results}, f, indent=2)
+    print('Results written to ' + args.output)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        parser = argparse.ArgumentParser(prog='python -m benchmarks compare')
+        parser.add_argument('before', help='JSON results of the reference run')
+        parser.add_argument('after', help='JSON results to compare with the reference')
+        args = parser.parse_args(sys.argv[2:])
+        compare(args.before, args.after)
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'startup':
+        sys.exit(startup_main(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', add_help=True)
+    parser.add_argument('--output', default=os.path.join(tempfile.gettempdir(), 'benchmark_results.json'),
+                        help='JSON file of the results (default: %(default)s)')
+    parser.add_argument('--corpus', help='Folder of the synthetic corpus, reused across runs (default: temporary folder)')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small', help='Size of the corpus (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus (default: %(default)s)')
+    parser.add_argument('--kind', action='append', dest='kinds', choices=KINDS, help='Kind of files (can be repeated, default: all)')
+    parser.add_argument('--path', action='append', dest='paths', choices=PATHS, help='Anonymization path (can be repeated, default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the fastest is kept (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes of the cli and gui paths (default: %(default)s)')
+    args = parser.parse_args()
+
+    corpus_folder = args.corpus or tempfile.mkdtemp(prefix='dicomanonymizer-corpus-')
+    try:
+        corpus = generate_corpus(corpus_folder, args.scale, args.seed, args.kinds or KINDS)
+        results = run(corpus, args.paths or PATHS, args.repeat, args.workers)
+    finally:
+        if args.corpus is None:
+            shutil.rmtree(corpus_folder, ignore_errors=True)
+
+    _write_results(args, results)
+
+
+def startup_main(argv: list) -> int:
+    """
+    Startup benchmark, fails if the command line adds more than the budget to the import of pydicom
+    """
+    parser = argparse.ArgumentParser(prog='python -m benchmarks startup')
+    parser.add_argument('--output', default=os.path.join(tempfile.gettempdir(), 'startup_results.json'),
+                        help='JSON file of the results (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=15, help='Number of runs of each command (default: %(default)s)')
+    parser.add_argument('--budget-ms', type=float, dest='budget_ms', default=DEFAULT_STARTUP_BUDGET_MS,
+                        help='Milliseconds the {} command may add to the import of pydicom (default: %(default)s)'.format(
+                            STARTUP_BUDGET_COMMAND))
+    args = parser.parse_args(argv)
+
+    work_folder = tempfile.mkdtemp(prefix='dicomanonymizer-startup-')
+    try:
+        corpus = generate_corpus(work_folder, 'small', 0, ['ct'])
+        results = bench_startup(corpus['ct'][0], work_folder, args.repeat)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    for result in results:
+        print(_format_result(result))
+
+    _write_results(args, results)
+
+    overhead = next(result['overhead_ms'] for result in results if result['kind'] == STARTUP_BUDGET_COMMAND)
+    if overhead > args.budget_ms:
+        print('Over budget: {} adds {:.1f} ms to the import of pydicom, the budget is {:.1f} ms'.format(
+            STARTUP_BUDGET_COMMAND, overhead, args.budget_ms))
+        return 1
+    return 0
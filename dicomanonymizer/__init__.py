@@ -1,2 +1,27 @@
-from .simpledicomanonymizer import *
-from .anonymizer import anonymize
+"""
+The names of simpledicomanonymizer, with engine.Anonymizer and anonymizer.anonymize, are imported on first use:
+importing a submodule, e.g. dicomanonymizer.ruleset, does not import the others and pydicom.
+"""
+import importlib
+
+# Names of the package defined outside simpledicomanonymizer, and their module
+_SUBMODULE_NAMES = {
+    'Anonymizer': 'engine',
+    'anonymize': 'anonymizer',
+}
+
+
+def __getattr__(name: str):
+    if name in _SUBMODULE_NAMES:
+        value = getattr(importlib.import_module('.' + _SUBMODULE_NAMES[name], __name__), name)
+    else:
+        simpledicomanonymizer = importlib.import_module('.simpledicomanonymizer', __name__)
+        if name == '__all__':
+            # from dicomanonymizer import *
+            value = [key for key in vars(simpledicomanonymizer) if not key.startswith('_')] + list(_SUBMODULE_NAMES)
+        elif name.startswith('__') or not hasattr(simpledicomanonymizer, name):
+            raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+        else:
+            value = getattr(simpledicomanonymizer, name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,29 @@
+"""
+python -m dicomanonymizer INPUT OUTPUT [options]: anonymize files, see anonymizer.main
+python -m dicomanonymizer serve [options]: run the HTTP anonymization service, see server.main
+python -m dicomanonymizer scp [options]: run the anonymizing storage SCP, see scp.main
+python -m dicomanonymizer compile-rules DICTIONARY [options]: compile a JSON dictionary, see ruleset.main
+python -m dicomanonymizer scan INPUT [options]: list the tags found in the headers of DICOM files, see scan.main
+"""
+import sys
+
+if __name__ == '__main__':
+    if getattr(sys, 'frozen', False):
+        # Worker processes of a frozen executable start from it, multiprocessing is not imported otherwise
+        import multiprocessing
+        multiprocessing.freeze_support()
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from .server import main
+        main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'scp':
+        from .scp import main
+        main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'compile-rules':
+        from .ruleset import main
+        main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'scan':
+        from .scan import main
+        main(sys.argv[2:])
+    else:
+        from .anonymizer import main
+        main()
@@ -1,22 +1,199 @@
 import argparse
-import ast
-import json
+import itertools
+import logging
 import os
+import secrets
 import sys
-import tqdm
+import threading
 
 from .simpledicomanonymizer import *
+from .archive import anonymize_archive, is_archive
+from .discovery import iter_paths
+from .instrumentation import Instrumentation, get_instrumentation, set_instrumentation, timed_iter, DISCOVERY
+from .pipeline import DEFAULT_QUEUE_DEPTH, DEFAULT_MAX_IN_FLIGHT_BYTES, anonymize_pipelined
+from .ruleset import load_ruleset, parse_tag, resolve_action
+from .scheduler import AFFINITIES, group_paths, pack_groups
 
-def anonymize(input_path: str, output_path: str, anonymization_actions: dict, deletePrivateTags: bool) -> None:
+# The engine and pydicom, multiprocessing and the SQLite based modules (manifest, uidmap) are imported where they
+# are used: the command line parses its arguments, and prints its help, before importing them
+
+logger = logging.getLogger(__name__)
+
+# Anonymizer of the current worker process and options of anonymize_dicom_file, set once by _init_worker
+_worker_anonymizer = None
+_worker_file_options = {}
+_worker_describe = False
+_worker_instrumented = False
+
+# Seconds between two checks of the cancel event of anonymize_in_pool
+CANCEL_POLL_INTERVAL = 0.1
+
+
+def _init_worker(anonymizer: 'Anonymizer', uid_map_path: str, uid_key: bytes, uid_root: str, file_options: dict,
+                 describe: bool = False, instrumented: bool = False) -> None:
+    """
+    Receive the compiled rules and set up the UIDs generation once per worker process
+    """
+    global _worker_anonymizer, _worker_file_options, _worker_describe, _worker_instrumented
+    _worker_anonymizer = anonymizer
+    _worker_file_options = file_options
+    _worker_describe = describe
+    _worker_instrumented = instrumented
+    if instrumented:
+        set_instrumentation(Instrumentation())
+    if uid_key is not None:
+        set_uid_key(uid_key, uid_root)
+    elif uid_map_path is not None:
+        from .uidmap import SQLiteUIDMap
+        # Commit each new UID right away so that all the workers share the same mapping
+        set_uid_map(SQLiteUIDMap(uid_map_path, commit_every=1))
+
+
+def _anonymize_in_worker(paths: tuple):
+    if _worker_describe:
+        from .manifest import anonymize_and_describe
+        return anonymize_and_describe(_worker_anonymizer, *paths, _worker_file_options)
+    _worker_anonymizer.anonymize_dicom_file(*paths, **_worker_file_options)
+
+
+def _anonymize_bytes_in_worker(data: bytes) -> bytes:
+    return _worker_anonymizer.anonymize_bytes(data)
+
+
+def _anonymize_chunk_in_worker(chunk: list) -> tuple:
+    results = [_anonymize_in_worker(paths) for paths in chunk]
+    report = None
+    if _worker_instrumented:
+        # The totals of the chunk are sent back with its results, to be merged in the main process
+        instrumentation = get_instrumentation()
+        report = instrumentation.report()
+        instrumentation.reset()
+    return results, report
+
+
+def _chunks(iterable, size: int):
+    """
+    Yield lists of up to size items of iterable, as they are consumed
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def anonymize_in_pool(anonymizer: 'Anonymizer', paths, workers: int, progress_bar=None,
+                      uid_map_path: str = None, uid_key: bytes = None, uid_root: str = DEFAULT_UID_ROOT,
+                      max_tasks_per_worker: int = None, chunk_size: int = 16, file_options: dict = None,
+                      on_result=None, cancel_event: threading.Event = None, affinity: str = None) -> bool:
+    """
+    Anonymize files with a pool of worker processes
+
+    Without uid_key nor uid_map_path, a random key is drawn for the run so that the workers
+    agree on the new UIDs: UIDs stay consistent within the run and random across runs.
+
+    :param anonymizer: Compiled rules, sent once to each worker
+    :param paths: Iterable of (input file, output file), consumed as the workers progress
+    :param workers: Number of worker processes
+    :param progress_bar: tqdm progress bar updated as files are done
+    :param uid_map_path: Path to a SQLite file storing the replaced UIDs, shared by the workers
+    :param uid_key: Secret key used to derive the new UIDs deterministically
+    :param uid_root: Root of the UIDs derived from uid_key
+    :param max_tasks_per_worker: Number of tasks (chunks of files) after which a worker is replaced
+    :param chunk_size: Number of files sent to a worker at once
+    :param file_options: Keyword arguments of Anonymizer.anonymize_dicom_file, e.g. defer_size
+    :param on_result: If set, errors do not stop the run and this function receives the result of
+    manifest.anonymize_and_describe for each file
+    :param cancel_event: When set, e.g. from another thread, the workers are terminated within
+    CANCEL_POLL_INTERVAL seconds, files being written are left incomplete
+    :param affinity: 'study' or 'directory' to send the files of a study, or of a folder, to a single worker
+    in the same task, see scheduler.group_paths. Tasks are then made of whole groups, of about chunk_size files
+    :return: True if all the files were processed, False if the run was cancelled
+
+    The workers are instrumented when the current process is (see instrumentation.set_instrumentation),
+    their totals are added to the instrumentation of the current process.
+    """
+    import multiprocessing
+
+    if uid_key is None and uid_map_path is None:
+        uid_key = secrets.token_bytes(32)
+    instrumentation = get_instrumentation()
+
+    # Leaving the with block terminates the workers
+    with multiprocessing.Pool(workers, _init_worker,
+                              (anonymizer, uid_map_path, uid_key, uid_root, file_options or {}, on_result is not None,
+                               instrumentation is not None),
+                              max_tasks_per_worker) as pool:
+        # Chunks are made here rather than by imap_unordered, which returns an iterator without
+        # timeout for a chunksize above 1
+        if affinity is not None:
+            chunks = pack_groups(group_paths(paths, affinity), chunk_size)
+        else:
+            chunks = _chunks(paths, chunk_size)
+        results = pool.imap_unordered(_anonymize_chunk_in_worker, chunks)
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                return False
+            try:
+                chunk_results, report = results.next(CANCEL_POLL_INTERVAL if cancel_event is not None else None)
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                return True
+            if report is not None:
+                instrumentation.merge(report)
+            for result in chunk_results:
+                if on_result is not None:
+                    on_result(result)
+                if progress_bar is not None:
+                    progress_bar.update(1)
+
+
+def anonymize(input_path: str, output_path: str, anonymization_actions: dict, deletePrivateTags: bool,
+              single_pass: bool = False, uid_map_path: str = None, uid_key: bytes = None,
+              uid_root: str = DEFAULT_UID_ROOT, workers: int = 1, max_tasks_per_worker: int = None,
+              extensions: list = None, check_preamble: bool = False, defer_size=None, splice: bool = False,
+              manifest_path: str = None, metrics_path: str = None, metrics_format: str = 'json',
+              readers: int = 0, writers: int = 1, queue_depth: int = DEFAULT_QUEUE_DEPTH,
+              max_in_flight_bytes: int = DEFAULT_MAX_IN_FLIGHT_BYTES, affinity: str = None) -> None:
     """
     Read data from input path (folder or file) and launch the anonymization.
 
     :param input_path: Path to a folder or to a file. If set to a folder,
-    then cross all over subfiles and apply anonymization.
-    :param output_path: Path to a folder or to a file.
+    then cross all over subfiles (recursively) and apply anonymization.
+    Tar, zip and gzip archives, or '-' for a tar stream on the standard input, are read member by member.
+    :param output_path: Path to a folder or to a file. The tree of an input folder is mirrored in it.
+    Tar, zip and gzip archives, or '-' for a tar stream on the standard output, are written member by member.
+    Archive members are anonymized in memory, in the current process, without defer_size, splice nor manifest.
     :param anonymization_actions: List of actions that will be applied on tags.
     :param deletePrivateTags: Whether to delete private tags.
+    :param single_pass: Visit each element once, nested sequences included, instead of applying rule by rule.
+    :param uid_map_path: Path to a SQLite file storing the replaced UIDs across runs. Not with uid_key.
+    :param uid_key: Secret key used to derive the new UIDs deterministically instead of randomly.
+    :param uid_root: Root of the UIDs derived from uid_key.
+    :param workers: Number of worker processes, files are anonymized in the current process if 1.
+    :param max_tasks_per_worker: Number of tasks after which a worker process is replaced.
+    :param extensions: Only anonymize the files of the input folder with one of these extensions.
+    :param check_preamble: Only anonymize the files of the input folder with the 'DICM' prefix.
+    :param defer_size: Values larger than this size in bytes are not read in memory but streamed to the output.
+    :param splice: Only re-encode the elements before the Pixel Data and copy the rest of the input file verbatim.
+    :param manifest_path: Path to a SQLite run manifest. Files already anonymized with the same rules are skipped,
+    the failed and pending ones are processed again. Errors are recorded in it instead of stopping the run.
+    :param metrics_path: Path to a file where the time spent per stage and per rule is written at the end of the run.
+    :param metrics_format: Format of the metrics file, 'json' or 'prometheus' (text exposition format).
+    :param readers: Number of threads prefetching the next files of the input folder while the current one is
+    anonymized, files are read, anonymized and written in sequence if 0. Not used with several workers.
+    :param writers: Number of threads writing the anonymized files when readers is set.
+    :param queue_depth: Number of files waiting between the read, anonymization and write stages when readers is set.
+    :param max_in_flight_bytes: Bound of the total size of the files read and not yet written when readers is set.
+    :param affinity: With several workers, 'study' or 'directory' to anonymize the files of a study, or of a folder,
+    in a single worker. With 'study' the StudyInstanceUID of the files is read scheduler.STUDY_WINDOW files at a
+    time, the files of a study found further apart may be sent to several workers.
     """
+    if uid_map_path is not None and uid_key is not None:
+        raise ValueError('uid_map_path cannot be used with uid_key: UIDs derived from the key are not stored in a map')
+
     # Get input arguments
     input_folder = ''
     output_folder = ''
@@ -24,33 +201,94 @@ def anonymize(input_path: str, output_path: str, anonymization_actions: dict, de
     if os.path.isdir(input_path):
         input_folder = input_path
 
+    archive_mode = is_archive(input_path) or is_archive(output_path)
+
     if os.path.isdir(output_path):
         output_folder = output_path
-        if input_folder == '':
+        if input_folder == '' and not archive_mode:
             output_path = os.path.join(output_folder, os.path.basename(input_path))
 
-    if input_folder != '' and output_folder == '':
-        print('Error, please set a correct output folder path')
+    if input_folder != '' and output_folder == '' and not archive_mode:
+        logger.error('Error, please set a correct output folder path')
         sys.exit()
 
-    # Generate list of input file if a folder has been set
-    input_files_list = []
-    output_files_list = []
-    if input_folder == '':
-        input_files_list.append(input_path)
-        output_files_list.append(output_path)
+    # Files of the input folder are discovered while they are processed
+    if archive_mode:
+        # Members are read from the input archive by anonymize_archive
+        paths = []
+        total = None
+        if manifest_path is not None:
+            logger.warning('The manifest is not used with archives')
+            manifest_path = None
+    elif input_folder == '':
+        paths = [(input_path, output_path)]
+        total = 1
     else:
-        files = os.listdir(input_folder)
-        for fileName in files:
-            input_files_list.append(input_folder + '/' + fileName)
-            output_files_list.append(output_folder + '/' + fileName)
+        paths = iter_paths(input_folder, output_folder, extensions, check_preamble)
+        total = None
+
+    # Compile the rules once for the whole run
+    from .engine import Anonymizer
+    anonymizer = Anonymizer(anonymization_actions, deletePrivateTags, single_pass)
+
+    if uid_key is not None:
+        set_uid_key(uid_key, uid_root)
+
+    uid_map = None
+    if uid_map_path is not None:
+        from .uidmap import SQLiteUIDMap
+        uid_map = SQLiteUIDMap(uid_map_path)
+        previous_uid_map = set_uid_map(uid_map)
 
-    progress_bar = tqdm.tqdm(total=len(input_files_list))
-    for cpt in range(len(input_files_list)):
-        anonymize_dicom_file(input_files_list[cpt], output_files_list[cpt], anonymization_actions, deletePrivateTags)
-        progress_bar.update(1)
+    instrumentation = None
+    if metrics_path is not None:
+        instrumentation = Instrumentation()
+        previous_instrumentation = set_instrumentation(instrumentation)
+        paths = timed_iter(paths, DISCOVERY)
 
-    progress_bar.close()
+    manifest = None
+    if manifest_path is not None:
+        from .manifest import RunManifest, anonymize_and_describe
+        manifest = RunManifest(manifest_path, anonymizer.fingerprint, uid_map=uid_map)
+        paths = manifest.pending(paths)
+
+    file_options = {'defer_size': defer_size, 'splice': splice}
+
+    import tqdm
+    progress_bar = tqdm.tqdm(total=total)
+    try:
+        if archive_mode:
+            anonymize_archive(anonymizer, input_path, output_path, progress_bar, extensions, check_preamble)
+        elif workers > 1 and input_folder != '':
+            anonymize_in_pool(anonymizer, paths, workers, progress_bar,
+                              uid_map_path, uid_key, uid_root, max_tasks_per_worker, file_options=file_options,
+                              on_result=manifest.record if manifest is not None else None, affinity=affinity)
+        elif readers > 0 and input_folder != '':
+            anonymize_pipelined(anonymizer, paths, readers, writers, queue_depth, max_in_flight_bytes, progress_bar,
+                                file_options, on_result=manifest.record if manifest is not None else None)
+        else:
+            for in_file, out_file in paths:
+                if manifest is not None:
+                    manifest.record(anonymize_and_describe(anonymizer, in_file, out_file, file_options))
+                else:
+                    anonymizer.anonymize_dicom_file(in_file, out_file, **file_options)
+                progress_bar.update(1)
+    finally:
+        progress_bar.close()
+        if manifest is not None:
+            manifest.close()
+            logger.info('%d files skipped, %d files failed (see %s)', manifest.skipped, manifest.failed, manifest_path)
+        if instrumentation is not None:
+            set_instrumentation(previous_instrumentation)
+            with open(metrics_path, 'w') as metrics_file:
+                metrics_file.write(instrumentation.to_prometheus() if metrics_format == 'prometheus'
+                                   else instrumentation.to_json())
+            logger.info('Metrics written to %s', metrics_path)
+        if uid_map is not None:
+            set_uid_map(previous_uid_map)
+            uid_map.close()
+        if uid_key is not None:
+            set_uid_key(None)
 
 
 def generate_actions_dictionary(map_action_tag, defined_action_map = {}) -> dict:
@@ -70,7 +308,7 @@ def generate_actions_dictionary(map_action_tag, defined_action_map = {}) -> dict
         if callable(action):
             action_function = action
         else:
-            action_function = defined_action_map[action] if action in defined_action_map else eval(action)
+            action_function = resolve_action(action, defined_action_map)
 
         # Generate the map
         if cpt == 0:
@@ -82,19 +320,79 @@ def generate_actions_dictionary(map_action_tag, defined_action_map = {}) -> dict
     return generated_map
 
 
+def read_actions_dictionary(path: str, defined_action_map: dict = {}) -> dict:
+    """
+    Read the actions of a JSON dictionary file, as given to the --dictionary option
+
+    :param path: JSON file mapping tags to action names, or to {"action": "regexp", "find": ..., "replace": ...},
+    or compiled ruleset (see ruleset.load_ruleset)
+    :param defined_action_map: link action name to action function
+    """
+    return load_ruleset(path, defined_action_map)
+
+
 def main(defined_action_map = {}):
     parser = argparse.ArgumentParser(add_help=True)
-    parser.add_argument('input', help='Path to the input dicom file or input directory which contains dicom files')
-    parser.add_argument('output', help='Path to the output dicom file or output directory which will contains dicom files')
+    parser.add_argument('input', help='Path to the input dicom file or input directory which contains dicom files. '\
+    'Tar, zip and gzip archives are read member by member, \'-\' reads a tar archive from the standard input')
+    parser.add_argument('output', help='Path to the output dicom file or output directory which will contains dicom files. '\
+    'Anonymized members are written to a tar or zip archive with such an extension, \'-\' writes a tar archive to '\
+    'the standard output')
     parser.add_argument('-t', action='append', nargs='*', help='tags action : Defines a new action to apply on the tag.'\
     '\'regexp\' action takes two arguments: '\
         '1. regexp to find substring '\
         '2. the string that will replace the previous found string')
-    parser.add_argument('--dictionary', action='store', help='File which contains a dictionary that can be added to the original one')
+    parser.add_argument('--dictionary', action='store', help='File which contains a dictionary that can be added to the original one, '\
+    'or its compiled ruleset (python -m dicomanonymizer compile-rules)')
     parser.add_argument('--keepPrivateTags', action='store_true', dest='keepPrivateTags', help='If used, then private tags won\'t be deleted')
+    parser.add_argument('--single-pass', action='store_true', dest='single_pass', help='If used, each element is visited once '\
+    '(nested sequences included) and its action is looked up, instead of applying the rules one by one')
+    parser.add_argument('--uid-map', action='store', dest='uid_map', help='SQLite file which stores the replaced UIDs. '\
+    'Reuse it across runs to keep the same UIDs for a study split across several runs')
+    parser.add_argument('--uid-key-file', action='store', dest='uid_key_file', help='File which contains a secret key. '\
+    'If used, new UIDs are derived from the original ones with this key (HMAC) instead of being random, '\
+    'so separate runs or workers agree on the new UIDs without sharing a UID map (not with --uid-map)')
+    parser.add_argument('--uid-root', action='store', dest='uid_root', default=DEFAULT_UID_ROOT,
+                        help='Root of the UIDs derived with --uid-key-file, up to 25 characters (default: %(default)s)')
+    parser.add_argument('--workers', action='store', type=int, default=1, help='Number of worker processes '\
+    '(default: %(default)s). Custom actions must be module level functions to be sent to the workers')
+    parser.add_argument('--max-tasks-per-worker', action='store', type=int, dest='max_tasks_per_worker',
+                        help='Number of tasks (chunks of files) after which a worker process is replaced')
+    parser.add_argument('--extension', action='append', dest='extensions', help='Only anonymize the files of the input '\
+    'directory with this extension, e.g. .dcm (can be repeated)')
+    parser.add_argument('--check-preamble', action='store_true', dest='check_preamble', help='Only anonymize the files of '\
+    'the input directory which have the \'DICM\' prefix after the preamble')
+    parser.add_argument('--defer-size', action='store', type=int, dest='defer_size', help='Values larger than this size '\
+    'in bytes (e.g. Pixel Data) are not read in memory but streamed from the input to the output file')
+    parser.add_argument('--splice', action='store_true', dest='splice', help='Only re-encode the elements before the '\
+    'Pixel Data, the rest of the input file is copied verbatim to the output file')
+    parser.add_argument('--manifest', action='store', dest='manifest', help='SQLite file which records the processed '\
+    'files. Reuse it to resume a run: files already anonymized with the same rules are skipped')
+    parser.add_argument('--metrics', action='store', dest='metrics', help='File where the time spent in each stage '\
+    '(discovery, read, rules, private tags, write) and in each rule, with the number of elements each rule applied to, '\
+    'is written at the end of the run')
+    parser.add_argument('--metrics-format', action='store', dest='metrics_format', choices=['json', 'prometheus'],
+                        default='json', help='Format of the --metrics file (default: %(default)s)')
+    parser.add_argument('--readers', action='store', type=int, default=0, help='Number of threads prefetching the next '\
+    'files while the current one is anonymized, to hide the latency of slow storage (default: %(default)s, files are '\
+    'read, anonymized and written in sequence). Not used with --workers')
+    parser.add_argument('--writers', action='store', type=int, default=1, help='Number of threads writing the '\
+    'anonymized files when --readers is used (default: %(default)s)')
+    parser.add_argument('--queue-depth', action='store', type=int, dest='queue_depth', default=DEFAULT_QUEUE_DEPTH,
+                        help='Number of files waiting between two stages when --readers is used (default: %(default)s)')
+    parser.add_argument('--max-in-flight-mb', action='store', type=int, dest='max_in_flight_mb',
+                        default=DEFAULT_MAX_IN_FLIGHT_BYTES // (1024 * 1024), help='Bound of the total size in MB of '\
+    'the files read and not yet written when --readers is used (default: %(default)s)')
+    parser.add_argument('--affinity', action='store', choices=AFFINITIES, help='With --workers, anonymize the files '\
+    'of a study (StudyInstanceUID read from their header) or of a folder in a single worker, so that the output of '\
+    'a study is complete as soon as its worker is done with it')
     parser.set_defaults(keepPrivateTags=False)
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    if args.uid_map is not None and args.uid_key_file is not None:
+        parser.error('--uid-map cannot be used with --uid-key-file: UIDs derived from the key are not stored in a map')
+
     input_path = args.input
     output_path = args.output
 
@@ -121,9 +419,9 @@ def main(defined_action_map = {}):
                         "replace": current_tag_parameters[3]
                     }
 
-                tags_list = [ast.literal_eval(current_tag_parameters[0])]
+                tags_list = [parse_tag(current_tag_parameters[0])]
 
-                action = eval(action_name)
+                action = resolve_action(action_name, defined_action_map)
                 # When generate_actions is called and we have options, we don't want use regexp
                 # as an action but we want to call it to generate a new method
                 if options is not None:
@@ -132,30 +430,25 @@ def main(defined_action_map = {}):
                 if cpt == 0:
                     new_anonymization_actions = generate_actions(tags_list, action, options)
                 else:
-                    new_anonymization_actions.update(generate_actions(tags_list, action, options))
+                    merge_actions(new_anonymization_actions, generate_actions(tags_list, action, options))
                 cpt += 1
 
     # Read an existing dictionary
     if args.dictionary:
-        with open(args.dictionary) as json_file:
-            data = json.load(json_file)
-            for key, value in data.items():
-                action_name = value
-                options = None
-                if type(value) is dict:
-                    action_name = value['action']
-                    options = {
-                        "find": value['find'],
-                        "replace" : value['replace']
-                    }
+        merge_actions(new_anonymization_actions, read_actions_dictionary(args.dictionary, defined_action_map))
 
-                l = [ast.literal_eval(key)]
-                action = defined_action_map[action_name] if action_name in defined_action_map else eval(action_name)
-                if cpt == 0:
-                    new_anonymization_actions = generate_actions(l, action, options)
-                else:
-                    new_anonymization_actions.update(generate_actions(l, action, options))
-                cpt += 1
+    uid_key = None
+    if args.uid_key_file:
+        with open(args.uid_key_file, 'rb') as key_file:
+            uid_key = key_file.read().strip()
 
     # Launch the anonymization
-    anonymize(input_path, output_path, new_anonymization_actions, not args.keepPrivateTags)
+    anonymize(input_path, output_path, new_anonymization_actions, not args.keepPrivateTags, args.single_pass, args.uid_map,
+              uid_key, args.uid_root, args.workers, args.max_tasks_per_worker,
+              args.extensions, args.check_preamble, args.defer_size, args.splice, args.manifest,
+              args.metrics, args.metrics_format, args.readers, args.writers, args.queue_depth,
+              args.max_in_flight_mb * 1024 * 1024, args.affinity)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Anonymization of the members of tar, zip and gzip archives, from and to files or standard streams.
+
+Members are read one at a time in memory and never extracted to disk. Input tar archives and
+standard input are read as streams, output tar archives and standard output are written as streams,
+so the tool can be used in shell pipelines. Members compressed with gzip (e.g. '.dcm.gz') are
+decompressed to be anonymized and compressed again in the output.
+"""
+import gzip
+import io
+import logging
+import os
+import sys
+import tarfile
+import time
+import zipfile
+from typing import Iterator, Sequence, Tuple
+
+from .discovery import DICM_PREFIX, PREAMBLE_LENGTH, iter_files
+
+logger = logging.getLogger(__name__)
+
+# Input or output path of the standard streams
+STDIO_PATH = '-'
+
+_TAR_MODES = (
+    (('.tar',), ''),
+    (('.tar.gz', '.tgz'), 'gz'),
+    (('.tar.bz2', '.tbz2'), 'bz2'),
+    (('.tar.xz', '.txz'), 'xz'),
+)
+_ZIP_EXTENSIONS = ('.zip',)
+_GZIP_EXTENSIONS = ('.gz',)
+_ZIP_SIGNATURE = b'PK\x03\x04'
+
+
+def _tar_compression(path: str):
+    """
+    Compression of a tar archive from its extension ('' if not compressed), None if it is not a tar archive
+    """
+    lower_path = path.lower()
+    for extensions, compression in _TAR_MODES:
+        if lower_path.endswith(extensions):
+            return compression
+    return None
+
+
+def is_archive(path: str) -> bool:
+    """
+    Whether the path is handled by this module: standard stream, tar, zip or gzip file
+    """
+    return (path == STDIO_PATH or _tar_compression(path) is not None
+            or path.lower().endswith(_ZIP_EXTENSIONS + _GZIP_EXTENSIONS))
+
+
+def iter_members(input_path: str) -> Iterator[Tuple[str, bytes, float]]:
+    """
+    Yield (name, content, modification time) of each regular file of the input
+
+    :param input_path: Tar or zip archive, gzip file, folder, or '-' for a tar stream on standard input
+    """
+    if input_path == STDIO_PATH:
+        stream = sys.stdin.buffer
+        if stream.peek(len(_ZIP_SIGNATURE))[:len(_ZIP_SIGNATURE)] == _ZIP_SIGNATURE:
+            raise ValueError('Zip archives cannot be read from the standard input, use a tar archive')
+        with tarfile.open(fileobj=stream, mode='r|*') as tar:
+            yield from _iter_tar_members(tar)
+    elif os.path.isdir(input_path):
+        for relative_path in iter_files(input_path):
+            path = os.path.join(input_path, relative_path)
+            with open(path, 'rb') as member_file:
+                yield relative_path.replace(os.sep, '/'), member_file.read(), os.path.getmtime(path)
+    elif _tar_compression(input_path) is not None:
+        # Stream mode: members are read in order, without seeking
+        with tarfile.open(input_path, mode='r|*') as tar:
+            yield from _iter_tar_members(tar)
+    elif input_path.lower().endswith(_ZIP_EXTENSIONS):
+        with zipfile.ZipFile(input_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, archive.read(info), time.mktime(info.date_time + (0, 0, -1))
+    else:
+        # Single file, possibly compressed with gzip
+        with open(input_path, 'rb') as member_file:
+            yield os.path.basename(input_path), member_file.read(), os.path.getmtime(input_path)
+
+
+def _iter_tar_members(tar: tarfile.TarFile) -> Iterator[Tuple[str, bytes, float]]:
+    for member in tar:
+        if member.isfile():
+            yield member.name, tar.extractfile(member).read(), member.mtime
+
+
+def _member_path(folder: str, name: str) -> str:
+    """
+    Path of a member written to a folder, refusing names which would be written outside of it
+
+    Member names come from the input archive: absolute names and '..' components are rejected.
+    """
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if (not parts or name.startswith(('/', '\\')) or '..' in parts
+            or any(os.path.splitdrive(part)[0] for part in parts)):
+        raise ValueError('Unsafe member name, not written: {!r}'.format(name))
+    path = os.path.join(folder, *parts)
+    real_folder = os.path.realpath(folder)
+    if os.path.commonpath([real_folder, os.path.realpath(path)]) != real_folder:
+        raise ValueError('Unsafe member name, not written: {!r}'.format(name))
+    return path
+
+
+class ArchiveWriter:
+    """
+    Output of the anonymized members: tar or zip archive, folder, gzip file of a single member, or '-' for
+    a tar stream on standard output
+
+    :param output_path: Path of the output, its extension selects the format and compression
+    """
+
+    def __init__(self, output_path: str):
+        self.output_path = output_path
+        self._tar = None
+        self._zip = None
+        self._folder = None
+        self._gzip_path = None
+        self._count = 0
+        if output_path == STDIO_PATH:
+            self._tar = tarfile.open(fileobj=sys.stdout.buffer, mode='w|')
+        elif _tar_compression(output_path) is not None:
+            compression = _tar_compression(output_path)
+            self._tar = tarfile.open(output_path, mode='w|' + compression)
+        elif output_path.lower().endswith(_ZIP_EXTENSIONS):
+            self._zip = zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED)
+        elif output_path.lower().endswith(_GZIP_EXTENSIONS):
+            self._gzip_path = output_path
+        else:
+            self._folder = output_path
+            os.makedirs(output_path, exist_ok=True)
+
+    def add(self, name: str, content: bytes, mtime: float = None) -> None:
+        """
+        Write a member
+        """
+        if mtime is None:
+            mtime = time.time()
+        if self._tar is not None:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = mtime
+            info.mode = 0o644
+            self._tar.addfile(info, io.BytesIO(content))
+        elif self._zip is not None:
+            info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self._zip.writestr(info, content)
+        elif self._gzip_path is not None:
+            if self._count:
+                raise ValueError('A gzip file holds a single member, use a tar or zip archive: ' + self._gzip_path)
+            if not name.lower().endswith(_GZIP_EXTENSIONS):
+                content = gzip.compress(content)
+            with open(self._gzip_path, 'wb') as member_file:
+                member_file.write(content)
+        else:
+            path = _member_path(self._folder, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as member_file:
+                member_file.write(content)
+        self._count += 1
+
+    def close(self) -> None:
+        if self._tar is not None:
+            self._tar.close()
+            if self.output_path == STDIO_PATH:
+                sys.stdout.buffer.flush()
+        elif self._zip is not None:
+            self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _is_selected(name: str, content: bytes, extensions: Sequence[str], check_preamble: bool) -> bool:
+    if extensions is not None and not name.lower().endswith(tuple(extension.lower() for extension in extensions)):
+        return False
+    if check_preamble and content[PREAMBLE_LENGTH:PREAMBLE_LENGTH + len(DICM_PREFIX)] != DICM_PREFIX:
+        return False
+    return True
+
+
+def anonymize_member(anonymizer, name: str, content: bytes) -> bytes:
+    """
+    Anonymize the content of a member, decompressed and compressed again if its name ends with '.gz'
+    """
+    compressed = name.lower().endswith(_GZIP_EXTENSIONS)
+    if compressed:
+        content = gzip.decompress(content)
+    content = anonymizer.anonymize_bytes(content)
+    if compressed:
+        content = gzip.compress(content)
+    return content
+
+
+def anonymize_archive(anonymizer, input_path: str, output_path: str, progress_bar=None,
+                      extensions: Sequence[str] = None, check_preamble: bool = False) -> int:
+    """
+    Anonymize the members of an input archive into an output archive, member by member
+
+    Either side can also be a folder, or '-' for a tar stream on the standard streams. Members which cannot be
+    anonymized, e.g. a README next to the DICOM files, are logged and left out of the output.
+
+    :param anonymizer: engine.Anonymizer applied to the members
+    :param input_path: Tar or zip archive, gzip file, folder, or '-' for the standard input
+    :param output_path: Tar or zip archive, folder, or '-' for the standard output
+    :param progress_bar: tqdm progress bar updated as members are written
+    :param extensions: Only anonymize the members with one of these extensions (before '.gz'), the others are
+    left out of the output
+    :param check_preamble: Only anonymize the members with the 'DICM' prefix after the preamble, the others are
+    left out of the output
+    :return: Number of members left out because they could not be anonymized
+    """
+    failed = 0
+    with ArchiveWriter(output_path) as writer:
+        for name, content, mtime in iter_members(input_path):
+            stripped_name = name[:-len('.gz')] if name.lower().endswith(_GZIP_EXTENSIONS) else name
+            try:
+                if extensions is not None or check_preamble:
+                    plain_content = gzip.decompress(content) if stripped_name != name else content
+                    if not _is_selected(stripped_name, plain_content, extensions, check_preamble):
+                        continue
+                anonymized_content = anonymize_member(anonymizer, name, content)
+            except Exception as e:
+                logger.error('%s not anonymized, left out of the output: %s: %s', name, type(e).__name__, e)
+                failed += 1
+                continue
+            writer.add(name, anonymized_content, mtime)
+            if progress_bar is not None:
+                progress_bar.update(1)
+    if failed:
+        logger.warning('%d members left out of the output', failed)
+    return failed
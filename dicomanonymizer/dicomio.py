@@ -0,0 +1,371 @@
+"""
+Reading and writing of DICOM files with deferred bulk elements.
+
+Elements larger than defer_size are not read in memory: their values stay in the input file
+and are streamed to the output file when the dataset is saved.
+
+A file can also be read up to its Pixel Data only: the header is anonymized and re-encoded,
+then the rest of the input file is spliced verbatim to the output file.
+"""
+import io
+import os
+import secrets
+import struct
+from typing import Iterator, Optional, Tuple, Union
+
+import pydicom
+from pydicom.charset import default_encoding
+from pydicom.datadict import dictionary_VR, dictionary_has_tag
+from pydicom.filebase import DicomFile, DicomFileLike
+from pydicom.filewriter import write_data_element, write_file_meta_info
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+from pydicom.valuerep import EXPLICIT_VR_LENGTH_32
+
+COPY_CHUNK_SIZE = 1024 * 1024
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# Tags at which pydicom stops reading with stop_before_pixels:
+# Float Pixel Data, Double Float Pixel Data and Pixel Data
+PIXEL_DATA_TAGS = frozenset((0x7FE00008, 0x7FE00009, 0x7FE00010))
+
+
+def read_dataset(in_file, defer_size: Union[int, str] = None) -> pydicom.FileDataset:
+    """
+    Read a DICOM file, leaving the values larger than defer_size in the file
+
+    :param in_file: File path or file-like object to read from
+    :param defer_size: Size in bytes (or string like '512 KB') above which values are not read
+    """
+    return pydicom.dcmread(in_file, defer_size=defer_size)
+
+
+class BufferReader(io.RawIOBase):
+    """
+    Read-only binary file over a bytes-like object (bytes, bytearray, memoryview...), without copying it
+
+    Unlike io.BytesIO, which copies any buffer but bytes, only the parts which are read are copied.
+    """
+
+    def __init__(self, buffer):
+        super().__init__()
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._view) if size is None or size < 0 else min(self._position + size, len(self._view))
+        data = self._view[self._position:end].tobytes()
+        self._position = max(self._position, end)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError('Negative seek position {}'.format(offset))
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+
+def read_header(in_file, defer_size: Union[int, str] = None) -> Tuple[pydicom.FileDataset, Optional[int], tuple]:
+    """
+    Read a DICOM file up to its Pixel Data
+
+    Returns the dataset, the offset of the rest of the file (the tail) and the (tag, end offset) of
+    the top level elements of the tail. The offset is None when the tail cannot be spliced: the
+    transfer syntax is deflated or the tail cannot be parsed.
+
+    :param in_file: File path to read from
+    :param defer_size: Size in bytes (or string like '512 KB') above which header values are not read
+    """
+    with open(in_file, 'rb') as source_file:
+        dataset = pydicom.dcmread(source_file, defer_size=defer_size, stop_before_pixels=True)
+        tail_offset = source_file.tell()
+        file_meta = getattr(dataset, 'file_meta', None)
+        if file_meta is not None and file_meta.get('TransferSyntaxUID') == DeflatedExplicitVRLittleEndian:
+            return dataset, None, ()
+        try:
+            tail_elements = _read_tail_elements(source_file, tail_offset, dataset.is_implicit_VR, dataset.is_little_endian)
+        except (ValueError, struct.error):
+            return dataset, None, ()
+    return dataset, tail_offset, tail_elements
+
+
+def _read_tail_elements(source_file, offset: int, is_implicit_VR: bool, is_little_endian: bool) -> tuple:
+    """
+    (tag, end offset) of the top level elements from offset to the end of the file, the values are skipped
+    """
+    endian = '<' if is_little_endian else '>'
+    file_size = os.fstat(source_file.fileno()).st_size
+    elements = []
+    while offset < file_size:
+        source_file.seek(offset)
+        header = source_file.read(8)
+        if len(header) < 8:
+            raise ValueError('Element header at {} is truncated'.format(offset))
+        group, element_number = struct.unpack(endian + 'HH', header[:4])
+        if is_implicit_VR:
+            length = struct.unpack(endian + 'L', header[4:])[0]
+            value_tell = offset + 8
+        elif header[4:6].decode('ascii', 'replace') in EXPLICIT_VR_LENGTH_32:
+            length = struct.unpack(endian + 'L', source_file.read(4))[0]
+            value_tell = offset + 12
+        else:
+            length = struct.unpack(endian + 'H', header[6:])[0]
+            value_tell = offset + 8
+        tag = (group << 16) | element_number
+        offset = value_tell + _value_length(source_file, tag, value_tell, length, is_little_endian)
+        elements.append((tag, offset))
+    return tuple(elements)
+
+
+def iter_raw_elements(dataset) -> Iterator:
+    """
+    Yield the top level elements in tag order, without converting raw elements nor reading deferred values
+    """
+    # Dataset.elements() reads the deferred values, so the underlying dict is used
+    elements = dataset._dict
+    for tag in sorted(elements):
+        element = elements.get(tag)
+        if element is not None:
+            yield element
+
+
+def is_deferred(element) -> bool:
+    """
+    Whether the value of a raw element has been left in the file
+    """
+    return element.is_raw and element.value is None
+
+
+def _is_streamed(dataset, element) -> bool:
+    # Empty values are deferred by pydicom too, they are cheap to read. pydicom replaces the UN VR of
+    # known tags on read, so these values are read as well to be written with the same VR.
+    return (is_deferred(element) and element.length != 0
+            and not (element.VR == 'UN' and dictionary_has_tag(element.tag))
+            and element.is_implicit_VR == dataset.is_implicit_VR
+            and element.is_little_endian == dataset.is_little_endian
+            and (element.is_implicit_VR or len(element.VR or '') == 2))
+
+
+def is_sequence(dataset, element) -> bool:
+    """
+    Whether an element (raw or not) of the dataset is a sequence, without reading deferred values
+    """
+    vr = element.VR
+    if element.is_raw and vr in (None, 'UN'):
+        # Implicit VR, or unknown VR which pydicom may convert on access
+        if element.value is None:
+            try:
+                return dictionary_VR(element.tag) == 'SQ'
+            except KeyError:
+                return False
+        vr = dataset[element.tag].VR
+    return vr == 'SQ'
+
+
+def _value_length(source_file, tag: int, value_tell: int, length: int, is_little_endian: bool) -> int:
+    """
+    Number of bytes of a value in the source file
+
+    Values of undefined length (encapsulated Pixel Data) are made of items followed by a sequence
+    delimiter, which is counted as pydicom writes it back after the value.
+    """
+    file_size = os.fstat(source_file.fileno()).st_size
+    if length != UNDEFINED_LENGTH:
+        if value_tell + length > file_size:
+            raise ValueError('Value of {:08X} is truncated'.format(tag))
+        return length
+
+    item_header = struct.Struct(('<' if is_little_endian else '>') + 'HHL')
+    position = value_tell
+    while True:
+        source_file.seek(position)
+        header = source_file.read(item_header.size)
+        if len(header) < item_header.size:
+            raise ValueError('Undefined length value of {:08X} is truncated'.format(tag))
+        group, element_number, item_length = item_header.unpack(header)
+        position += item_header.size
+        if (group, element_number) == (0xFFFE, 0xE0DD):
+            return position - value_tell
+        if (group, element_number) != (0xFFFE, 0xE000) or item_length == UNDEFINED_LENGTH:
+            raise ValueError('Undefined length value of {:08X} is not encapsulated'.format(tag))
+        position += item_length
+        if position > file_size:
+            raise ValueError('Undefined length value of {:08X} is truncated'.format(tag))
+
+
+def _kernel_copy(in_fd: int, offset: int, length: int, out_fd: int, out_offset: int) -> int:
+    """
+    Copy with copy_file_range or sendfile when available, return the number of bytes copied
+    """
+    copied = 0
+    try:
+        while copied < length:
+            if hasattr(os, 'copy_file_range'):
+                count = os.copy_file_range(in_fd, out_fd, length - copied, offset + copied, out_offset + copied)
+            elif hasattr(os, 'sendfile'):
+                os.lseek(out_fd, out_offset + copied, os.SEEK_SET)
+                count = os.sendfile(out_fd, in_fd, offset + copied, length - copied)
+            else:
+                break
+            if count == 0:
+                break
+            copied += count
+    except OSError:
+        # Not supported between these files (e.g. across file systems on older kernels),
+        # the rest is copied by the caller
+        pass
+    return copied
+
+
+def _copy_range(source_file, offset: int, length: int, fp, chunk_size: int) -> None:
+    """
+    Copy length bytes of the source file from offset to fp, in the kernel when fp is a regular file
+    """
+    out = getattr(fp, 'parent', fp)
+    try:
+        out.flush()
+        out_fd = out.fileno()
+        out_offset = out.tell()
+    except (AttributeError, OSError, ValueError):
+        # No file descriptor (e.g. BytesIO) or not seekable (e.g. pipe)
+        out_fd = None
+    if out_fd is not None:
+        copied = _kernel_copy(source_file.fileno(), offset, length, out_fd, out_offset)
+        out.seek(out_offset + copied)
+        offset += copied
+        length -= copied
+
+    source_file.seek(offset)
+    while length > 0:
+        chunk = source_file.read(min(chunk_size, length))
+        if not chunk:
+            raise EOFError('Value at {} is truncated in the source file'.format(offset))
+        fp.write(chunk)
+        offset += len(chunk)
+        length -= len(chunk)
+
+
+def _write_deferred_element(fp, element, value_length: int, source_file, chunk_size: int) -> None:
+    """
+    Write the header of a deferred element then copy its value from the source file
+    """
+    fp.write_tag(element.tag)
+    if fp.is_implicit_VR:
+        fp.write_UL(element.length)
+    else:
+        fp.write(element.VR.encode('ascii'))
+        if element.VR in EXPLICIT_VR_LENGTH_32:
+            fp.write_US(0)
+            fp.write_UL(element.length)
+        else:
+            fp.write_US(element.length)
+
+    _copy_range(source_file, element.value_tell, value_length, fp, chunk_size)
+
+
+def _temporary_path(out_file: str) -> str:
+    """
+    Path of a new file next to out_file, to be written before replacing out_file
+    """
+    return '{}.{}.tmp'.format(out_file, secrets.token_hex(8))
+
+
+def save_dataset(dataset: pydicom.FileDataset, out_file, chunk_size: int = COPY_CHUNK_SIZE,
+                 tail: Tuple[int, int] = None) -> None:
+    """
+    Save the dataset like dataset.save_as, streaming the deferred values from the file it was read from
+
+    Falls back to dataset.save_as when nothing is copied from the source file, when the dataset was
+    not read from a file path or when the transfer syntax is deflated.
+
+    :param dataset: Dataset read with read_dataset or read_header
+    :param out_file: File path or file-like object to write to
+    :param chunk_size: Size of the chunks copied from the source file
+    :param tail: (start, end) offsets of the bytes of the source file copied verbatim after the
+    dataset, see read_header
+
+    A file path is written through a temporary file in the same folder, which then replaces it:
+    out_file can be the source file itself.
+    """
+    source = getattr(dataset, 'filename', None)
+    file_meta = getattr(dataset, 'file_meta', None)
+    transfer_syntax = file_meta.get('TransferSyntaxUID') if file_meta is not None else None
+    if tail is None and (not isinstance(source, str)
+                                or transfer_syntax == DeflatedExplicitVRLittleEndian
+                                or not any(_is_streamed(dataset, element) for element in iter_raw_elements(dataset))):
+        if not isinstance(out_file, str):
+            dataset.save_as(out_file)
+            return
+        temporary_path = _temporary_path(out_file)
+        try:
+            dataset.save_as(temporary_path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        os.replace(temporary_path, out_file)
+        return
+
+    caller_owns_file = not isinstance(out_file, str)
+    temporary_path = None
+    if not caller_owns_file:
+        temporary_path = _temporary_path(out_file)
+    with open(source, 'rb') as source_file:
+        fp = DicomFileLike(out_file) if caller_owns_file else DicomFile(temporary_path, 'wb')
+        try:
+            preamble = getattr(dataset, 'preamble', None)
+            if preamble:
+                fp.write(preamble)
+                fp.write(b'DICM')
+            if file_meta:
+                write_file_meta_info(fp, file_meta, enforce_standard=False)
+
+            fp.is_little_endian = dataset.is_little_endian
+            fp.is_implicit_VR = dataset.is_implicit_VR
+            encoding = dataset.get('SpecificCharacterSet', default_encoding)
+            for element in iter_raw_elements(dataset):
+                # do not write retired Group Length (see PS3.5, 7.2)
+                if element.tag.element == 0 and element.tag.group > 6:
+                    continue
+                value_length = None
+                if _is_streamed(dataset, element):
+                    try:
+                        value_length = _value_length(source_file, element.tag, element.value_tell,
+                                                     element.length, element.is_little_endian)
+                    except ValueError:
+                        # Read by pydicom below, which reports the error
+                        pass
+                if value_length is not None:
+                    _write_deferred_element(fp, element, value_length, source_file, chunk_size)
+                elif is_deferred(element):
+                    write_data_element(fp, dataset[element.tag], encoding)
+                else:
+                    write_data_element(fp, element, encoding)
+
+            if tail is not None:
+                _copy_range(source_file, tail[0], tail[1] - tail[0], fp, chunk_size)
+        except BaseException:
+            if not caller_owns_file:
+                fp.close()
+                os.remove(temporary_path)
+            raise
+    if not caller_owns_file:
+        fp.close()
+        os.replace(temporary_path, out_file)
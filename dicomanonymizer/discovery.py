@@ -0,0 +1,79 @@
+"""
+Streaming discovery of the files to anonymize in a directory tree.
+"""
+import os
+from typing import Iterator, Sequence, Tuple
+
+# The 'DICM' prefix follows the 128 bytes preamble in DICOM files
+DICM_PREFIX = b'DICM'
+PREAMBLE_LENGTH = 128
+
+
+def is_dicom_file(path: str) -> bool:
+    """
+    Check whether the file starts with a preamble followed by the 'DICM' prefix
+    """
+    try:
+        with open(path, 'rb') as file:
+            file.seek(PREAMBLE_LENGTH)
+            return file.read(len(DICM_PREFIX)) == DICM_PREFIX
+    except OSError:
+        return False
+
+
+def iter_files(input_folder: str, extensions: Sequence[str] = None, check_preamble: bool = False,
+               skip_folder: str = None) -> Iterator[str]:
+    """
+    Yield the path relative to input_folder of each file in the tree, as it is found
+
+    Directories are read one at a time with os.scandir, symbolic links to directories are not followed.
+
+    :param input_folder: Root of the tree
+    :param extensions: Only yield files with one of these extensions (case insensitive), e.g. ['.dcm']
+    :param check_preamble: Only yield files with the 'DICM' prefix after the preamble
+    :param skip_folder: Folder which is not traversed, e.g. an output folder inside the input tree
+    """
+    if skip_folder is not None:
+        skip_folder = os.path.realpath(skip_folder)
+    if extensions is not None:
+        extensions = tuple(extension.lower() for extension in extensions)
+
+    pending_folders = ['']
+    while pending_folders:
+        relative_folder = pending_folders.pop()
+        with os.scandir(os.path.join(input_folder, relative_folder)) as entries:
+            for entry in entries:
+                relative_path = os.path.join(relative_folder, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if skip_folder is None or os.path.realpath(entry.path) != skip_folder:
+                        pending_folders.append(relative_path)
+                    continue
+                if not entry.is_file():
+                    continue
+                if extensions is not None and not entry.name.lower().endswith(extensions):
+                    continue
+                if check_preamble and not is_dicom_file(entry.path):
+                    continue
+                yield relative_path
+
+
+def iter_paths(input_folder: str, output_folder: str, extensions: Sequence[str] = None,
+               check_preamble: bool = False) -> Iterator[Tuple[str, str]]:
+    """
+    Yield (input file, output file) for each file of the input tree, the output tree mirrors the input one
+
+    Output sub folders are created when their first file is yielded.
+
+    :param input_folder: Root of the input tree
+    :param output_folder: Root of the output tree
+    :param extensions: Only yield files with one of these extensions (case insensitive), e.g. ['.dcm']
+    :param check_preamble: Only yield files with the 'DICM' prefix after the preamble
+    """
+    # Files of a folder are yielded together, so only the current folder is remembered
+    current_folder = None
+    for relative_path in iter_files(input_folder, extensions, check_preamble, output_folder):
+        relative_folder = os.path.dirname(relative_path)
+        if relative_folder != current_folder:
+            os.makedirs(os.path.join(output_folder, relative_folder), exist_ok=True)
+            current_folder = relative_folder
+        yield os.path.join(input_folder, relative_path), os.path.join(output_folder, relative_path)
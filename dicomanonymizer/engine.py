@@ -0,0 +1,508 @@
+"""
+Anonymization engine: compiles the DICOM standard tables plus extra rules once into
+a reusable, immutable plan.
+"""
+import hashlib
+import io
+import json
+import logging
+import time
+from functools import lru_cache, partial
+from types import MappingProxyType
+from typing import Iterable, Iterator
+
+import pydicom
+
+from .dicomio import BufferReader, read_dataset, read_header, save_dataset, iter_raw_elements, is_sequence, PIXEL_DATA_TAGS
+from .instrumentation import get_instrumentation, stage, READ, RULES, PRIVATE_TAGS, WRITE
+from .simpledicomanonymizer import (
+    initialize_actions,
+    replace_element, empty_element, replace_element_UID, delete_element,
+    replace, empty, delete, keep, replace_UID, empty_or_replace, delete_or_empty, delete_or_replace,
+    delete_or_empty_or_replace, delete_or_empty_or_replace_UID, is_regexp,
+    _PRIVATE_CREATOR_FIRST, _PRIVATE_CREATOR_LAST,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def _default_rules() -> MappingProxyType:
+    """
+    Default DICOM standard actions, built once per process
+    """
+    return MappingProxyType(initialize_actions())
+
+
+# Element handlers: (dataset, element) -> None
+# Built-in actions are resolved to these so that the element is fetched once per rule
+
+def _replace_handler(dataset, element):
+    replace_element(element)
+
+
+def _empty_handler(dataset, element):
+    empty_element(element)
+
+
+def _replace_UID_handler(dataset, element):
+    replace_element_UID(element)
+
+
+def _delete_or_empty_or_replace_UID_handler(dataset, element):
+    if element.VR == 'UI':
+        replace_element_UID(element)
+    else:
+        empty_element(element)
+
+
+def _keep_handler(dataset, element):
+    pass
+
+
+def _regexp_handler(substitute, dataset, element):
+    element.value = substitute(str(element.value))
+
+
+_element_handlers = {
+    replace: _replace_handler,
+    empty: _empty_handler,
+    delete: delete_element,
+    replace_UID: _replace_UID_handler,
+    empty_or_replace: _replace_handler,
+    delete_or_empty: _empty_handler,
+    delete_or_replace: _replace_handler,
+    delete_or_empty_or_replace: _replace_handler,
+    delete_or_empty_or_replace_UID: _delete_or_empty_or_replace_UID_handler,
+    keep: _keep_handler,
+}
+
+
+def _describe_action(action) -> str:
+    """
+    Stable description of an action, the same across processes and runs
+    """
+    if isinstance(action, partial):
+        return '{}({})'.format(_describe_action(action.func),
+                               ', '.join([_describe_action(arg) if isinstance(arg, partial) else repr(arg)
+                                          for arg in action.args] +
+                                         ['{}={!r}'.format(key, value) for key, value in sorted(action.keywords.items())]))
+    return '{}.{}'.format(getattr(action, '__module__', None), getattr(action, '__qualname__', repr(action)))
+
+
+def _private_block(key: int):
+    """
+    Element number of the creator of a private element, e.g. 0x0010 for (gggg,1000-10FF), None for the creators
+    and the elements outside the blocks
+    """
+    block = (key & 0xFFFF) >> 8
+    return block if block >= _PRIVATE_CREATOR_FIRST else None
+
+
+def tag_to_int(tag) -> int:
+    """
+    Convert a (group, element) tuple to the integer key used by pydicom
+    """
+    return (tag[0] << 16) | tag[1]
+
+
+class Anonymizer:
+    """
+    Compiled anonymization plan
+
+    The DICOM standard tables and the extra rules are merged and compiled once, then the
+    same object can be applied to any number of datasets or files.
+
+    Two traversals are available:
+    - rule driven (default): each rule is looked up in the dataset, repeating group rules walk
+      the whole dataset. Only top level elements are matched by individual tag rules.
+    - single pass: each element is visited once, nested sequence items included, and its action
+      is resolved with a hash lookup on the tag, then on the repeating group masks. Sequences
+      without action (or kept) are traversed, the others are handled by their action.
+
+    :param extra_anonymization_rules: add more tag's actions, overriding the standard ones
+    :param delete_private_tags: Define if private tags should be delete or not
+    :param single_pass: Use the element driven traversal instead of the rule driven one
+    """
+
+    def __init__(self, extra_anonymization_rules: dict = None, delete_private_tags: bool = True,
+                 single_pass: bool = False):
+        rules = dict(_default_rules())
+        if extra_anonymization_rules is not None:
+            rules.update(extra_anonymization_rules)
+
+        self._rules = MappingProxyType(rules)
+        self._delete_private_tags = delete_private_tags
+        self._single_pass = single_pass
+        self._fingerprint = None
+        self._steps = tuple(self._compile_step(tag, action) for tag, action in rules.items())
+
+        # Indexes for the single pass traversal
+        tag_index = {}
+        meta_index = {}
+        masks = {}
+        for step in self._steps:
+            tag, key = step[0], step[1]
+            if key is None:
+                group, element, group_mask, element_mask = tag
+                masks.setdefault((group_mask, element_mask), {})[(group, element)] = step
+            elif tag[0] == 0x0002:
+                meta_index[key] = step
+            else:
+                tag_index[key] = step
+        self._tag_index = MappingProxyType(tag_index)
+        self._meta_index = MappingProxyType(meta_index)
+        self._mask_index = tuple((group_mask, element_mask, MappingProxyType(index))
+                                 for (group_mask, element_mask), index in masks.items())
+
+    def __reduce__(self):
+        # Sent to worker processes as rules, compiled again once per worker
+        return self.__class__, (dict(self._rules), self._delete_private_tags, self._single_pass)
+
+    @staticmethod
+    def _compile_step(tag, action) -> tuple:
+        """
+        Compile one rule into (tag, key, action, handler, is_private)
+
+        The key is None for repeating group rules, which are stored as
+        (group, element, group_mask, element_mask) in the tag.
+        """
+        if len(tag) > 2:
+            return tag, None, action, None, False
+        if is_regexp(action):
+            # Patterns compiled by regexp(options)
+            handler = partial(_regexp_handler, action.args[1])
+        else:
+            handler = _element_handlers.get(action)
+        return tag, tag_to_int(tag), action, handler, bool(tag[0] & 1)
+
+    @property
+    def rules(self) -> MappingProxyType:
+        """
+        Read-only view of the merged tag -> action rules
+        """
+        return self._rules
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Hash of the rules and options of the plan, it changes whenever the output could change
+        """
+        if self._fingerprint is None:
+            description = json.dumps({
+                'rules': sorted([list(tag), _describe_action(action)] for tag, action in self._rules.items()),
+                'delete_private_tags': self._delete_private_tags,
+                'single_pass': self._single_pass,
+            })
+            self._fingerprint = hashlib.sha256(description.encode('utf-8')).hexdigest()
+        return self._fingerprint
+
+    @property
+    def delete_private_tags(self) -> bool:
+        return self._delete_private_tags
+
+    @property
+    def single_pass(self) -> bool:
+        return self._single_pass
+
+    def anonymize_dicom_file(self, in_file: str, out_file: str, defer_size=None, splice: bool = False) -> None:
+        """
+        Anonymize a DICOM file by modifying personal tags
+
+        :param in_file: File path or file-like object to read from
+        :param out_file: File path or file-like object to write to
+        :param defer_size: Values larger than this size in bytes are not read in memory but
+        streamed from in_file to out_file
+        :param splice: Only read and re-encode the elements before the Pixel Data, the Pixel Data
+        is copied verbatim from in_file. Files which cannot be spliced, or file-like objects, are read entirely.
+        """
+        dataset, tail = self.read_dicom_file(in_file, defer_size, splice)
+        self.anonymize_dataset(dataset)
+        self.write_dicom_file(dataset, out_file, tail)
+
+    def anonymize_bytes(self, data) -> bytes:
+        """
+        Anonymize a DICOM file held in memory
+
+        :param data: Content of the file: bytes, bytearray, memoryview or any object supporting the buffer
+        protocol, or a binary file-like object
+        :return: Content of the anonymized file
+        """
+        out_file = io.BytesIO()
+        self.anonymize_dicom_file(data if hasattr(data, 'read') else BufferReader(data), out_file)
+        return out_file.getvalue()
+
+    def anonymize_buffers(self, buffers: Iterable, as_datasets: bool = False) -> Iterator:
+        """
+        Anonymize DICOM files held in memory, as they are consumed
+
+        The compiled plan is shared by the whole batch, and so is the mapping of the replaced UIDs
+        (see set_uid_map and set_uid_key), so the files of a study keep consistent UIDs.
+
+        :param buffers: Iterable of file contents, see anonymize_bytes
+        :param as_datasets: Yield the anonymized datasets instead of their encoded content
+        :return: Iterator of the anonymized contents (bytes) or datasets, in the order of buffers
+        """
+        for data in buffers:
+            if as_datasets:
+                dataset, _ = self.read_dicom_file(data if hasattr(data, 'read') else BufferReader(data))
+                self.anonymize_dataset(dataset)
+                yield dataset
+            else:
+                yield self.anonymize_bytes(data)
+
+    def read_dicom_file(self, in_file, defer_size=None, splice: bool = False) -> tuple:
+        """
+        First step of anonymize_dicom_file: read the file to anonymize
+
+        :param in_file: File path or file-like object to read from
+        :param defer_size: See anonymize_dicom_file
+        :param splice: See anonymize_dicom_file
+        :return: (dataset, tail), tail is the range of in_file to copy after the dataset, or None
+        """
+        tail = None
+        with stage(READ):
+            if splice and isinstance(in_file, str):
+                dataset, tail_offset, tail_elements = read_header(in_file, defer_size)
+                if tail_offset is not None:
+                    tail = self._splice_range(tail_offset, tail_elements)
+                if tail is None:
+                    # No Pixel Data, or elements after it which the rules change
+                    logger.debug('%s cannot be spliced, reading it entirely', in_file)
+                    dataset = read_dataset(in_file, defer_size)
+            else:
+                dataset = read_dataset(in_file, defer_size)
+        return dataset, tail
+
+    @staticmethod
+    def write_dicom_file(dataset: pydicom.FileDataset, out_file, tail: tuple = None) -> None:
+        """
+        Last step of anonymize_dicom_file: write the anonymized dataset
+
+        :param dataset: Dataset returned by read_dicom_file, once anonymized
+        :param out_file: File path or file-like object to write to
+        :param tail: Tail returned by read_dicom_file
+        """
+        # Store modified image
+        with stage(WRITE):
+            save_dataset(dataset, out_file, tail=tail)
+
+    def _splice_range(self, tail_offset: int, tail_elements: tuple):
+        """
+        Range of the tail which can be copied as is, or None if the file cannot be spliced
+
+        The tail must be pixel data elements without rule, followed only by elements which
+        would be deleted (e.g. Data Set Trailing Padding) and are thus left out.
+        """
+        end = tail_offset
+        copied = True
+        for key, element_end in tail_elements:
+            step = self._find_step(key)
+            if copied and key in PIXEL_DATA_TAGS and step is None:
+                end = element_end
+                continue
+            copied = False
+            if step is None:
+                deleted = self._delete_private_tags and bool((key >> 16) & 1)
+            else:
+                deleted = step[3] is delete_element
+            if not deleted:
+                return None
+        return tail_offset, end
+
+    def find_rule(self, key: int):
+        """
+        Rule applying to an element, as (tag, action), None if no rule applies
+
+        :param key: Tag of the element, as an integer
+        """
+        if key >> 16 == 0x0002:
+            step = self._find_step(key, self._meta_index, ())
+        else:
+            step = self._find_step(key)
+        return None if step is None else (step[0], step[2])
+
+    def _find_step(self, key: int, tag_index=None, mask_index=None):
+        """
+        Step of the plan applying to an element: tag rule first, then repeating group rules
+        """
+        tag_index = self._tag_index if tag_index is None else tag_index
+        mask_index = self._mask_index if mask_index is None else mask_index
+        step = tag_index.get(key)
+        if step is not None:
+            return step
+        group, element_number = key >> 16, key & 0xFFFF
+        for group_mask, element_mask, index in mask_index:
+            step = index.get((group & group_mask, element_number & element_mask))
+            if step is not None:
+                return step
+        return None
+
+    def anonymize_dataset(self, dataset: pydicom.Dataset) -> None:
+        """
+        Anonymize a pydicom Dataset in place with the compiled plan
+
+        :param dataset: Dataset to be anonymize
+        """
+        instrumentation = get_instrumentation()
+
+        # X - Private tags = (0xgggg, 0xeeee) where 0xgggg is odd
+        # The private elements with a rule are kept in place, the others are deleted: by the single pass traversal
+        # as it visits them, or by a walk after the rules
+        with stage(RULES):
+            if self._single_pass:
+                file_meta = getattr(dataset, 'file_meta', None)
+                if file_meta is not None:
+                    self._anonymize_elements(file_meta, self._meta_index, (), instrumentation)
+                self._anonymize_elements(dataset, self._tag_index, self._mask_index, instrumentation)
+            else:
+                kept_private_tags = self._anonymize_rules(dataset, instrumentation)
+
+        if self._delete_private_tags and not self._single_pass:
+            with stage(PRIVATE_TAGS):
+                self._remove_private_tags(dataset, kept_private_tags)
+
+    def _anonymize_rules(self, dataset, instrumentation=None) -> set:
+        """
+        Rule driven traversal: apply each rule of the plan in order
+
+        :return: Tags of the private elements with a rule, and of their creators, to keep in the dataset
+        """
+        kept_private_tags = set()
+        for tag, key, action, handler, is_private in self._steps:
+            if instrumentation is not None:
+                start = time.perf_counter()
+
+            # We are in a repeating group
+            if key is None:
+                hits = self._apply_repeating_group_rule(dataset, tag, action)
+                if instrumentation is not None:
+                    instrumentation.add_rule(tag, action, hits, time.perf_counter() - start)
+                continue
+
+            # From : https://github.com/KitwareMedical/dicom-anonymizer/pull/18
+            # The meta header information is located in the `file_meta` dataset
+            # For tags with tag group `0x0002` we thus apply the action to the `file_meta` dataset
+            target = dataset.file_meta if tag[0] == 0x0002 else dataset
+            if handler is None:
+                hits = key in target
+                action(target, tag)
+            elif handler is not _keep_handler:
+                element = target.get(key)
+                hits = element is not None
+                if hits:
+                    handler(target, element)
+            else:
+                hits = False
+
+            # Keep the private element, and its creator, if the action did not delete it
+            if is_private and key in dataset:
+                kept_private_tags.add(key)
+                block = _private_block(key)
+                if block is not None:
+                    kept_private_tags.add((key & 0xFFFF0000) | block)
+
+            if instrumentation is not None:
+                instrumentation.add_rule(tag, action, int(hits), time.perf_counter() - start)
+
+        return kept_private_tags
+
+    def _anonymize_elements(self, dataset, tag_index, mask_index, instrumentation=None) -> None:
+        """
+        Single pass traversal: visit each element once and resolve its action from the indexes
+
+        When private tags are deleted, the private elements without a rule are deleted as they are visited, and
+        the private creators once the blocks with a kept element are known.
+        """
+        delete_private_tags = self._delete_private_tags
+        private_creators = []
+        kept_blocks = set()
+        for raw_element in list(iter_raw_elements(dataset)):
+            key = raw_element.tag
+            step = self._find_step(key, tag_index, mask_index)
+
+            if delete_private_tags and key.is_private and (step is None or not step[4]):
+                if _PRIVATE_CREATOR_FIRST <= key & 0xFFFF <= _PRIVATE_CREATOR_LAST:
+                    private_creators.append(key)
+                else:
+                    del dataset[key]
+                continue
+
+            if step is None or step[3] is _keep_handler:
+                # No action on the element itself: traverse the sequence items
+                if is_sequence(dataset, raw_element):
+                    for sub_dataset in dataset[key].value:
+                        self._anonymize_elements(sub_dataset, tag_index, mask_index, instrumentation)
+                if step is None:
+                    continue
+
+            if instrumentation is not None:
+                start = time.perf_counter()
+
+            rule_tag, rule_key, action, handler, is_private = step
+            tag = rule_tag
+            if rule_key is None:
+                # Repeating group rule: the action receives the tag of the element
+                tag = (key >> 16, key & 0xFFFF)
+            if handler is None:
+                action(dataset, tag)
+            elif handler is not _keep_handler:
+                element = dataset.get(key)
+                if element is not None:
+                    handler(dataset, element)
+
+            # The items of a sequence handled by its action are not traversed: delete their private elements
+            if delete_private_tags and handler is not _keep_handler and key in dataset \
+                    and is_sequence(dataset, dataset.get_item(key)):
+                for sub_dataset in dataset[key].value:
+                    self._remove_private_tags(sub_dataset)
+
+            # Keep the creator of a private element if the action did not delete it
+            if is_private and key in dataset:
+                kept_blocks.add((key >> 16, _private_block(key)))
+
+            if instrumentation is not None:
+                instrumentation.add_rule(rule_tag, action, 1, time.perf_counter() - start)
+
+        for key in private_creators:
+            if (key >> 16, key & 0xFFFF) not in kept_blocks:
+                del dataset[key]
+
+    @classmethod
+    def _apply_repeating_group_rule(cls, dataset, tag, action) -> int:
+        """
+        Apply the action to the elements matching the masks, nested sequences included
+
+        Same traversal as dataset.walk, without reading the deferred values
+
+        :return: Number of elements the action was applied to
+        """
+        group, element, group_mask, element_mask = tag
+        hits = 0
+        for raw_element in list(iter_raw_elements(dataset)):
+            data_tag = raw_element.tag
+            if data_tag.group & group_mask == group and data_tag.element & element_mask == element:
+                action(dataset, (data_tag.group, data_tag.element))
+                hits += 1
+            # 'data_tag in dataset' needed in case the action deleted the element
+            if data_tag in dataset and is_sequence(dataset, raw_element):
+                for sub_dataset in dataset[data_tag].value:
+                    hits += cls._apply_repeating_group_rule(sub_dataset, tag, action)
+        return hits
+
+    @classmethod
+    def _remove_private_tags(cls, dataset, kept_tags=()):
+        """
+        Remove all private elements, nested sequences included
+
+        Same as dataset.remove_private_tags, without reading the deferred values
+
+        :param kept_tags: Tags of the private elements kept at the top level of the dataset
+        """
+        for raw_element in list(iter_raw_elements(dataset)):
+            if raw_element.tag.is_private:
+                if raw_element.tag not in kept_tags:
+                    del dataset[raw_element.tag]
+            elif is_sequence(dataset, raw_element):
+                for sub_dataset in dataset[raw_element.tag].value:
+                    cls._remove_private_tags(sub_dataset)
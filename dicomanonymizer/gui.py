@@ -1,25 +1,167 @@
 import warnings
 
-from PySide2.QtWidgets import QApplication, QLabel, QWidget, QCheckBox, QLineEdit, QFileSystemModel, QPushButton, QListView, QTableWidget, QTableWidgetItem, QMessageBox
+from PySide2.QtWidgets import QApplication, QLabel, QWidget, QCheckBox, QLineEdit, QFileSystemModel, QPushButton, QListView, QTableWidget, QTableWidgetItem, QMessageBox, QSplashScreen
 from PySide2.QtWidgets import QGridLayout, QVBoxLayout, QHBoxLayout, QToolButton, QGroupBox, QFileDialog, QProgressDialog, QAbstractItemView, QHeaderView, QStyleOptionViewItem
-from PySide2.QtCore import Qt, QSize, QModelIndex, QUrl
+from PySide2.QtCore import Qt, QSize, QModelIndex, QUrl, QObject, QRunnable, QThreadPool, Signal
 from PySide2.QtGui import QIcon, QPixmap, QPainter, QColor, QDesktopServices
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import os, sys
-import ast
+import argparse
+import logging
+import threading
+import time
 
-from dicomanonymizer.anonymizer import generate_actions, anonymize_dicom_file, actions_map_name_functions
-import json
+from dicomanonymizer.anonymizer import generate_actions, anonymize_dicom_file, actions_map_name_functions, anonymize_in_pool
+from dicomanonymizer.discovery import iter_files, is_dicom_file
+from dicomanonymizer.engine import Anonymizer
+from dicomanonymizer.manifest import RunManifest, anonymize_and_describe
+from dicomanonymizer.ruleset import load_ruleset, parse_tag
+from dicomanonymizer.simpledicomanonymizer import set_uid_map, merge_actions
+from dicomanonymizer.uidmap import SQLiteUIDMap
+
+logger = logging.getLogger(__name__)
 
 ROOT_PATH = os.path.split(os.path.dirname(os.path.realpath(__file__)))[0]
 
 
+class RunSignals(QObject):
+    # Number of files to process, once they are all found
+    discovered = Signal(int)
+    # Files done, files per second, seconds left (-1 if unknown)
+    progress = Signal(int, float, float)
+    error = Signal(str)
+    # False if the run was cancelled or stopped by an error
+    finished = Signal(bool)
+
+
+class RunWorker(QRunnable):
+    """
+    Find and anonymize the files out of the Qt main thread, with a pool of processes if workers > 1
+
+    Progress is reported through the signals, cancel() stops the run within a fraction of a second.
+    """
+    def __init__(self, anonymizer: Anonymizer, selection: list, output_folder: str, check_preamble: bool,
+                 workers: int, uid_map_path: str = None, manifest: RunManifest = None):
+        """
+        :param selection: List of (file or folder, valid), valid is None if the path was not validated yet
+        :param output_folder: Folder of the anonymized files, a sub folder is made for each selected path
+        :param check_preamble: Detect the DICOM files by the 'DICM' prefix after the preamble instead of the .dcm extension
+        """
+        super().__init__()
+        self.setAutoDelete(False)
+        self.signals = RunSignals()
+        self.anonymizer = anonymizer
+        self.selection = selection
+        self.output_folder = output_folder
+        self.check_preamble = check_preamble
+        self.paths = []
+        self.workers = workers
+        self.uid_map_path = uid_map_path
+        self.manifest = manifest
+        self.cancel_event = threading.Event()
+        self.done = 0
+        self.start_time = None
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def update(self, n: int):
+        # Same interface as the progress bar of anonymize_in_pool
+        self.done += n
+        elapsed = time.monotonic() - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0.
+        eta = (len(self.paths) - self.done) / rate if rate > 0 else -1.
+        self.signals.progress.emit(self.done, rate, eta)
+
+    def run(self):
+        try:
+            paths = self.__discover()
+            if self.manifest is not None:
+                # Files already anonymized with the same rules in a previous run are skipped
+                paths = list(self.manifest.pending(paths))
+            self.paths = paths
+            self.signals.discovered.emit(len(self.paths))
+            self.start_time = time.monotonic()
+            workers = min(self.workers, len(self.paths))
+            if self.cancel_event.is_set():
+                completed = False
+            elif workers > 1:
+                completed = anonymize_in_pool(self.anonymizer, self.paths, workers, self,
+                                              uid_map_path=self.uid_map_path, chunk_size=1,
+                                              on_result=self.manifest.record if self.manifest is not None else None,
+                                              cancel_event=self.cancel_event)
+            else:
+                completed = self.__run_in_thread()
+        except Exception as e:
+            self.signals.error.emit('{}: {}'.format(type(e).__name__, e))
+            completed = False
+        self.signals.finished.emit(completed)
+
+    def __discover(self) -> list:
+        """
+        (input file, output file) of the selected paths, the files of a folder are numbered in sorted order
+        """
+        extensions = None if self.check_preamble else ['.dcm']
+        paths = []
+        new_id = 0
+        for (p, valid) in self.selection:
+            if self.cancel_event.is_set():
+                break
+            if valid is None:
+                # Was still being validated in the background
+                valid, _ = validate_path(p, self.check_preamble)
+            if not valid:
+                continue
+            new_folder_path = os.path.join(self.output_folder, 'Anonymized_{:04d}'.format(new_id))
+            if os.path.isdir(p):
+                # Traverse the whole patient folder to gather all the studies
+                files_in_path = sorted(iter_files(p, extensions, self.check_preamble))
+                if len(files_in_path):
+                    os.makedirs(new_folder_path, exist_ok=True)
+                    for i, f in enumerate(files_in_path):
+                        new_f = os.path.join(new_folder_path, 'Image_{:04d}.dcm'.format(i))
+                        paths.append((os.path.join(p, f), new_f))
+            elif os.path.isfile(p):
+                os.makedirs(new_folder_path, exist_ok=True)
+                paths.append((p, os.path.join(new_folder_path, 'Image_{:04d}'.format(new_id) + '.dcm')))
+            new_id += 1
+        return paths
+
+    def __run_in_thread(self) -> bool:
+        uid_map = None
+        if self.uid_map_path is not None:
+            uid_map = SQLiteUIDMap(self.uid_map_path)
+            previous_uid_map = set_uid_map(uid_map)
+            if self.manifest is not None:
+                # Committed before the manifest, see RunManifest
+                self.manifest.uid_map = uid_map
+        try:
+            for in_file, out_file in self.paths:
+                if self.cancel_event.is_set():
+                    return False
+                if self.manifest is not None:
+                    self.manifest.record(anonymize_and_describe(self.anonymizer, in_file, out_file))
+                else:
+                    self.anonymizer.anonymize_dicom_file(in_file, out_file)
+                self.update(1)
+        finally:
+            if uid_map is not None:
+                if self.manifest is not None:
+                    self.manifest.flush()
+                    self.manifest.uid_map = None
+                set_uid_map(previous_uid_map)
+                uid_map.close()
+        return True
+
+
 class OptionsWidget:
-    def __init__(self):
+    def __init__(self, uid_map_path: str = None, manifest_path: str = None):
         # Options
         self.cb_keep_private_tags = QCheckBox("Keep Private Tags")
+        self.cb_check_preamble = QCheckBox("Detect DICOM files by content")
+        self.cb_check_preamble.setToolTip("Look for the 'DICM' prefix after the preamble instead of the .dcm extension")
         self.button_fix_output_dir = QPushButton("Select output folder")
         self.button_fix_output_dir.setCheckable(True)
         self.output_folder = FileSelector(button_label='Select directory', directory=True)
@@ -30,6 +172,14 @@ class OptionsWidget:
         self.line_tag_actions.setText("(0x0010,0x0020);replace_UID;")
         self.line_tag_actions.setToolTip("Separate the items with semicolon (;). E.g., (0x0010,0x0020);replace_UID;(0x001,0x001);keep;")
         self.dict_file_widget = FileSelector(label='Dictionary', button_label='...', selection_filter='JSON (*.json)')
+        self.uid_map_widget = FileSelector(label='UID map', button_label='...', selection_filter='SQLite (*.sqlite *.db)')
+        self.uid_map_widget.setToolTip("SQLite file which stores the replaced UIDs, reuse it to keep the same UIDs across runs")
+        if uid_map_path is not None:
+            self.uid_map_widget._set_text_box(uid_map_path)
+        self.manifest_widget = FileSelector(label='Run manifest', button_label='...', selection_filter='SQLite (*.sqlite *.db)')
+        self.manifest_widget.setToolTip("SQLite file which records the processed files, reuse it to skip the files already anonymized with the same rules")
+        if manifest_path is not None:
+            self.manifest_widget._set_text_box(manifest_path)
 
         self._layout_tag_actions = QHBoxLayout()
         self._layout_options = QVBoxLayout()
@@ -44,26 +194,35 @@ class OptionsWidget:
 
         self._layout_options.alignment()
         self._layout_options.addWidget(self.cb_keep_private_tags)
+        self._layout_options.addWidget(self.cb_check_preamble)
         self._layout_options.addLayout(self._layout_tag_actions)
         self._layout_options.addWidget(self.dict_file_widget)
+        self._layout_options.addWidget(self.uid_map_widget)
+        self._layout_options.addWidget(self.manifest_widget)
         self._layout_options.setAlignment(Qt.AlignTop)
         self._layout_options.addWidget(self.button_fix_output_dir)
         self._layout_options.addWidget(self.output_folder)
         self.container_box.setLayout(self._layout_options)
         self.container_box.setMinimumWidth(400)
-        self.container_box.setFixedHeight(200)
+        self.container_box.setFixedHeight(300)
 
     def setEnabled(self, arg__1: bool):
         self.line_tag_actions.setEnabled(arg__1)
         self.cb_keep_private_tags.setEnabled(arg__1)
+        self.cb_check_preamble.setEnabled(arg__1)
         self.dict_file_widget.setEnabled(arg__1)
+        self.uid_map_widget.setEnabled(arg__1)
+        self.manifest_widget.setEnabled(arg__1)
         self.button_fix_output_dir.setEnabled(arg__1)
         self.output_folder.setEnabled(arg__1)
 
     def setDisabled(self, arg__1: bool):
         self.line_tag_actions.setDisabled(arg__1)
         self.cb_keep_private_tags.setDisabled(arg__1)
+        self.cb_check_preamble.setDisabled(arg__1)
         self.dict_file_widget.setDisabled(arg__1)
+        self.uid_map_widget.setDisabled(arg__1)
+        self.manifest_widget.setDisabled(arg__1)
         self.button_fix_output_dir.setDisabled(arg__1)
         self.output_folder.setDisabled(arg__1)
 
@@ -160,7 +319,7 @@ class SelectorWidget:
         self.find_directory.text_box.textChanged.connect(self.__update_list_view)
 
         self.button_up = QToolButton()
-        print('--QIcon path: ' + os.path.join(ROOT_PATH, 'images/up.png'))
+        logger.debug('QIcon path: %s', os.path.join(ROOT_PATH, 'images/up.png'))
         button_up_icon = QIcon()
         button_up_icon.addPixmap(QPixmap(os.path.join(ROOT_PATH, 'images/up.png')), QIcon.Normal, QIcon.On)
         self.button_up.setIconSize(QSize(30, 30))
@@ -240,7 +399,84 @@ class SelectorWidget:
             self.go_in_directory(os.path.dirname(current_dir))
 
 
+def validate_path(path: str, check_preamble: bool = False) -> (bool, int):
+    """
+    Whether a selected path can be anonymized, and its number of DICOM files (sub folders included)
+
+    :param path: File or folder
+    :param check_preamble: Detect the DICOM files by the 'DICM' prefix after the preamble instead of the .dcm extension
+    """
+    if os.path.isdir(path):
+        extensions = None if check_preamble else ['.dcm']
+        count = sum(1 for _ in iter_files(path, extensions, check_preamble))
+        return count > 0, count
+    if os.path.isfile(path):
+        valid = is_dicom_file(path) if check_preamble else path.lower().endswith('.dcm')
+        return valid, int(valid)
+    return False, 0
+
+
+class PathValidationSignals(QObject):
+    # Path, check_preamble, valid, number of DICOM files
+    validated = Signal(str, bool, bool, int)
+
+
+def tree_mtime_ns(path: str) -> int:
+    """
+    Latest modification time of a file, or of the folders of a tree: adding, removing or renaming a file
+    anywhere in the tree changes it
+
+    Symbolic links to directories are not followed, like in discovery.iter_files.
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    pending_folders = [path] if os.path.isdir(path) else []
+    while pending_folders:
+        with os.scandir(pending_folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    mtime_ns = max(mtime_ns, entry.stat(follow_symlinks=False).st_mtime_ns)
+                    pending_folders.append(entry.path)
+    return mtime_ns
+
+
+class PathValidationTask(QRunnable):
+    """
+    Validate a path out of the Qt main thread, results are cached by path and tree_mtime_ns
+    """
+    def __init__(self, path: str, check_preamble: bool, signals: PathValidationSignals, cache: dict,
+                 cache_lock: threading.Lock):
+        super().__init__()
+        self.signals = signals
+        self.path = path
+        self.check_preamble = check_preamble
+        self.cache = cache
+        self.cache_lock = cache_lock
+
+    def run(self):
+        try:
+            mtime_ns = tree_mtime_ns(self.path)
+        except OSError:
+            mtime_ns = None
+        key = (self.path, self.check_preamble)
+        with self.cache_lock:
+            cached = self.cache.get(key)
+        if cached is not None and mtime_ns is not None and cached[0] == mtime_ns:
+            valid, count = cached[1:]
+        else:
+            try:
+                valid, count = validate_path(self.path, self.check_preamble)
+            except OSError:
+                valid, count = False, 0
+            if mtime_ns is not None:
+                with self.cache_lock:
+                    self.cache[key] = (mtime_ns, valid, count)
+        self.signals.validated.emit(self.path, self.check_preamble, valid, count)
+
+
 class SelectionTable:
+    # Number of paths validated at the same time, the validation is mostly waiting for the file system
+    VALIDATION_THREADS = 4
+
     def __init__(self, custom_cell_styler=None):
         self.table = QTableWidget()
         self.__initialize_table(custom_cell_styler)
@@ -266,13 +502,24 @@ class SelectionTable:
         self.__rows_counter = 0
         self.__id_dict = dict()
 
+        # Paths are validated in the background, the results are kept across entries
+        self.check_preamble = False
+        self.__validation_pool = QThreadPool()
+        self.__validation_pool.setMaxThreadCount(self.VALIDATION_THREADS)
+        self.__validation_cache = dict()
+        self.__validation_cache_lock = threading.Lock()
+        self.__validation_signals = PathValidationSignals()
+        self.__validation_signals.validated.connect(self.__slot_path_validated)
+
     def __initialize_table(self, cell_style=None):
-        self.table.setColumnCount(2)
+        self.table.setColumnCount(3)
         self.table.setHorizontalHeaderItem(0, QTableWidgetItem('Path'))
         self.table.setHorizontalHeaderItem(1, QTableWidgetItem('Valid'))
+        self.table.setHorizontalHeaderItem(2, QTableWidgetItem('Files'))
         self.table.setColumnHidden(1, True)
         self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Fixed)
         self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.horizontalHeader().setSectionResizeMode(2, QHeaderView.ResizeToContents)
         self.table.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.table.setMinimumHeight(300)
         self.table.setMinimumWidth(400)
@@ -282,26 +529,40 @@ class SelectionTable:
     def add_entry(self, new_path):
         if not self.__is_duplicated(new_path):
             self.table.insertRow(self.__rows_counter)
-            valid = self.__check_path_validity(new_path)
+            # Valid is None until the validation is done
             self.table.setItem(self.__rows_counter, 0, QTableWidgetItem(new_path))
-            self.table.setItem(self.__rows_counter, 1, QTableWidgetItem(str(valid)))
-            if not valid:
-                self.__change_row_colour(self.__rows_counter)
+            self.table.setItem(self.__rows_counter, 1, QTableWidgetItem(str(None)))
+            self.table.setItem(self.__rows_counter, 2, QTableWidgetItem('...'))
             self.__id_dict[new_path] = self.__rows_counter
             self.__rows_counter += 1
+            self.__validate(new_path)
         else:
             warnings.warn('Duplicated entry: ' + new_path)
 
-    @staticmethod
-    def __check_path_validity(query):
-        if os.path.isdir(query):
-            files = [f for f in os.listdir(query) if f.endswith('.dcm')]
-            valid = bool(len(files))
-        elif os.path.isfile(query):
-            valid = os.path.split(query)[-1].split('.')[-1].lower() == 'dcm'
-        else:
-            raise ValueError('Something went wrong. Got: ' + query)
-        return valid
+    def set_check_preamble(self, check_preamble: bool):
+        """
+        Detect the DICOM files by their preamble instead of their extension, and validate the entries again
+        """
+        self.check_preamble = check_preamble
+        for r in range(self.__rows_counter):
+            self.table.item(r, 1).setText(str(None))
+            self.table.item(r, 2).setText('...')
+            self.__change_row_colour(r, (255, 255, 255, 255))
+            self.__validate(self.table.item(r, 0).text())
+
+    def __validate(self, path):
+        self.__validation_pool.start(PathValidationTask(path, self.check_preamble, self.__validation_signals,
+                                                        self.__validation_cache, self.__validation_cache_lock))
+
+    def __slot_path_validated(self, path: str, check_preamble: bool, valid: bool, count: int):
+        row = self.__find_row(path)
+        if row is None or check_preamble != self.check_preamble:
+            # Removed from the list or validated again in the meantime
+            return
+        self.table.item(row, 1).setText(str(valid))
+        self.table.item(row, 2).setText(str(count))
+        if not valid:
+            self.__change_row_colour(row)
 
     def remove_entry(self, entry_path):
         row_to_remove = self.__id_dict[entry_path]
@@ -312,7 +573,8 @@ class SelectionTable:
         data = list()
         for r in range(self.__rows_counter):
             path, valid = self.table.item(r, 0), self.table.item(r, 1)
-            data.append((path.text(), eval(valid.text())))
+            # True, False, or None while still being validated
+            data.append((path.text(), {'True': True, 'False': False}.get(valid.text())))
         if clear:
             self.clear_table()
         return data
@@ -322,12 +584,13 @@ class SelectionTable:
             self.table.item(row, c).setBackground(QColor(*colour))
 
     def __is_duplicated(self, query):
-        ret_val = False
+        return self.__find_row(query) is not None
+
+    def __find_row(self, query):
         for r in range(self.table.rowCount()):
-            ret_val = query == self.table.item(r, 0).text()
-            if ret_val:
-                break
-        return ret_val
+            if query == self.table.item(r, 0).text():
+                return r
+        return None
 
     def clear_table(self):
         self.table.clearContents()
@@ -339,7 +602,8 @@ class SelectionTable:
     def clear_invalid(self):
         num_removed = 0
         for r in range(self.__rows_counter).__reversed__():
-            if not eval(self.table.item(r, 1).text()):
+            # Entries still being validated are kept
+            if self.table.item(r, 1).text() == str(False):
                 self.table.removeRow(r)
                 num_removed += 1
         self.__rows_counter -= num_removed
@@ -357,9 +621,13 @@ class SelectionTable:
 
 
 class AnonymizerGUI:
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, uid_map_path: str = None, manifest_path: str = None, workers: int = None):
         self.__file_selector_widget = SelectorWidget()
-        self.__options_widget = OptionsWidget()
+        self.__options_widget = OptionsWidget(uid_map_path, manifest_path)
+        self.__workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.__run_worker = None
+        self.__run_output_folder = None
+        self.__dialog_progress = None
 
         self.__run_button = QPushButton('Run')
         self.__run_button.setStyleSheet("background-color: rgb(128, 255, 128);")
@@ -370,6 +638,7 @@ class AnonymizerGUI:
         self.__file_selector_widget.selection_table.button_clear.clicked.connect(self.__toggle_run_button)
         self.__file_selector_widget.selection_table.button_clear_invalid.clicked.connect(self.__toggle_run_button)
         self.__file_selector_widget.button_transfer_to_table.clicked.connect(self.__toggle_run_button)
+        self.__options_widget.cb_check_preamble.toggled.connect(self.__file_selector_widget.selection_table.set_check_preamble)
 
         self.layout = QGridLayout()
 
@@ -396,54 +665,69 @@ class AnonymizerGUI:
 
     def __slot_run_button(self):
         selected_data = self.__file_selector_widget.selection_table.get_data()
-        paths_to_process = list()
 
         output_folder = ROOT_PATH if self.__options_widget.output_folder.text_box.text() == '' else self.__options_widget.output_folder.text_box.text()
         output_folder = os.path.join(output_folder, 'Anonymized_{}'.format(datetime.now().strftime('%H%M%S_%d%m%Y')))
-        new_id = 0
-        for (p, valid) in selected_data:
-            if valid:
-                if os.path.isdir(p):
-                    # TODO: use walk to traverse the patient folder and gather all the studies. Up to 3 levels!
-                    new_folder_name = 'Anonymized_{:04d}'.format(new_id)
-                    files_in_path = [f for f in os.listdir(p) if f.endswith('.dcm')]
-                    if len(files_in_path):
-                        os.makedirs(os.path.join(output_folder, new_folder_name), exist_ok=True)
-                        files_in_path.sort()
-                        for i, f in enumerate(files_in_path):
-                            new_f = os.path.join(output_folder, new_folder_name, 'Image_{:04d}.dcm'.format(i))
-                            paths_to_process.append((os.path.join(p, f), new_f))
-                elif os.path.isfile(p):
-                    folder_path, file_name = os.path.split(p)
-                    new_folder_path = os.path.join(output_folder, 'Anonymized_{:04d}'.format(new_id))
-                    os.makedirs(new_folder_path, exist_ok=True)
-                    paths_to_process.append((p, os.path.join(new_folder_path, 'Image_{:04d}'.format(new_id) + '.dcm')))
-                new_id += 1
+        check_preamble = self.__options_widget.cb_check_preamble.isChecked()
 
         tags = self.__options_widget.line_tag_actions.text()
         tags = tags.split(';') if tags != '' else list()     # Empty list
         tags.remove('')
         tags = list(zip(*(iter(tags),) * 2))  # TODO: improve tag actions GUI [["tags", action], ["tags", action], ...]
         anonymization_rules = self.__get_anonymization_rules(tags, self.__options_widget.dict_file_widget.text_box.text())
+        anonymizer = Anonymizer(anonymization_rules, not self.__options_widget.cb_keep_private_tags.isChecked())
+
+        uid_map_path = self.__options_widget.uid_map_widget.text_box.text()
+        uid_map_path = uid_map_path if uid_map_path != '' else None
+
+        manifest = None
+        manifest_path = self.__options_widget.manifest_widget.text_box.text()
+        if manifest_path != '':
+            manifest = RunManifest(manifest_path, anonymizer.fingerprint)
 
         self.setDisabled(True)
-        progress_increment = 100 / len(paths_to_process)
-        dialog_progress = QProgressDialog('Processing files', 'Cancel', 0, 100)
-        dialog_progress.setWindowModality(Qt.WindowModal)
-
-        for i, (in_file, out_file) in enumerate(paths_to_process):
-            self.run_anonymization(in_file, out_file,
-                                   not self.__options_widget.cb_keep_private_tags.isChecked(),
-                                   anonymization_rules)
-            dialog_progress.setValue(progress_increment * i)
-            if dialog_progress.wasCanceled():
-                break
-        dialog_progress.setValue(100)
-        dialog_progress.close()
+        self.__run_worker = RunWorker(anonymizer, selected_data, output_folder, check_preamble, self.__workers,
+                                      uid_map_path, manifest)
+        self.__run_output_folder = output_folder
+        # Busy indicator until the files are found
+        self.__dialog_progress = QProgressDialog('Looking for DICOM files', 'Cancel', 0, 0)
+        self.__dialog_progress.setWindowModality(Qt.WindowModal)
+        self.__dialog_progress.setMinimumDuration(0)
+        self.__dialog_progress.canceled.connect(self.__run_worker.cancel)
+        self.__run_worker.signals.discovered.connect(self.__slot_run_discovered)
+        self.__run_worker.signals.progress.connect(self.__slot_run_progress)
+        self.__run_worker.signals.error.connect(self.__slot_run_error)
+        self.__run_worker.signals.finished.connect(self.__slot_run_finished)
+        self.__dialog_progress.show()
+        QThreadPool.globalInstance().start(self.__run_worker)
+
+    def __slot_run_discovered(self, total: int):
+        self.__dialog_progress.setMaximum(max(total, 1))
+        self.__dialog_progress.setLabelText('Processing {} files'.format(total))
+
+    def __slot_run_progress(self, done: int, rate: float, eta: float):
+        total = len(self.__run_worker.paths)
+        self.__dialog_progress.setValue(done)
+        eta_text = str(timedelta(seconds=int(eta))) if eta >= 0 else '--:--:--'
+        self.__dialog_progress.setLabelText('Processed {}/{} files ({:.1f} files/s), time left: {}'.format(done, total, rate, eta_text))
+
+    def __slot_run_error(self, message: str):
+        QMessageBox.critical(None, 'Anonymization error', message)
+
+    def __slot_run_finished(self, completed: bool):
+        self.__dialog_progress.close()
+
+        summary = '' if completed else '\nThe run was cancelled, the last files may be incomplete.'
+        manifest = self.__run_worker.manifest
+        if manifest is not None:
+            manifest.close()
+            summary += '\n{} files skipped, {} files failed (see {})'.format(manifest.skipped, manifest.failed, manifest.path)
+        output_folder = self.__run_output_folder
+        self.__run_worker = None
 
         info_dialog = QMessageBox()
         button_open_out_dir = QPushButton('Open output folder')
-        info_dialog.setText('Output can be found in: '+output_folder)
+        info_dialog.setText('Output can be found in: '+output_folder+summary)
         info_dialog.setStandardButtons(QMessageBox.Ok)
         info_dialog.addButton(button_open_out_dir, QMessageBox.NoRole)
         info_dialog.setIcon(QMessageBox.Information)
@@ -478,7 +762,7 @@ class AnonymizerGUI:
                             "replace": current_tag_parameters[3]
                         }
 
-                    tags_list = [ast.literal_eval(current_tag_parameters[0])]
+                    tags_list = [parse_tag(current_tag_parameters[0])]
 
                     action = actions_map_name_functions[action_name]
                     # When generate_actions is called and we have options, we don't want use regexp
@@ -489,30 +773,12 @@ class AnonymizerGUI:
                     if cpt == 0:
                         new_anonymization_rules = generate_actions(tags_list, action, options)
                     else:
-                        new_anonymization_rules.update(generate_actions(tags_list, action, options))
+                        merge_actions(new_anonymization_rules, generate_actions(tags_list, action, options))
                     cpt += 1
 
-        # Read an existing dictionary
+        # Read an existing dictionary, or its compiled ruleset
         if dictionary_file:
-            with open(dictionary_file) as json_file:
-                data = json.load(json_file)
-                for key, value in data.items():
-                    action_name = value
-                    options = None
-                    if type(value) is dict:
-                        action_name = value['action']
-                        options = {
-                            "find": value['find'],
-                            "replace": value['replace']
-                        }
-
-                    l = [ast.literal_eval(key)]
-                    action = eval(action_name)
-                    if cpt == 0:
-                        new_anonymization_rules = generate_actions(l, action, options)
-                    else:
-                        new_anonymization_rules.update(generate_actions(l, action, options))
-                    cpt += 1
+            merge_actions(new_anonymization_rules, load_ruleset(dictionary_file))
 
         return new_anonymization_rules
 
@@ -532,18 +798,30 @@ class AnonymizerGUI:
         self.__options_widget.output_folder.setEnabled(arg__1)
 
 
-def main():
-    app = QApplication([])      # THIS MUST BE THE FIRST INSTRUCTION!!!!
+def main(splash: QSplashScreen = None):
+    """
+    :param splash: Splash screen shown while the application was loading, closed once the window is shown
+    """
+    # The application is created first, unless the splash screen already did
+    app = QApplication.instance() or QApplication([])
     app.setWindowIcon(QIcon(os.path.join(ROOT_PATH, 'images', 'app_icon_128.png')))
     window = QWidget()
 
-    gui = AnonymizerGUI()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uid-map', action='store', dest='uid_map', help='SQLite file which stores the replaced UIDs')
+    parser.add_argument('--manifest', action='store', dest='manifest', help='SQLite file which records the processed files')
+    parser.add_argument('--workers', action='store', type=int, dest='workers', help='Number of worker processes (default: number of CPUs)')
+    args, _ = parser.parse_known_args(app.arguments()[1:])
+
+    gui = AnonymizerGUI(uid_map_path=args.uid_map, manifest_path=args.manifest, workers=args.workers)
 
     # Applicaton setup
     window.setWindowTitle('DICOM Anonymizer')
     window.setGeometry(300, 300, 800, 400)
     window.setLayout(gui.layout)
     window.show()
+    if splash is not None:
+        splash.finish(window)
     sys.exit(app.exec_())
 
 
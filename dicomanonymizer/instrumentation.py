@@ -0,0 +1,219 @@
+"""
+Optional instrumentation of the anonymization: time spent in each stage (discovery, read, rules,
+private tags, write) and in each rule, with the number of elements each rule applied to.
+
+Disabled by default. Enable it with set_instrumentation(Instrumentation()), run the anonymization,
+then get the totals with report(), to_json() or to_prometheus().
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from typing import Iterable, Iterator
+
+# Stages of the anonymization of a file
+DISCOVERY = 'discovery'
+READ = 'read'
+RULES = 'rules'
+PRIVATE_TAGS = 'private_tags'
+WRITE = 'write'
+
+# Instrumentation of the current process, None when disabled
+_instrumentation = None
+
+
+def set_instrumentation(instrumentation):
+    """
+    Replace the instrumentation of the current process, None disables it
+
+    :return The previous instrumentation
+    """
+    global _instrumentation
+    previous_instrumentation = _instrumentation
+    _instrumentation = instrumentation
+    return previous_instrumentation
+
+
+def get_instrumentation():
+    """
+    Instrumentation of the current process, None when disabled
+    """
+    return _instrumentation
+
+
+@contextmanager
+def _no_stage():
+    yield
+
+
+def stage(name: str):
+    """
+    Context manager timing a stage with the current instrumentation, if any
+    """
+    if _instrumentation is None:
+        return _no_stage()
+    return _instrumentation.stage(name)
+
+
+def timed_iter(iterable: Iterable, name: str) -> Iterator:
+    """
+    Yield the items of iterable, the time spent getting each of them is added to the stage name
+    """
+    iterator = iter(iterable)
+    while True:
+        instrumentation = _instrumentation
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        if instrumentation is not None:
+            instrumentation.add_stage(name, time.perf_counter() - start)
+        yield item
+
+
+def tag_label(tag) -> str:
+    """
+    Tag of a rule as '(gggg,eeee)', masked digits of repeating group rules are shown as 'x'
+    """
+    if len(tag) == 2:
+        return '({:04X},{:04X})'.format(*tag)
+    group, element, group_mask, element_mask = tag
+
+    def digits(value, mask):
+        return ''.join(digit if (mask >> shift) & 0xF else 'x'
+                       for digit, shift in zip('{:04X}'.format(value), (12, 8, 4, 0)))
+
+    return '({},{})'.format(digits(group, group_mask), digits(element, element_mask))
+
+
+def action_label(action) -> str:
+    """
+    Name of the function of an action, e.g. 'replace' or 'regexp'
+    """
+    while isinstance(action, partial):
+        action = action.func
+    return getattr(action, '__name__', type(action).__name__)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Instrumentation:
+    """
+    Totals of the time spent per stage and per rule, shared by the threads of the process
+
+    Worker processes have their own instrumentation, their reports are added to the one of the
+    main process with merge.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # stage -> [calls, seconds, max seconds]
+        self._stages = {}
+        # (tag label, action label) -> [hits, seconds]
+        self._rules = {}
+        # (tag, action) -> (tag label, action label)
+        self._labels = {}
+
+    def add_stage(self, name: str, seconds: float, calls: int = 1) -> None:
+        with self._lock:
+            totals = self._stages.get(name)
+            if totals is None:
+                self._stages[name] = [calls, seconds, seconds]
+            else:
+                totals[0] += calls
+                totals[1] += seconds
+                totals[2] = max(totals[2], seconds)
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Context manager adding the time spent in its block to the stage name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_rule(self, tag, action, hits: int, seconds: float) -> None:
+        """
+        Add the application of a rule to a dataset
+
+        :param tag: Tag of the rule, (group, element) or (group, element, group mask, element mask)
+        :param action: Action of the rule
+        :param hits: Number of elements the action was applied to
+        :param seconds: Time spent applying the rule
+        """
+        labels = self._labels.get((tag, action))
+        if labels is None:
+            labels = self._labels.setdefault((tag, action), (tag_label(tag), action_label(action)))
+        with self._lock:
+            totals = self._rules.get(labels)
+            if totals is None:
+                self._rules[labels] = [hits, seconds]
+            else:
+                totals[0] += hits
+                totals[1] += seconds
+
+    def merge(self, report: dict) -> None:
+        """
+        Add the totals of a report, e.g. from a worker process
+        """
+        with self._lock:
+            for name, totals in report['stages'].items():
+                current = self._stages.setdefault(name, [0, 0., 0.])
+                current[0] += totals['calls']
+                current[1] += totals['seconds']
+                current[2] = max(current[2], totals['max_seconds'])
+            for rule in report['rules']:
+                current = self._rules.setdefault((rule['tag'], rule['action']), [0, 0.])
+                current[0] += rule['hits']
+                current[1] += rule['seconds']
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stages.clear()
+            self._rules.clear()
+
+    def report(self) -> dict:
+        """
+        Totals as a dictionary, rules sorted from the slowest
+        """
+        with self._lock:
+            stages = {name: {'calls': calls, 'seconds': seconds, 'max_seconds': max_seconds}
+                      for name, (calls, seconds, max_seconds) in self._stages.items()}
+            rules = [{'tag': tag, 'action': action, 'hits': hits, 'seconds': seconds}
+                     for (tag, action), (hits, seconds) in self._rules.items()]
+        rules.sort(key=lambda rule: rule['seconds'], reverse=True)
+        return {'stages': stages, 'rules': rules}
+
+    def to_json(self, indent: int = 2) -> str:
+        return json.dumps(self.report(), indent=indent)
+
+    def to_prometheus(self, prefix: str = 'dicomanonymizer') -> str:
+        """
+        Totals in the Prometheus text exposition format
+        """
+        report = self.report()
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} counter'.format(prefix, name))
+            for labels, value in samples:
+                lines.append('{}_{}{{{}}} {}'.format(prefix, name, ','.join(
+                    '{}="{}"'.format(key, _escape_label(label)) for key, label in labels), repr(value)))
+
+        metric('stage_calls_total', 'Number of times each stage ran.',
+               [((('stage', name),), totals['calls']) for name, totals in sorted(report['stages'].items())])
+        metric('stage_seconds_total', 'Time spent in each stage.',
+               [((('stage', name),), totals['seconds']) for name, totals in sorted(report['stages'].items())])
+        metric('rule_hits_total', 'Number of elements each rule was applied to.',
+               [((('tag', rule['tag']), ('action', rule['action'])), rule['hits']) for rule in report['rules']])
+        metric('rule_seconds_total', 'Time spent applying each rule.',
+               [((('tag', rule['tag']), ('action', rule['action'])), rule['seconds']) for rule in report['rules']])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,183 @@
+"""
+Run manifest: a SQLite journal of the files of a batch run, used to resume it.
+
+Each input file is recorded with its size, modification time, content hash, the fingerprint
+of the rules it was anonymized with and its status. A run using the same manifest again
+skips the files already done with the same rules to the same output, and processes the new,
+changed, failed and pending (interrupted) ones.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator, Tuple
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path: str, chunk_size: int = HASH_CHUNK_SIZE) -> str:
+    """
+    SHA-256 of the content of a file, read in chunks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def anonymize_and_describe(anonymizer, in_file: str, out_file: str, file_options: dict = None) -> tuple:
+    """
+    Anonymize one file and describe its input for RunManifest.record
+
+    Errors are returned instead of raised, so that the run goes on with the other files.
+
+    :param anonymizer: engine.Anonymizer applied to the file
+    :param in_file: File to anonymize
+    :param out_file: Anonymized file
+    :param file_options: Keyword arguments of Anonymizer.anonymize_dicom_file
+    :return: (in_file, out_file, size, mtime_ns, content_hash, error)
+    """
+    try:
+        stat = os.stat(in_file)
+        content_hash = file_digest(in_file)
+        anonymizer.anonymize_dicom_file(in_file, out_file, **(file_options or {}))
+    except Exception as e:
+        return in_file, out_file, None, None, None, '{}: {}'.format(type(e).__name__, e)
+    return in_file, out_file, stat.st_size, stat.st_mtime_ns, content_hash, None
+
+
+class RunManifest:
+    """
+    Journal of the files of a batch run, stored in a SQLite file
+
+    The same manifest can be shared by several threads of the process running the batch.
+
+    :param path: Path to the SQLite file, created if it does not exist
+    :param ruleset_hash: Fingerprint of the rules of the run, see engine.Anonymizer.fingerprint
+    :param commit_every: Number of records written before a commit
+    :param uid_map: UID map of the run, e.g. uidmap.SQLiteUIDMap, flushed before each commit so that a file is never
+    recorded as done while the UIDs it was given are not on disk
+    """
+
+    def __init__(self, path: str, ruleset_hash: str, commit_every: int = 100, uid_map=None):
+        self.path = path
+        self.ruleset_hash = ruleset_hash
+        self.commit_every = commit_every
+        self.uid_map = uid_map
+
+        # Counters of the current run
+        self.skipped = 0
+        self.failed = 0
+
+        self._pending = 0
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS files '
+                                 '(input_path TEXT PRIMARY KEY, output_path TEXT, size INTEGER, mtime_ns INTEGER, '
+                                 'content_hash TEXT, ruleset_hash TEXT, status TEXT NOT NULL, error TEXT, '
+                                 'updated REAL) WITHOUT ROWID')
+        self._connection.commit()
+
+    def _write(self, in_file: str, out_file: str, status: str, size: int = None, mtime_ns: int = None,
+               content_hash: str = None, error: str = None) -> None:
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                     (os.path.abspath(in_file), os.path.abspath(out_file), size, mtime_ns,
+                                      content_hash, self.ruleset_hash, status, error, time.time()))
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self.flush()
+
+    def is_done(self, in_file: str, out_file: str = None) -> bool:
+        """
+        Whether the file was anonymized with the same rules, is unchanged and its output still exists
+
+        A file whose modification time changed but not its content is still done.
+
+        :param in_file: Input file
+        :param out_file: Output file of the current run, the file is not done if it was written elsewhere
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT output_path, size, mtime_ns, content_hash, ruleset_hash, status '
+                                           'FROM files WHERE input_path = ?', (os.path.abspath(in_file),)).fetchone()
+        if row is None:
+            return False
+        output_path, size, mtime_ns, content_hash, ruleset_hash, status = row
+        if status != DONE or ruleset_hash != self.ruleset_hash or not os.path.exists(output_path):
+            return False
+        if out_file is not None and os.path.normcase(os.path.abspath(out_file)) != os.path.normcase(output_path):
+            return False
+
+        try:
+            stat = os.stat(in_file)
+        except OSError:
+            return False
+        if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+            return True
+        if stat.st_size != size or file_digest(in_file) != content_hash:
+            return False
+
+        with self._lock:
+            self._connection.execute('UPDATE files SET mtime_ns = ? WHERE input_path = ?',
+                                     (stat.st_mtime_ns, os.path.abspath(in_file)))
+        return True
+
+    def pending(self, paths: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str]]:
+        """
+        Yield the (input file, output file) which are not done, and record them as pending
+
+        :param paths: (input file, output file) of the run
+        """
+        for in_file, out_file in paths:
+            if self.is_done(in_file, out_file):
+                self.skipped += 1
+                continue
+            self._write(in_file, out_file, PENDING)
+            yield in_file, out_file
+
+    def record(self, result: tuple) -> None:
+        """
+        Record the result of anonymize_and_describe, as done or failed
+        """
+        in_file, out_file, size, mtime_ns, content_hash, error = result
+        if error is None:
+            self._write(in_file, out_file, DONE, size, mtime_ns, content_hash)
+        else:
+            self.failed += 1
+            self._write(in_file, out_file, FAILED, error=error)
+
+    def counts(self) -> dict:
+        """
+        Number of files of the manifest by status
+        """
+        with self._lock:
+            return dict(self._connection.execute('SELECT status, COUNT(*) FROM files GROUP BY status').fetchall())
+
+    def flush(self) -> None:
+        """
+        Commit the pending records to disk, after the UID map
+        """
+        with self._lock:
+            if self.uid_map is not None:
+                self.uid_map.flush()
+            self._connection.commit()
+            self._pending = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
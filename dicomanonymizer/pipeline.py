@@ -0,0 +1,243 @@
+"""
+Pipelined anonymization: files are read, anonymized and written by separate stages so that the
+I/O latency of slow storage (network or object store mounts) is hidden behind the processing.
+
+Reader threads prefetch the next files, the calling thread anonymizes them and writer threads
+write the results. The stages are connected by bounded queues, and the total size of the files
+in flight is bounded too, so that memory use does not depend on the number of files.
+"""
+import os
+import queue
+import threading
+from typing import Iterable, Tuple
+
+DEFAULT_QUEUE_DEPTH = 8
+DEFAULT_MAX_IN_FLIGHT_BYTES = 256 * 1024 * 1024
+
+# Seconds between two checks for a stop (error or cancellation) of the blocked stages
+STOP_POLL_INTERVAL = 0.1
+
+# End of the files of a stage
+_END = object()
+
+
+class _Task:
+    """
+    A file going through the pipeline
+    """
+    __slots__ = ('in_file', 'out_file', 'size', 'stat', 'content_hash', 'dataset', 'tail', 'error')
+
+    def __init__(self, in_file: str, out_file: str, size: int):
+        self.in_file = in_file
+        self.out_file = out_file
+        self.size = size
+        self.stat = None
+        self.content_hash = None
+        self.dataset = None
+        self.tail = None
+        self.error = None
+
+
+class _ByteBudget:
+    """
+    Bound of the total size of the files in flight
+
+    A file larger than the whole budget is let through when nothing else is in flight.
+    """
+
+    def __init__(self, max_bytes: int, stop: threading.Event):
+        self._max_bytes = max_bytes
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._stop = stop
+
+    def acquire(self, size: int) -> bool:
+        """
+        Wait until size bytes fit in the budget, return False if the pipeline is stopped meanwhile
+        """
+        with self._condition:
+            while self._in_flight and self._in_flight + size > self._max_bytes:
+                if self._stop.is_set():
+                    return False
+                self._condition.wait(STOP_POLL_INTERVAL)
+            self._in_flight += size
+            return True
+
+    def release(self, size: int) -> None:
+        with self._condition:
+            self._in_flight -= size
+            self._condition.notify_all()
+
+
+def _put(task_queue: queue.Queue, item, stop: threading.Event) -> bool:
+    """
+    Put an item in a bounded queue, return False if the pipeline is stopped meanwhile
+    """
+    while True:
+        try:
+            task_queue.put(item, timeout=STOP_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            if stop.is_set():
+                return False
+
+
+def _get(task_queue: queue.Queue, stop: threading.Event):
+    """
+    Get an item from a queue, return _END if the pipeline is stopped meanwhile
+    """
+    while True:
+        try:
+            return task_queue.get(timeout=STOP_POLL_INTERVAL)
+        except queue.Empty:
+            if stop.is_set():
+                return _END
+
+
+def _describe(task: _Task) -> tuple:
+    """
+    Result of the task, in the format of manifest.anonymize_and_describe
+    """
+    if task.error is not None:
+        return task.in_file, task.out_file, None, None, None, '{}: {}'.format(type(task.error).__name__, task.error)
+    return task.in_file, task.out_file, task.stat.st_size, task.stat.st_mtime_ns, task.content_hash, None
+
+
+def anonymize_pipelined(anonymizer, paths: Iterable[Tuple[str, str]], readers: int = 2, writers: int = 1,
+                        queue_depth: int = DEFAULT_QUEUE_DEPTH, max_in_flight_bytes: int = DEFAULT_MAX_IN_FLIGHT_BYTES,
+                        progress_bar=None, file_options: dict = None, on_result=None,
+                        cancel_event: threading.Event = None) -> bool:
+    """
+    Anonymize files with reader and writer threads around the anonymization in the current thread
+
+    :param anonymizer: engine.Anonymizer applied to the files
+    :param paths: Iterable of (input file, output file), consumed as the readers progress
+    :param readers: Number of threads reading the next files
+    :param writers: Number of threads writing the anonymized files
+    :param queue_depth: Number of files waiting between two stages
+    :param max_in_flight_bytes: Bound of the total size of the input files read and not yet written
+    :param progress_bar: tqdm progress bar updated as files are written
+    :param file_options: Keyword arguments of Anonymizer.anonymize_dicom_file, e.g. defer_size
+    :param on_result: If set, errors do not stop the run and this function receives the result of each
+    file, in the format of manifest.anonymize_and_describe
+    :param cancel_event: When set, e.g. from another thread, the run stops within STOP_POLL_INTERVAL
+    seconds after the files being written
+    :return: True if all the files were processed, False if the run was cancelled
+    """
+    if on_result is not None:
+        from .manifest import file_digest
+
+    file_options = file_options or {}
+    defer_size = file_options.get('defer_size')
+    splice = file_options.get('splice', False)
+    describe = on_result is not None
+
+    stop = threading.Event()
+    budget = _ByteBudget(max_in_flight_bytes, stop)
+    read_queue = queue.Queue(queue_depth)
+    write_queue = queue.Queue(queue_depth)
+    paths_iterator = iter(paths)
+    paths_lock = threading.Lock()
+    results_lock = threading.Lock()
+    # First error raised by a stage when the errors stop the run
+    errors = []
+
+    def fail(error):
+        with results_lock:
+            errors.append(error)
+        stop.set()
+
+    def read():
+        try:
+            while not stop.is_set():
+                with paths_lock:
+                    in_file, out_file = next(paths_iterator, (None, None))
+                if in_file is None:
+                    break
+                try:
+                    size = os.path.getsize(in_file)
+                except OSError:
+                    size = 0
+                if not budget.acquire(size):
+                    break
+                task = _Task(in_file, out_file, size)
+                try:
+                    if describe:
+                        task.stat = os.stat(in_file)
+                        task.content_hash = file_digest(in_file)
+                    task.dataset, task.tail = anonymizer.read_dicom_file(in_file, defer_size, splice)
+                except Exception as e:
+                    if not describe:
+                        raise
+                    task.error = e
+                if not _put(read_queue, task, stop):
+                    break
+        except BaseException as e:
+            fail(e)
+        finally:
+            _put(read_queue, _END, stop)
+
+    def write():
+        try:
+            while not stop.is_set():
+                task = _get(write_queue, stop)
+                if task is _END:
+                    break
+                try:
+                    if task.error is None:
+                        anonymizer.write_dicom_file(task.dataset, task.out_file, task.tail)
+                except Exception as e:
+                    if not describe:
+                        raise
+                    task.error = e
+                finally:
+                    task.dataset = None
+                    budget.release(task.size)
+                with results_lock:
+                    if on_result is not None:
+                        on_result(_describe(task))
+                    if progress_bar is not None:
+                        progress_bar.update(1)
+        except BaseException as e:
+            fail(e)
+
+    threads = [threading.Thread(target=read, name='anonymizer-reader-{}'.format(i), daemon=True)
+               for i in range(readers)]
+    threads += [threading.Thread(target=write, name='anonymizer-writer-{}'.format(i), daemon=True)
+                for i in range(writers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        remaining_readers = readers
+        while remaining_readers and not stop.is_set():
+            if cancel_event is not None and cancel_event.is_set():
+                stop.set()
+                break
+            try:
+                task = read_queue.get(timeout=STOP_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if task is _END:
+                remaining_readers -= 1
+                continue
+            if task.error is None:
+                try:
+                    anonymizer.anonymize_dataset(task.dataset)
+                except Exception as e:
+                    if not describe:
+                        raise
+                    task.error = e
+            if not _put(write_queue, task, stop):
+                break
+    except BaseException as e:
+        fail(e)
+    finally:
+        for _ in range(writers):
+            _put(write_queue, _END, stop)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return not stop.is_set()
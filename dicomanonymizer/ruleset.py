@@ -0,0 +1,204 @@
+"""
+Compiled rulesets: the JSON dictionaries given to --dictionary, validated once and cached.
+
+A dictionary maps tags, written as "(0x0010, 0x0010)" or "(0x5000, 0x0000, 0xFF00, 0x0000)" for
+repeating groups, to action names or to {"action": "regexp", "find": ..., "replace": ...}. Its
+compiled form lists the merged rules as [tag, action name, options], so that loading it only
+resolves names: no tag or action is evaluated.
+
+Compiled rulesets are cached by content hash of the dictionary. They can also be written next
+to the dictionary with: python -m dicomanonymizer compile-rules rules.json -o rules.ruleset.json
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+
+from .simpledicomanonymizer import actions_map_name_functions, generate_actions, is_regexp, \
+    merge_actions
+
+logger = logging.getLogger(__name__)
+
+RULESET_FORMAT = 'dicomanonymizer-ruleset'
+# Changed when the compiled form changes, so that previous cache entries are not used
+RULESET_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                 'dicomanonymizer', 'rulesets')
+
+
+def parse_tag(text: str) -> tuple:
+    """
+    Parse a tag written as a tuple of integers, e.g. "(0x0010, 0x0010)"
+
+    :param text: Tuple of 2 integers (group, element) or 4 integers (group, element, group mask, element mask)
+    :return Tuple of integers
+    """
+    stripped = text.strip()
+    if len(stripped) < 2 or stripped[0] != '(' or stripped[-1] != ')':
+        raise ValueError('Invalid tag {!r}: expected "(group, element)"'.format(text))
+    try:
+        tag = tuple(int(value, 0) for value in stripped[1:-1].split(','))
+    except ValueError:
+        raise ValueError('Invalid tag {!r}: expected integers such as 0x0010'.format(text)) from None
+    if len(tag) not in (2, 4) or not all(0 <= value <= 0xFFFF for value in tag):
+        raise ValueError('Invalid tag {!r}: expected 2 or 4 values between 0 and 0xFFFF'.format(text))
+    return tag
+
+
+def resolve_action(action_name: str, defined_action_map: dict = {}):
+    """
+    Action function of a name, looked up in defined_action_map then in the pre-defined actions
+
+    :param action_name: Name of the action, e.g. "keep"
+    :param defined_action_map: link action name to action function
+    """
+    if action_name in defined_action_map:
+        return defined_action_map[action_name]
+    if action_name in actions_map_name_functions:
+        return actions_map_name_functions[action_name]
+    raise ValueError('Unknown action {!r}, expected one of: {}'.format(
+        action_name, ', '.join(sorted(set(actions_map_name_functions) | set(defined_action_map)))))
+
+
+def compile_ruleset(data: dict, defined_action_map: dict = {}) -> dict:
+    """
+    Validate the entries of a JSON dictionary and merge them into the compiled ruleset
+
+    :param data: Content of the JSON dictionary
+    :param defined_action_map: link action name to action function
+    :return Compiled ruleset, see load_compiled_ruleset
+    """
+    if not isinstance(data, dict):
+        raise ValueError('A dictionary maps tags to actions, got {}'.format(type(data).__name__))
+
+    actions = {}
+    names = {}
+    for key, value in data.items():
+        options = None
+        action_name = value
+        if isinstance(value, dict):
+            action_name = value.get('action')
+            if action_name != 'regexp':
+                raise ValueError('{}: only the regexp action takes options, got {!r}'.format(key, action_name))
+            if not isinstance(value.get('find'), str) or not isinstance(value.get('replace'), str):
+                raise ValueError('{}: the regexp action needs "find" and "replace" strings'.format(key))
+            options = {
+                "find": value['find'],
+                "replace": value['replace']
+            }
+        elif not isinstance(value, str):
+            raise ValueError('{}: expected an action name, got {!r}'.format(key, value))
+        elif value == 'regexp':
+            raise ValueError('{}: the regexp action needs "find" and "replace" strings'.format(key))
+
+        action = resolve_action(action_name, defined_action_map)
+        names[action] = action_name
+        try:
+            merge_actions(actions, generate_actions([parse_tag(key)], action, options))
+        except re.error as e:
+            raise ValueError('{}: invalid regexp: {}'.format(key, e)) from None
+
+    rules = []
+    for tag, action in actions.items():
+        if is_regexp(action):
+            rules.append([list(tag), 'regexp', action.args[0]])
+        else:
+            rules.append([list(tag), names[action], None])
+    return {'format': RULESET_FORMAT, 'version': RULESET_VERSION, 'rules': rules}
+
+
+def load_compiled_ruleset(ruleset: dict, defined_action_map: dict = {}) -> dict:
+    """
+    Actions of a compiled ruleset
+
+    :param ruleset: Compiled ruleset, as returned by compile_ruleset
+    :param defined_action_map: link action name to action function
+    :return Dictionary which maps actions functions to tags
+    """
+    if ruleset.get('format') != RULESET_FORMAT or ruleset.get('version') != RULESET_VERSION:
+        raise ValueError('Not a compiled ruleset of version {}'.format(RULESET_VERSION))
+    actions = {}
+    for tag, action_name, options in ruleset['rules']:
+        action = resolve_action(action_name, defined_action_map)
+        actions[tuple(tag)] = action if options is None else action(options)
+    return actions
+
+
+def _read_cached(cache_path: str):
+    try:
+        with open(cache_path, encoding='utf-8') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cached(cache_path: str, ruleset: dict) -> None:
+    """
+    Write a compiled ruleset atomically, concurrent runs may compile the same dictionary
+    """
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+        with os.fdopen(file_descriptor, 'w', encoding='utf-8') as cache_file:
+            json.dump(ruleset, cache_file, separators=(',', ':'))
+        os.replace(temporary_path, cache_path)
+    except OSError:
+        logger.debug('Cannot cache the compiled ruleset in %s', cache_path, exc_info=True)
+
+
+def load_ruleset(path: str, defined_action_map: dict = {}, cache_dir: str = DEFAULT_CACHE_DIR) -> dict:
+    """
+    Read the actions of a JSON dictionary, or of a compiled ruleset written by compile-rules
+
+    A dictionary is compiled on its first use, later uses with the same content load the cached ruleset.
+
+    :param path: JSON dictionary or compiled ruleset
+    :param defined_action_map: link action name to action function
+    :param cache_dir: Folder of the compiled rulesets, None to compile the dictionary each time
+    :return Dictionary which maps actions functions to tags
+    """
+    with open(path, 'rb') as json_file:
+        content = json_file.read()
+
+    cache_path = None
+    if cache_dir is not None:
+        content_hash = hashlib.sha256(content).hexdigest()
+        cache_path = os.path.join(cache_dir, '{}-v{}.json'.format(content_hash, RULESET_VERSION))
+        ruleset = _read_cached(cache_path)
+        if ruleset is not None:
+            return load_compiled_ruleset(ruleset, defined_action_map)
+
+    data = json.loads(content.decode('utf-8'))
+    if isinstance(data, dict) and data.get('format') == RULESET_FORMAT:
+        return load_compiled_ruleset(data, defined_action_map)
+
+    ruleset = compile_ruleset(data, defined_action_map)
+    if cache_path is not None:
+        _write_cached(cache_path, ruleset)
+    return load_compiled_ruleset(ruleset, defined_action_map)
+
+
+def main(argv: list = None, defined_action_map: dict = {}):
+    parser = argparse.ArgumentParser(prog='python -m dicomanonymizer compile-rules', add_help=True,
+                                     description='Validate a JSON dictionary and write its compiled ruleset, which '
+                                     'can be given to --dictionary instead')
+    parser.add_argument('dictionary', help='JSON dictionary mapping tags to actions')
+    parser.add_argument('-o', '--output', action='store', help='Compiled ruleset (default: the dictionary with the '
+                        '.ruleset.json extension)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    output_path = args.output or os.path.splitext(args.dictionary)[0] + '.ruleset.json'
+    with open(args.dictionary, encoding='utf-8') as json_file:
+        data = json.load(json_file)
+    try:
+        ruleset = compile_ruleset(data, defined_action_map)
+    except ValueError as e:
+        parser.exit(1, 'error: {}\n'.format(e))
+    with open(output_path, 'w', encoding='utf-8') as ruleset_file:
+        json.dump(ruleset, ruleset_file, separators=(',', ':'))
+    logger.info('%d rules written to %s', len(ruleset['rules']), output_path)
@@ -0,0 +1,332 @@
+"""
+Read-only inventory of the tags of a tree of DICOM files, to write a ruleset before anonymizing.
+
+Only the headers are read: each file is read up to its Pixel Data, large values are skipped, and
+the elements after the Pixel Data are listed without reading their values. Each tag found is counted
+(files and occurrences, nested sequences included) with the VRs seen and the rule applying to it.
+Private elements are counted per private creator, and elements matching a repeating group rule
+(e.g. (50xx,xxxx)) are counted per rule.
+
+Start it with: python -m dicomanonymizer scan INPUT --output inventory.csv
+"""
+import argparse
+import csv
+import logging
+import os
+
+from pydicom.datadict import dictionary_VR, dictionary_has_tag, keyword_for_tag
+
+from .anonymizer import _chunks, read_actions_dictionary
+from .dicomio import iter_raw_elements, is_sequence, read_header
+from .discovery import iter_files
+from .engine import Anonymizer
+from .instrumentation import action_label, tag_label
+from .simpledicomanonymizer import PrivateCreatorIndex, _PRIVATE_CREATOR_FIRST, _PRIVATE_CREATOR_LAST
+
+logger = logging.getLogger(__name__)
+
+# Values larger than this size in bytes are not read, only their tag and VR are needed
+SCAN_DEFER_SIZE = 1024
+
+# Kinds of the rows of the inventory, in the order of the report
+TAG = 'tag'
+REPEATING_GROUP = 'repeating_group'
+PRIVATE_CREATOR = 'private_creator'
+PRIVATE = 'private'
+_KINDS = (TAG, REPEATING_GROUP, PRIVATE_CREATOR, PRIVATE)
+
+REPORT_COLUMNS = ('kind', 'tag', 'keyword', 'private_creator', 'action', 'files', 'occurrences', 'vrs')
+REPORT_FORMATS = ('csv', 'parquet')
+
+# Rules of the scan of the current worker process, set once by _init_worker
+_worker_anonymizer = None
+
+
+class Inventory:
+    """
+    Counts of the tags found in the scanned files, merged across worker processes
+
+    Entries are keyed by (TAG, tag), (REPEATING_GROUP, rule tag), (PRIVATE_CREATOR, group, creator) or
+    (PRIVATE, group, creator, element offset in the block).
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.failed = 0
+        # key -> [files, occurrences, set of VRs]
+        self._entries = {}
+        # Rule tag -> action label, for the rows of the report
+        self._actions = {}
+
+    def add_file(self, counts: dict, actions: dict) -> None:
+        """
+        Add the counts of one file
+
+        :param counts: key -> [occurrences, set of VRs] of the file
+        :param actions: key -> action label of the rules applying to the keys
+        """
+        self.files += 1
+        for key, (occurrences, vrs) in counts.items():
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = [1, occurrences, set(vrs)]
+            else:
+                entry[0] += 1
+                entry[1] += occurrences
+                entry[2].update(vrs)
+        self._actions.update(actions)
+
+    def merge(self, other: 'Inventory') -> None:
+        """
+        Add the counts of another inventory, e.g. of a worker process
+        """
+        self.files += other.files
+        self.failed += other.failed
+        for key, (files, occurrences, vrs) in other._entries.items():
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = [files, occurrences, set(vrs)]
+            else:
+                entry[0] += files
+                entry[1] += occurrences
+                entry[2].update(vrs)
+        self._actions.update(other._actions)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def rows(self) -> list:
+        """
+        Rows of the report, with the REPORT_COLUMNS keys, sorted by kind then tag
+        """
+        rows = []
+        for key in sorted(self._entries, key=lambda key: (_KINDS.index(key[0]), key[1:])):
+            files, occurrences, vrs = self._entries[key]
+            kind = key[0]
+            creator = ''
+            keyword = ''
+            if kind == TAG:
+                tag = (key[1] >> 16, key[1] & 0xFFFF)
+                label = tag_label(tag)
+                keyword = keyword_for_tag(key[1])
+            elif kind == REPEATING_GROUP:
+                tag = key[1]
+                label = tag_label(tag)
+            elif kind == PRIVATE_CREATOR:
+                tag = None
+                label = '({:04X},00xx)'.format(key[1])
+                creator = key[2]
+            else:
+                tag = None
+                label = '({:04X},xx{:02X})'.format(key[1], key[3])
+                creator = key[2]
+            rows.append({
+                'kind': kind,
+                'tag': label,
+                'keyword': keyword,
+                'private_creator': creator,
+                'action': self._actions.get(tag, ''),
+                'files': files,
+                'occurrences': occurrences,
+                'vrs': '/'.join(sorted(vrs)),
+            })
+        return rows
+
+
+def _element_vr(element) -> str:
+    """
+    VR of an element, from the dictionary if it is not explicit in the file (implicit VR or UN)
+    """
+    if element.VR not in (None, 'UN'):
+        return element.VR
+    if dictionary_has_tag(element.tag):
+        return dictionary_VR(element.tag)
+    return 'UN'
+
+
+def _entry_key(key, creators: PrivateCreatorIndex, anonymizer: Anonymizer, actions: dict) -> tuple:
+    """
+    Key of the inventory entry counting an element
+    """
+    group, element = key >> 16, key & 0xFFFF
+    if group & 1:
+        if _PRIVATE_CREATOR_FIRST <= element <= _PRIVATE_CREATOR_LAST:
+            return PRIVATE_CREATOR, group, str(creators.creator(group, element) or '')
+        return PRIVATE, group, str(creators.creator(group, element >> 8) or ''), element & 0xFF
+
+    rule = anonymizer.find_rule(key)
+    if rule is None:
+        return TAG, key
+    rule_tag, action = rule
+    actions[rule_tag] = action_label(action)
+    if len(rule_tag) > 2:
+        return REPEATING_GROUP, rule_tag
+    return TAG, key
+
+
+def _count(counts: dict, key: tuple, vr: str) -> None:
+    entry = counts.get(key)
+    if entry is None:
+        counts[key] = [1, {vr}]
+    else:
+        entry[0] += 1
+        entry[1].add(vr)
+
+
+def _scan_dataset(dataset, anonymizer: Anonymizer, counts: dict, actions: dict) -> PrivateCreatorIndex:
+    """
+    Count the elements of a dataset, nested sequences included
+
+    :return: Private creators of the dataset
+    """
+    creators = PrivateCreatorIndex(dataset)
+    for raw_element in list(iter_raw_elements(dataset)):
+        _count(counts, _entry_key(raw_element.tag, creators, anonymizer, actions), _element_vr(raw_element))
+        if is_sequence(dataset, raw_element):
+            for sub_dataset in dataset[raw_element.tag].value:
+                _scan_dataset(sub_dataset, anonymizer, counts, actions)
+    return creators
+
+
+def scan_file(path: str, anonymizer: Anonymizer, inventory: Inventory) -> None:
+    """
+    Add the tags of a file to the inventory, the file is counted as failed if it cannot be read
+
+    :param path: DICOM file
+    :param anonymizer: Rules reported for each tag
+    :param inventory: Inventory updated with the counts of the file
+    """
+    counts = {}
+    actions = {}
+    try:
+        dataset, _, tail_elements = read_header(path, SCAN_DEFER_SIZE)
+        file_meta = getattr(dataset, 'file_meta', None)
+        if file_meta is not None:
+            _scan_dataset(file_meta, anonymizer, counts, actions)
+        creators = _scan_dataset(dataset, anonymizer, counts, actions)
+        # Elements after the Pixel Data: their values are not read, the VR is the one of the dictionary
+        for tag, _ in tail_elements:
+            vr = dictionary_VR(tag) if dictionary_has_tag(tag) else 'UN'
+            _count(counts, _entry_key(tag, creators, anonymizer, actions), vr)
+    except Exception:
+        logger.debug('Cannot scan %s', path, exc_info=True)
+        inventory.failed += 1
+        return
+    inventory.add_file(counts, actions)
+
+
+def _init_worker(anonymizer: Anonymizer) -> None:
+    global _worker_anonymizer
+    _worker_anonymizer = anonymizer
+
+
+def _scan_chunk_in_worker(paths: list) -> Inventory:
+    inventory = Inventory()
+    for path in paths:
+        scan_file(path, _worker_anonymizer, inventory)
+    return inventory
+
+
+def scan(input_path: str, anonymizer: Anonymizer = None, workers: int = 1, extensions: list = None,
+         check_preamble: bool = False, progress_bar=None, chunk_size: int = 64) -> Inventory:
+    """
+    Inventory of the tags of a DICOM file or of the files of a folder, nothing is written
+
+    :param input_path: DICOM file or folder, read recursively
+    :param anonymizer: Rules reported for each tag, the default ones if None
+    :param workers: Number of worker processes, the files are scanned in the current process if 1
+    :param extensions: Only scan the files of the folder with one of these extensions
+    :param check_preamble: Only scan the files of the folder which have the 'DICM' prefix after the preamble
+    :param progress_bar: tqdm progress bar updated as files are scanned
+    :param chunk_size: Number of files sent to a worker at once
+    """
+    if anonymizer is None:
+        anonymizer = Anonymizer()
+    if os.path.isdir(input_path):
+        paths = (os.path.join(input_path, relative_path)
+                 for relative_path in iter_files(input_path, extensions, check_preamble))
+    else:
+        paths = [input_path]
+
+    inventory = Inventory()
+    if workers > 1:
+        import multiprocessing
+        with multiprocessing.Pool(workers, _init_worker, (anonymizer,)) as pool:
+            for chunk_inventory in pool.imap_unordered(_scan_chunk_in_worker, _chunks(paths, chunk_size)):
+                inventory.merge(chunk_inventory)
+                if progress_bar is not None:
+                    progress_bar.update(chunk_inventory.files + chunk_inventory.failed)
+    else:
+        for path in paths:
+            scan_file(path, anonymizer, inventory)
+            if progress_bar is not None:
+                progress_bar.update(1)
+    return inventory
+
+
+def write_report(inventory: Inventory, output_path: str, report_format: str = None) -> None:
+    """
+    Write the rows of the inventory to a CSV or Parquet file
+
+    :param inventory: Inventory returned by scan
+    :param output_path: Report file
+    :param report_format: 'csv' or 'parquet', from the extension of output_path if None
+    """
+    if report_format is None:
+        report_format = 'parquet' if output_path.lower().endswith('.parquet') else 'csv'
+    rows = inventory.rows()
+    if report_format == 'parquet':
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Parquet reports require pyarrow: pip install pyarrow') from None
+        table = pyarrow.Table.from_pydict({column: [row[column] for row in rows] for column in REPORT_COLUMNS})
+        pyarrow.parquet.write_table(table, output_path)
+    else:
+        with open(output_path, 'w', newline='', encoding='utf-8') as report_file:
+            writer = csv.DictWriter(report_file, REPORT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def main(argv: list = None, defined_action_map: dict = {}):
+    parser = argparse.ArgumentParser(prog='python -m dicomanonymizer scan', add_help=True,
+                                     description='List the tags found in the headers of DICOM files, with the rule '
+                                     'applying to each of them, without anonymizing the files')
+    parser.add_argument('input', help='Path to the input dicom file or input directory which contains dicom files')
+    parser.add_argument('-o', '--output', action='store', default='inventory.csv', help='Report file, Parquet if its '\
+    'extension is .parquet (default: %(default)s)')
+    parser.add_argument('--format', action='store', dest='report_format', choices=REPORT_FORMATS,
+                        help='Format of the report (default: from the extension of --output)')
+    parser.add_argument('--workers', action='store', type=int, default=1, help='Number of worker processes '\
+    '(default: %(default)s)')
+    parser.add_argument('--dictionary', action='store', help='File which contains a dictionary that can be added to the '\
+    'original one, or its compiled ruleset: the report shows the actions of these rules')
+    parser.add_argument('--extension', action='append', dest='extensions', help='Only scan the files of the input '\
+    'directory with this extension, e.g. .dcm (can be repeated)')
+    parser.add_argument('--check-preamble', action='store_true', dest='check_preamble', help='Only scan the files of '\
+    'the input directory which have the \'DICM\' prefix after the preamble')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    report_format = args.report_format or ('parquet' if args.output.lower().endswith('.parquet') else 'csv')
+    if report_format == 'parquet':
+        # Checked before scanning rather than after
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.exit(1, 'error: Parquet reports require pyarrow: pip install pyarrow\n')
+    actions = read_actions_dictionary(args.dictionary, defined_action_map) if args.dictionary else None
+
+    import tqdm
+    progress_bar = tqdm.tqdm(total=None if os.path.isdir(args.input) else 1)
+    try:
+        inventory = scan(args.input, Anonymizer(actions), args.workers, args.extensions, args.check_preamble,
+                         progress_bar)
+    finally:
+        progress_bar.close()
+
+    write_report(inventory, args.output, report_format)
+    logger.info('%d files scanned, %d failed, %d rows written to %s', inventory.files, inventory.failed, len(inventory),
+                args.output)
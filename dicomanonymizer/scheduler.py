@@ -0,0 +1,120 @@
+"""
+Study affinity of the parallel runs: the files of a study are sent to the same worker, in the same task.
+
+The UIDs of a study are then looked up and cached by a single worker, and the output of a study is
+complete as soon as its task is done. Files are grouped by the folder they are in, as found while
+discovering them, or by the StudyInstanceUID read from the beginning of their header, a window of
+files at a time.
+"""
+import itertools
+import os
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+AFFINITY_STUDY = 'study'
+AFFINITY_DIRECTORY = 'directory'
+AFFINITIES = (AFFINITY_STUDY, AFFINITY_DIRECTORY)
+
+# (0020,000D) Study Instance UID
+STUDY_INSTANCE_UID_TAG = 0x0020000D
+
+# Number of files whose StudyInstanceUID is read before their groups are yielded
+STUDY_WINDOW = 512
+
+
+def _after_study_instance_uid(tag, VR, length) -> bool:
+    return tag > STUDY_INSTANCE_UID_TAG
+
+
+def read_study_instance_uid(path: str) -> Optional[str]:
+    """
+    StudyInstanceUID of a file, read without going further in its header
+
+    :param path: DICOM file
+    :return The UID, None if the file cannot be read or has none
+    """
+    from pydicom.errors import InvalidDicomError
+    from pydicom.filereader import read_partial
+    try:
+        with open(path, 'rb') as in_file:
+            dataset = read_partial(in_file, _after_study_instance_uid, specific_tags=['StudyInstanceUID'])
+        study_instance_uid = dataset.get('StudyInstanceUID')
+    except (OSError, InvalidDicomError, ValueError, EOFError):
+        return None
+    return str(study_instance_uid) if study_instance_uid else None
+
+
+def group_by_directory(paths: Iterable[Tuple[str, str]]) -> Iterator[List[Tuple[str, str]]]:
+    """
+    Yield lists of the consecutive (input file, output file) whose input files are in the same folder
+
+    Groups are yielded as paths is consumed: discovery.iter_paths yields the files of a folder together.
+    """
+    group = []
+    current_folder = None
+    for paths_item in paths:
+        folder = os.path.dirname(paths_item[0])
+        if group and folder != current_folder:
+            yield group
+            group = []
+        current_folder = folder
+        group.append(paths_item)
+    if group:
+        yield group
+
+
+def group_by_study(paths: Iterable[Tuple[str, str]], window: int = STUDY_WINDOW) -> Iterator[List[Tuple[str, str]]]:
+    """
+    Yield lists of the (input file, output file) whose input files have the same StudyInstanceUID
+
+    The headers are read window files at a time, and the groups of a window are yielded, largest first, before
+    the next window is read: the workers start after the first window rather than after the whole tree. The
+    files of a study which are more than window files apart in paths, e.g. in several folders of the tree, may
+    be in several lists. Files without StudyInstanceUID, or which cannot be read, are each in their own list.
+    """
+    iterator = iter(paths)
+    while True:
+        window_paths = list(itertools.islice(iterator, window))
+        if not window_paths:
+            return
+        studies = {}
+        ungrouped = []
+        for paths_item in window_paths:
+            study_instance_uid = read_study_instance_uid(paths_item[0])
+            if study_instance_uid is None:
+                ungrouped.append([paths_item])
+            else:
+                studies.setdefault(study_instance_uid, []).append(paths_item)
+        # Starting with the largest studies leaves the small ones to even out the end of the window
+        yield from sorted(studies.values(), key=len, reverse=True)
+        yield from ungrouped
+
+
+def group_paths(paths: Iterable[Tuple[str, str]], affinity: str) -> Iterable[List[Tuple[str, str]]]:
+    """
+    Group (input file, output file) by study or by folder
+
+    :param paths: Iterable of (input file, output file)
+    :param affinity: 'study' or 'directory'
+    """
+    if affinity == AFFINITY_STUDY:
+        return group_by_study(paths)
+    if affinity == AFFINITY_DIRECTORY:
+        return group_by_directory(paths)
+    raise ValueError('Unknown affinity {!r}, expected one of: {}'.format(affinity, ', '.join(AFFINITIES)))
+
+
+def pack_groups(groups: Iterable[list], size: int) -> Iterator[list]:
+    """
+    Yield tasks of up to size items made of whole groups, a group larger than size is a task on its own
+    """
+    task = []
+    for group in groups:
+        if task and len(task) + len(group) > size:
+            yield task
+            task = []
+        task.extend(group)
+        if len(task) >= size:
+            yield task
+            task = []
+    if task:
+        yield task
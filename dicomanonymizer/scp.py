@@ -0,0 +1,327 @@
+"""
+DICOM storage SCP anonymizing the received instances on the fly: each C-STORE request is anonymized
+as it arrives, then written to a folder or forwarded to another storage SCP. The original instance
+is never written to disk.
+
+Requires pynetdicom (pip install pynetdicom), which is optional for the rest of the package.
+
+Start it with: python -m dicomanonymizer scp --port 11112 --output-folder anonymized
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import re
+import secrets
+import threading
+
+import pydicom
+
+from .anonymizer import _anonymize_bytes_in_worker, _init_worker, read_actions_dictionary
+from .dicomio import BufferReader
+from .engine import Anonymizer
+from .simpledicomanonymizer import DEFAULT_UID_ROOT, set_uid_key, set_uid_map
+from .uidmap import SQLiteUIDMap
+
+try:
+    from pynetdicom import AE, ALL_TRANSFER_SYNTAXES, AllStoragePresentationContexts, build_context, evt
+    from pynetdicom.sop_class import Verification
+except ImportError:
+    AE = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AE_TITLE = 'DICOMANONYMIZER'
+
+# C-STORE statuses (PS3.4, B.2.3) and general statuses (PS3.7, C.4)
+STATUS_SUCCESS = 0x0000
+STATUS_SOP_CLASS_NOT_SUPPORTED = 0x0122
+STATUS_OUT_OF_RESOURCES = 0xA700
+STATUS_CANNOT_UNDERSTAND = 0xC000
+
+# Presentation context IDs are the odd numbers from 1 to 255 (PS3.8, 9.3.2.2)
+MAX_PRESENTATION_CONTEXTS = 128
+
+# UIDs are numeric components separated by dots, of up to 64 characters (PS3.5, 9.1)
+_UID_PATTERN = re.compile(r'[0-9]+(\.[0-9]+)*')
+
+
+def _uid_file_name(value):
+    """
+    UID used in an output path, None if the value is not a valid UID, e.g. a path sent by the peer
+    """
+    value = str(value or '')
+    return value if len(value) <= 64 and _UID_PATTERN.fullmatch(value) else None
+
+
+class ForwardError(Exception):
+    """
+    An instance could not be forwarded, status is the C-STORE status returned to the peer which sent it
+    """
+
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+def _require_pynetdicom() -> None:
+    if AE is None:
+        raise ImportError('The storage SCP requires pynetdicom: pip install pynetdicom')
+
+
+class AnonymizingStorageSCP:
+    """
+    Storage SCP anonymizing the received instances before writing or forwarding them
+
+    Each association is handled in its own thread. With several workers the instances are anonymized
+    in worker processes, as encoded bytes, so that associations are processed in parallel.
+
+    :param anonymizer: Compiled rules applied to the received instances
+    :param output_folder: Folder where the anonymized instances are written, as
+    <StudyInstanceUID>/<SOPInstanceUID>.dcm with the anonymized UIDs
+    :param forward_address: (host, port) of a storage SCP the anonymized instances are sent to
+    :param forward_ae_title: AE title of the storage SCP at forward_address
+    :param ae_title: AE title of this SCP, also used to forward
+    :param workers: Number of worker processes, instances are anonymized in the association threads if 1
+    :param uid_map_path: Path to a SQLite file storing the replaced UIDs, shared by the workers
+    :param uid_key: Secret key used to derive the new UIDs deterministically
+    :param uid_root: Root of the UIDs derived from uid_key
+    """
+
+    def __init__(self, anonymizer: Anonymizer, output_folder: str = None, forward_address: tuple = None,
+                 forward_ae_title: str = 'ANY-SCP', ae_title: str = DEFAULT_AE_TITLE, workers: int = 1,
+                 uid_map_path: str = None, uid_key: bytes = None, uid_root: str = DEFAULT_UID_ROOT):
+        _require_pynetdicom()
+        if output_folder is None and forward_address is None:
+            raise ValueError('Set an output folder or a forward address')
+        self.anonymizer = anonymizer
+        self.output_folder = output_folder
+        self.forward_address = forward_address
+        self.forward_ae_title = forward_ae_title
+        self.ae_title = ae_title
+
+        # Counters of the received instances
+        self.received = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+        self._server = None
+        self._forward_ae = None
+        self._forward_association = None
+        # (SOP Class UID, Transfer Syntax UID) requested when associating, and those the forward SCP rejected
+        self._forward_contexts = []
+        self._rejected_forward_contexts = set()
+        self._forward_lock = threading.Lock()
+
+        self._pool = None
+        if workers > 1:
+            # As in anonymizer.anonymize_in_pool, a random key for the lifetime of the SCP keeps the
+            # UIDs consistent across the workers
+            if uid_key is None and uid_map_path is None:
+                uid_key = secrets.token_bytes(32)
+            self._pool = multiprocessing.Pool(workers, _init_worker,
+                                              (anonymizer, uid_map_path, uid_key, uid_root, {}))
+
+    def _count(self, failed: bool) -> None:
+        with self._lock:
+            self.received += 1
+            if failed:
+                self.failed += 1
+
+    def handle_store(self, event) -> int:
+        """
+        Handler of the C-STORE requests: anonymize the instance, then write or forward it
+        """
+        try:
+            # The dataset is not decoded here: the encoded instance, with its file meta information,
+            # is anonymized like a file held in memory
+            data = event.encoded_dataset(include_meta=True)
+            if self._pool is not None:
+                data = self._pool.apply(_anonymize_bytes_in_worker, (data,))
+            else:
+                data = self.anonymizer.anonymize_bytes(data)
+        except Exception:
+            logger.exception('Cannot anonymize the instance received from %s', event.assoc.requestor.address)
+            self._count(True)
+            return STATUS_CANNOT_UNDERSTAND
+
+        try:
+            if self.output_folder is not None:
+                self._write(data)
+            if self.forward_address is not None:
+                self._forward(data)
+        except ForwardError as e:
+            logger.error('Cannot forward the anonymized instance: %s', e)
+            self._count(True)
+            return e.status
+        except Exception:
+            logger.exception('Cannot store the anonymized instance')
+            self._count(True)
+            return STATUS_OUT_OF_RESOURCES
+
+        self._count(False)
+        return STATUS_SUCCESS
+
+    def _write(self, data: bytes) -> None:
+        header = pydicom.dcmread(BufferReader(data), stop_before_pixels=True,
+                                 specific_tags=['StudyInstanceUID', 'SOPInstanceUID'])
+        # The UIDs come from the peer when the rules keep them: only valid UIDs are used in the path
+        folder = os.path.join(self.output_folder, _uid_file_name(header.get('StudyInstanceUID')) or 'unknown')
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, '{}.dcm'.format(_uid_file_name(header.get('SOPInstanceUID'))
+                                                    or secrets.token_hex(16)))
+        with open(path, 'wb') as out_file:
+            out_file.write(data)
+
+    def _forward(self, data: bytes) -> None:
+        dataset = pydicom.dcmread(BufferReader(data))
+        context = (dataset.file_meta.MediaStorageSOPClassUID, dataset.file_meta.TransferSyntaxUID)
+        with self._forward_lock:
+            association = self._forward_association_for(context)
+            status = association.send_c_store(dataset)
+        if status.get('Status') is None:
+            raise ForwardError('No response to the C-STORE to {}:{}'.format(*self.forward_address),
+                               STATUS_OUT_OF_RESOURCES)
+        if status.Status != STATUS_SUCCESS:
+            # The status of the forward SCP is passed on to the peer
+            raise ForwardError('C-STORE to {}:{} failed with status 0x{:04X}'.format(
+                self.forward_address[0], self.forward_address[1], status.Status), status.Status)
+
+    def _forward_association_for(self, context: tuple):
+        """
+        Association with the forward SCP accepting the SOP class and transfer syntax of context
+
+        The SOP classes and transfer syntaxes are requested as they are received: a new one ends the
+        current association, and a new one is requested with all the contexts seen so far.
+        """
+        if context in self._rejected_forward_contexts:
+            raise ForwardError('{} in {} rejected by {}:{}'.format(*context, *self.forward_address),
+                               STATUS_SOP_CLASS_NOT_SUPPORTED)
+        association = self._forward_association
+        if association is not None and association.is_established and any(
+                (accepted.abstract_syntax, accepted.transfer_syntax[0]) == context
+                for accepted in association.accepted_contexts):
+            return association
+
+        if context not in self._forward_contexts:
+            self._forward_contexts.append(context)
+            del self._forward_contexts[:-MAX_PRESENTATION_CONTEXTS]
+        if association is not None and association.is_established:
+            association.release()
+        self._forward_association = self._forward_ae.associate(
+            self.forward_address[0], self.forward_address[1], ae_title=self.forward_ae_title,
+            contexts=[build_context(sop_class_uid, transfer_syntax)
+                      for sop_class_uid, transfer_syntax in self._forward_contexts])
+        if not self._forward_association.is_established:
+            raise ForwardError('Cannot associate with {}:{}'.format(*self.forward_address), STATUS_OUT_OF_RESOURCES)
+        accepted_contexts = {(accepted.abstract_syntax, accepted.transfer_syntax[0])
+                             for accepted in self._forward_association.accepted_contexts}
+        self._rejected_forward_contexts.update(set(self._forward_contexts) - accepted_contexts)
+        if context not in accepted_contexts:
+            raise ForwardError('{} in {} rejected by {}:{}'.format(*context, *self.forward_address),
+                               STATUS_SOP_CLASS_NOT_SUPPORTED)
+        return self._forward_association
+
+    def start(self, host: str = '', port: int = 11112, block: bool = True):
+        """
+        Listen to the C-STORE and C-ECHO requests
+
+        :param host: Address to listen to, all the interfaces if empty
+        :param port: Port to listen to
+        :param block: Serve in the current thread until interrupted, otherwise in a background thread
+        """
+        ae = AE(ae_title=self.ae_title)
+        for context in AllStoragePresentationContexts:
+            ae.add_supported_context(context.abstract_syntax, ALL_TRANSFER_SYNTAXES)
+        ae.add_supported_context(Verification)
+
+        if self.forward_address is not None:
+            # The contexts are requested from the received instances, see _forward_association_for
+            self._forward_ae = AE(ae_title=self.ae_title)
+
+        handlers = [(evt.EVT_C_STORE, self.handle_store)]
+        logger.info('Storage SCP %s listening on port %d', self.ae_title, port)
+        if block:
+            try:
+                ae.start_server((host, port), block=True, evt_handlers=handlers)
+            finally:
+                self.stop()
+        else:
+            self._server = ae.start_server((host, port), block=False, evt_handlers=handlers)
+            return self._server
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        with self._forward_lock:
+            if self._forward_association is not None and self._forward_association.is_established:
+                self._forward_association.release()
+            self._forward_association = None
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        logger.info('%d instances received, %d failed', self.received, self.failed)
+
+
+def main(argv: list = None, defined_action_map: dict = {}):
+    parser = argparse.ArgumentParser(prog='python -m dicomanonymizer scp', add_help=True)
+    parser.add_argument('--host', action='store', default='', help='Address to listen to (default: all the interfaces)')
+    parser.add_argument('--port', action='store', type=int, default=11112, help='Port to listen to (default: %(default)s)')
+    parser.add_argument('--ae-title', action='store', dest='ae_title', default=DEFAULT_AE_TITLE,
+                        help='AE title of the SCP (default: %(default)s)')
+    parser.add_argument('--output-folder', action='store', dest='output_folder', help='Folder where the anonymized '\
+    'instances are written, as <StudyInstanceUID>/<SOPInstanceUID>.dcm')
+    parser.add_argument('--forward', action='store', help='HOST:PORT of a storage SCP the anonymized instances are '\
+    'sent to')
+    parser.add_argument('--forward-ae-title', action='store', dest='forward_ae_title', default='ANY-SCP',
+                        help='AE title of the --forward storage SCP (default: %(default)s)')
+    parser.add_argument('--workers', action='store', type=int, default=1, help='Number of worker processes '\
+    '(default: %(default)s, instances are anonymized in the association threads)')
+    parser.add_argument('--dictionary', action='store', help='File which contains a dictionary that can be added to the original one, '\
+    'or its compiled ruleset (python -m dicomanonymizer compile-rules)')
+    parser.add_argument('--keepPrivateTags', action='store_true', dest='keepPrivateTags', help='If used, then private tags won\'t be deleted')
+    parser.add_argument('--single-pass', action='store_true', dest='single_pass', help='If used, each element is visited once '\
+    '(nested sequences included) and its action is looked up, instead of applying the rules one by one')
+    parser.add_argument('--uid-map', action='store', dest='uid_map', help='SQLite file which stores the replaced UIDs')
+    parser.add_argument('--uid-key-file', action='store', dest='uid_key_file', help='File which contains a secret key '\
+    'used to derive the new UIDs from the original ones (HMAC) instead of drawing them randomly')
+    parser.add_argument('--uid-root', action='store', dest='uid_root', default=DEFAULT_UID_ROOT,
+                        help='Root of the UIDs derived with --uid-key-file, up to 25 characters (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    if args.output_folder is None and args.forward is None:
+        parser.error('set --output-folder or --forward')
+    if args.uid_map is not None and args.uid_key_file is not None:
+        parser.error('--uid-map cannot be used with --uid-key-file: UIDs derived from the key are not stored in a map')
+
+    forward_address = None
+    if args.forward is not None:
+        forward_host, forward_port = args.forward.rsplit(':', 1)
+        forward_address = (forward_host, int(forward_port))
+
+    actions = read_actions_dictionary(args.dictionary, defined_action_map) if args.dictionary else None
+    anonymizer = Anonymizer(actions, not args.keepPrivateTags, args.single_pass)
+
+    uid_key = None
+    if args.uid_key_file:
+        with open(args.uid_key_file, 'rb') as key_file:
+            uid_key = key_file.read().strip()
+    if uid_key is not None:
+        set_uid_key(uid_key, args.uid_root)
+    uid_map = None
+    if args.uid_map is not None:
+        uid_map = SQLiteUIDMap(args.uid_map, commit_every=1)
+        set_uid_map(uid_map)
+
+    scp = AnonymizingStorageSCP(anonymizer, args.output_folder, forward_address, args.forward_ae_title, args.ae_title,
+                                args.workers, args.uid_map, uid_key, args.uid_root)
+    try:
+        scp.start(args.host, args.port, block=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if uid_map is not None:
+            uid_map.close()
@@ -0,0 +1,299 @@
+"""
+HTTP anonymization service: a long running process keeping the compiled rules and the UID mapping
+warm between requests.
+
+Endpoints:
+- POST /anonymize: a DICOM file (PS3.10) as body, or several as the parts of a multipart body.
+  Returns the anonymized file as application/dicom, or the anonymized files as a multipart/related
+  body in the same order.
+- GET /health: liveness, as JSON.
+- GET /stats: throughput since the start, as JSON.
+- GET /metrics: the same counters, plus the instrumentation totals if enabled, in the Prometheus
+  text format.
+
+Start it with: python -m dicomanonymizer serve --port 8080
+"""
+import argparse
+import email.parser
+import email.policy
+import json
+import logging
+import multiprocessing
+import secrets
+import threading
+import time
+import uuid
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .anonymizer import _anonymize_bytes_in_worker, _init_worker, read_actions_dictionary
+from .engine import Anonymizer
+from .instrumentation import Instrumentation, get_instrumentation, set_instrumentation
+from .simpledicomanonymizer import DEFAULT_UID_ROOT, set_uid_key, set_uid_map
+from .uidmap import SQLiteUIDMap
+
+logger = logging.getLogger(__name__)
+
+DICOM_CONTENT_TYPE = 'application/dicom'
+DEFAULT_MAX_REQUEST_BYTES = 1024 * 1024 * 1024
+
+
+class ServerStats:
+    """
+    Counters of the service, shared by the request threads
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.requests = 0
+        self.files = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.anonymize_seconds = 0.
+        self._lock = threading.Lock()
+
+    def add(self, files: int = 0, bytes_in: int = 0, bytes_out: int = 0, seconds: float = 0., errors: int = 0) -> None:
+        with self._lock:
+            self.requests += 1
+            self.files += files
+            self.errors += errors
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.anonymize_seconds += seconds
+
+    def report(self) -> dict:
+        with self._lock:
+            uptime = time.time() - self.start_time
+            return {
+                'uptime_seconds': uptime,
+                'requests': self.requests,
+                'files': self.files,
+                'errors': self.errors,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'anonymize_seconds': self.anonymize_seconds,
+                'files_per_second': self.files / uptime if uptime else 0.,
+                'mb_per_second': self.bytes_in / 1e6 / uptime if uptime else 0.,
+            }
+
+
+class AnonymizationServer(ThreadingHTTPServer):
+    """
+    HTTP server anonymizing the DICOM files posted to /anonymize, one thread per request
+
+    :param address: (host, port) to listen to, port 0 picks a free port
+    :param anonymizer: Compiled rules used for all the requests
+    :param workers: Number of worker processes, files are anonymized in the request threads if 1
+    :param uid_map_path: Path to a SQLite file storing the replaced UIDs, shared by the workers
+    :param uid_key: Secret key used to derive the new UIDs deterministically
+    :param uid_root: Root of the UIDs derived from uid_key
+    :param max_request_bytes: Larger request bodies are refused
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple, anonymizer: Anonymizer, workers: int = 1, uid_map_path: str = None,
+                 uid_key: bytes = None, uid_root: str = DEFAULT_UID_ROOT,
+                 max_request_bytes: int = DEFAULT_MAX_REQUEST_BYTES):
+        super().__init__(address, AnonymizationRequestHandler)
+        self.anonymizer = anonymizer
+        self.max_request_bytes = max_request_bytes
+        self.stats = ServerStats()
+        self.pool = None
+        if workers > 1:
+            # As in anonymizer.anonymize_in_pool, a random key for the lifetime of the server keeps the
+            # UIDs consistent across the workers
+            if uid_key is None and uid_map_path is None:
+                uid_key = secrets.token_bytes(32)
+            self.pool = multiprocessing.Pool(workers, _init_worker,
+                                             (anonymizer, uid_map_path, uid_key, uid_root, {}))
+
+    def anonymize_files(self, files: list) -> list:
+        """
+        Anonymize the contents of files, in the worker processes if any
+        """
+        if self.pool is not None:
+            return self.pool.map(_anonymize_bytes_in_worker, files)
+        return list(self.anonymizer.anonymize_buffers(files))
+
+    def server_close(self):
+        super().server_close()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+
+class AnonymizationRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'DICOMAnonymizer'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.info('%s - %s', self.address_string(), format % args)
+
+    def _send(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, value: dict, status: int = HTTPStatus.OK) -> None:
+        self._send(status, json.dumps(value).encode('utf-8'), 'application/json')
+
+    def _send_error(self, status: int, message: str) -> None:
+        self._send_json({'error': message}, status)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json({'status': 'ok', 'uptime_seconds': time.time() - self.server.stats.start_time})
+        elif self.path == '/stats':
+            self._send_json(self.server.stats.report())
+        elif self.path == '/metrics':
+            self._send(HTTPStatus.OK, self._prometheus_metrics().encode('utf-8'), 'text/plain; version=0.0.4')
+        else:
+            self._send_error(HTTPStatus.NOT_FOUND, 'Unknown path: ' + self.path)
+
+    def _prometheus_metrics(self) -> str:
+        lines = []
+        for name, value in sorted(self.server.stats.report().items()):
+            metric = 'dicomanonymizer_server_' + name
+            lines.append('# TYPE {} {}'.format(metric, 'counter' if name not in ('uptime_seconds', 'files_per_second',
+                                                                               'mb_per_second') else 'gauge'))
+            lines.append('{} {!r}'.format(metric, value))
+        text = '\n'.join(lines) + '\n'
+        instrumentation = get_instrumentation()
+        if instrumentation is not None:
+            text += instrumentation.to_prometheus()
+        return text
+
+    def do_POST(self):
+        if self.path != '/anonymize':
+            self._send_error(HTTPStatus.NOT_FOUND, 'Unknown path: ' + self.path)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self._send_error(HTTPStatus.LENGTH_REQUIRED, 'Content-Length is required')
+            return
+        if length > self.server.max_request_bytes:
+            self.close_connection = True
+            self._send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                             'Request larger than {} bytes'.format(self.server.max_request_bytes))
+            return
+        body = self.rfile.read(length)
+
+        content_type = self.headers.get('Content-Type', DICOM_CONTENT_TYPE)
+        multipart = content_type.lower().startswith('multipart/')
+        files = _parse_multipart(content_type, body) if multipart else [body]
+
+        start = time.perf_counter()
+        try:
+            anonymized_files = self.server.anonymize_files(files)
+        except Exception as e:
+            self.server.stats.add(bytes_in=length, errors=1)
+            self._send_error(HTTPStatus.BAD_REQUEST, '{}: {}'.format(type(e).__name__, e))
+            return
+        seconds = time.perf_counter() - start
+
+        if multipart:
+            boundary = uuid.uuid4().hex
+            response = _format_multipart(anonymized_files, boundary)
+            response_type = 'multipart/related; type="{}"; boundary={}'.format(DICOM_CONTENT_TYPE, boundary)
+        else:
+            response = anonymized_files[0]
+            response_type = DICOM_CONTENT_TYPE
+        self.server.stats.add(len(files), length, len(response), seconds)
+        self._send(HTTPStatus.OK, response, response_type)
+
+
+def _parse_multipart(content_type: str, body: bytes) -> list:
+    """
+    Contents of the parts of a multipart body (multipart/related or multipart/form-data)
+    """
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        'Content-Type: {}\r\n\r\n'.format(content_type).encode('latin-1') + body)
+    return [part.get_payload(decode=True) for part in message.iter_parts()]
+
+
+def _format_multipart(files: list, boundary: str) -> bytes:
+    """
+    multipart/related body of DICOM files
+    """
+    delimiter = '--{}\r\n'.format(boundary).encode('ascii')
+    part_header = 'Content-Type: {}\r\n\r\n'.format(DICOM_CONTENT_TYPE).encode('ascii')
+    chunks = []
+    for content in files:
+        chunks += [delimiter, part_header, content, b'\r\n']
+    chunks.append('--{}--\r\n'.format(boundary).encode('ascii'))
+    return b''.join(chunks)
+
+
+def serve(anonymizer: Anonymizer, host: str = '127.0.0.1', port: int = 8080, workers: int = 1,
+          uid_map_path: str = None, uid_key: bytes = None, uid_root: str = DEFAULT_UID_ROOT,
+          max_request_bytes: int = DEFAULT_MAX_REQUEST_BYTES) -> None:
+    """
+    Run the anonymization service until interrupted
+
+    See AnonymizationServer for the parameters.
+    """
+    if uid_key is not None:
+        set_uid_key(uid_key, uid_root)
+    uid_map = None
+    if uid_map_path is not None:
+        uid_map = SQLiteUIDMap(uid_map_path, commit_every=1)
+        previous_uid_map = set_uid_map(uid_map)
+
+    server = AnonymizationServer((host, port), anonymizer, workers, uid_map_path, uid_key, uid_root, max_request_bytes)
+    logger.info('Listening on http://%s:%d', *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if uid_map is not None:
+            set_uid_map(previous_uid_map)
+            uid_map.close()
+        if uid_key is not None:
+            set_uid_key(None)
+
+
+def main(argv: list = None, defined_action_map: dict = {}):
+    parser = argparse.ArgumentParser(prog='python -m dicomanonymizer serve', add_help=True)
+    parser.add_argument('--host', action='store', default='127.0.0.1', help='Address to listen to (default: %(default)s)')
+    parser.add_argument('--port', action='store', type=int, default=8080, help='Port to listen to (default: %(default)s)')
+    parser.add_argument('--workers', action='store', type=int, default=1, help='Number of worker processes '\
+    '(default: %(default)s, files are anonymized in the request threads)')
+    parser.add_argument('--dictionary', action='store', help='File which contains a dictionary that can be added to the original one, '\
+    'or its compiled ruleset (python -m dicomanonymizer compile-rules)')
+    parser.add_argument('--keepPrivateTags', action='store_true', dest='keepPrivateTags', help='If used, then private tags won\'t be deleted')
+    parser.add_argument('--single-pass', action='store_true', dest='single_pass', help='If used, each element is visited once '\
+    '(nested sequences included) and its action is looked up, instead of applying the rules one by one')
+    parser.add_argument('--uid-map', action='store', dest='uid_map', help='SQLite file which stores the replaced UIDs')
+    parser.add_argument('--uid-key-file', action='store', dest='uid_key_file', help='File which contains a secret key '\
+    'used to derive the new UIDs from the original ones (HMAC) instead of drawing them randomly')
+    parser.add_argument('--uid-root', action='store', dest='uid_root', default=DEFAULT_UID_ROOT,
+                        help='Root of the UIDs derived with --uid-key-file, up to 25 characters (default: %(default)s)')
+    parser.add_argument('--max-request-mb', action='store', type=int, dest='max_request_mb',
+                        default=DEFAULT_MAX_REQUEST_BYTES // (1024 * 1024),
+                        help='Larger requests are refused (default: %(default)s)')
+    parser.add_argument('--metrics', action='store_true', help='If used, the time spent per stage and per rule is '\
+    'recorded and exposed on /metrics (not with --workers)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    if args.uid_map is not None and args.uid_key_file is not None:
+        parser.error('--uid-map cannot be used with --uid-key-file: UIDs derived from the key are not stored in a map')
+
+    actions = read_actions_dictionary(args.dictionary, defined_action_map) if args.dictionary else None
+    anonymizer = Anonymizer(actions, not args.keepPrivateTags, args.single_pass)
+
+    uid_key = None
+    if args.uid_key_file:
+        with open(args.uid_key_file, 'rb') as key_file:
+            uid_key = key_file.read().strip()
+
+    if args.metrics:
+        set_instrumentation(Instrumentation())
+    serve(anonymizer, args.host, args.port, args.workers, args.uid_map, uid_key, args.uid_root,
+          args.max_request_mb * 1024 * 1024)
@@ -1,46 +1,177 @@
+import hashlib
+import hmac
+import logging
 import re
-from typing import List
-
-import pydicom
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import Iterable, Iterator, List
 
 from .dicomfields import *
 from .format_tag import tag_to_hex_strings
 
+logger = logging.getLogger(__name__)
+
 dictionary = {}
 
+# Root used for UIDs derived from a secret key, '2.25.' is the UUID derived root (128 bits values)
+DEFAULT_UID_ROOT = '2.25.'
+# Decimal digits left after the root of the UIDs derived from a secret key, 39 digits hold 128 bits
+_MIN_KEYED_UID_DIGITS = 39
+_MAX_UID_LENGTH = 64
+_uid_key = None
+_uid_root = DEFAULT_UID_ROOT
+
 
 # Regexp function
 
-def regexp(options: dict):
+def _regexp_options(options) -> list:
+    """
+    List of the find/replace options of a regexp action
+    """
+    return [options] if isinstance(options, dict) else list(options)
+
+
+def _substitute(pattern, replace, value: str) -> str:
+    return pattern.sub(replace, value)
+
+
+def _substitute_chain(substitutions: tuple, value: str) -> str:
+    for pattern, replace in substitutions:
+        value = pattern.sub(replace, value)
+    return value
+
+
+def compile_regexp(options):
+    """
+    Compile the options of a regexp action into a function applied to the string value
+
+    Several find/replace options are applied one after the other, each to the result of the previous one.
+
+    :param options: find/replace dict, or list of them
+    """
+    options = _regexp_options(options)
+    substitutions = tuple((re.compile(option['find']), option['replace']) for option in options)
+    if len(substitutions) == 1:
+        return partial(_substitute, *substitutions[0])
+    return partial(_substitute_chain, substitutions)
+
+
+def _apply_regexp(options, substitute, dataset, tag):
+    """
+    Apply a regexp to the dataset
+    """
+    element = dataset.get(tag)
+    if element is not None:
+        element.value = substitute(str(element.value))
+
+
+def regexp(options):
     """
     Apply a regexp method to the dataset
 
-    :param options: contains two values:
+    :param options: contains two values, or a list of such options applied in order (see compile_regexp):
         - find: which string should be find
         - replace: string that will replace the find string
     """
+    # The patterns are compiled once here. Unlike a closure, a partial of a module level function can be sent
+    # to worker processes
+    return partial(_apply_regexp, options, compile_regexp(options))
 
-    def apply_regexp(dataset, tag):
-        """
-        Apply a regexp to the dataset
-        """
-        element = dataset.get(tag)
-        if element is not None:
-            element.value = re.sub(options['find'], options['replace'], str(element.value))
 
-    return apply_regexp
+def is_regexp(action) -> bool:
+    """
+    Whether the action was made by regexp(options)
+    """
+    return isinstance(action, partial) and action.func is _apply_regexp
+
+
+def merge_actions(actions: dict, new_actions: dict) -> None:
+    """
+    Update actions with new_actions, regexp actions on the same tag are combined instead of replaced
+
+    :param actions: tag -> action dictionary, updated in place
+    :param new_actions: tag -> action dictionary to add
+    """
+    for tag, action in new_actions.items():
+        previous_action = actions.get(tag)
+        if is_regexp(previous_action) and is_regexp(action):
+            action = regexp(_regexp_options(previous_action.args[0]) + _regexp_options(action.args[0]))
+        actions[tag] = action
 
 
 # Default anonymization functions
 
+def set_uid_map(uid_map):
+    """
+    Replace the mapping used by get_UID to store the replaced UIDs
+
+    :param uid_map: Any object with dict-like get and setdefault methods, e.g. a dict or an
+    uidmap.SQLiteUIDMap for a bounded and persistent mapping
+    :return The previous mapping
+    """
+    global dictionary
+    previous_uid_map = dictionary
+    dictionary = uid_map
+    return previous_uid_map
+
+
+def set_uid_key(key: bytes, root: str = DEFAULT_UID_ROOT) -> None:
+    """
+    Enable the deterministic UID mode: new UIDs are derived from the original UID with an HMAC
+    keyed by a secret, so that separate processes or nodes agree on the mapped UIDs without any
+    shared state. Set key to None to go back to the default random mode.
+
+    :param key: Secret key, keep it private as it allows to check guesses of original UIDs
+    :param root: UID root of the generated UIDs
+    """
+    from pydicom.uid import UID
+    global _uid_key, _uid_root
+    if not root.endswith('.'):
+        root += '.'
+    if not UID(root[:-1]).is_valid:
+        raise ValueError('Invalid UID root: {}'.format(root))
+    _check_keyed_uid_root(root)
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    _uid_key = key
+    _uid_root = root
+
+
+def _check_keyed_uid_root(root: str) -> None:
+    if _MAX_UID_LENGTH - len(root) < _MIN_KEYED_UID_DIGITS:
+        raise ValueError('UID root too long: {} characters, at most {} leave enough digits for the derived UIDs'
+                         .format(len(root), _MAX_UID_LENGTH - _MIN_KEYED_UID_DIGITS))
+
+
+def generate_keyed_UID(old_uid: str, key: bytes, root: str = DEFAULT_UID_ROOT) -> str:
+    """
+    Derive a new UID from the original one with HMAC-SHA256 under the given root
+
+    The digest is reduced to the digits left after the root, at least 39 (128 bits), so that distinct
+    UIDs do not collide.
+    """
+    _check_keyed_uid_root(root)
+    digest = hmac.new(key, str(old_uid).encode('utf-8'), hashlib.sha256).digest()
+    if root == DEFAULT_UID_ROOT:
+        # 2.25 UIDs are limited to 128 bits integers
+        digest = digest[:16]
+    return root + str(int.from_bytes(digest, 'big') % 10 ** (_MAX_UID_LENGTH - len(root)))
+
+
 def get_UID(old_uid: str) -> str:
     """
     Lookup new UID in cached dictionary or create new one if none found
+    In deterministic mode (see set_uid_key) the new UID is derived from the old one instead
     """
+    if _uid_key is not None:
+        return generate_keyed_UID(old_uid, _uid_key, _uid_root)
+
     from pydicom.uid import generate_uid
-    if old_uid not in dictionary:
-        dictionary[old_uid] = generate_uid(None)
-    return dictionary.get(old_uid)
+    new_uid = dictionary.get(old_uid)
+    if new_uid is None:
+        new_uid = dictionary.setdefault(old_uid, generate_uid(None))
+    return new_uid
 
 def replace_element_UID(element):
     """
@@ -70,6 +201,66 @@ def replace_element_date_time(element):
     element.value = '00010101010101.000000+0000'
 
 
+def _set_element_value(value):
+    """
+    Build an element handler which assigns a pre-built value to the element
+    """
+    def set_element_value(element):
+        element.value = value
+
+    return set_element_value
+
+
+def _keep_element(element):
+    pass
+
+
+def _replace_sequence(element):
+    # Iterating the dataset (rather than elements()) converts raw elements so they can be modified
+    for sub_dataset in element.value:
+        for sub_element in sub_dataset:
+            replace_element(sub_element)
+
+
+def _empty_sequence(element):
+    for sub_dataset in element.value:
+        for sub_element in sub_dataset:
+            empty_element(sub_element)
+
+
+# VR dispatch tables used by replace_element and empty_element, built once at import
+_replace_element_by_vr = {
+    'DA': replace_element_date,
+    'TM': _set_element_value('000000.00'),
+    'LO': _set_element_value('Anonymized'),
+    'SH': _set_element_value('Anonymized'),
+    'PN': _set_element_value('Anonymized'),
+    'CS': _set_element_value('Anonymized'),
+    'UI': replace_element_UID,
+    'UL': _keep_element,
+    'IS': _set_element_value('0'),
+    'FD': _set_element_value(0),
+    'FL': _set_element_value(0),
+    'SS': _set_element_value(0),
+    'US': _set_element_value(0),
+    'ST': _set_element_value(''),
+    'SQ': _replace_sequence,
+    'DT': replace_element_date_time,
+}
+
+_empty_element_by_vr = {
+    'SH': _set_element_value(''),
+    'PN': _set_element_value(''),
+    'UI': _set_element_value(''),
+    'LO': _set_element_value(''),
+    'CS': _set_element_value(''),
+    'DA': replace_element_date,
+    'TM': _set_element_value('000000.00'),
+    'UL': _set_element_value(0),
+    'SQ': _empty_sequence,
+}
+
+
 def replace_element(element):
     """
     Replace element's value according to it's VR:
@@ -83,30 +274,10 @@ def replace_element(element):
     - SQ: call replace_element for all sub elements
     - DT: cf replace_element_date_time
     """
-    if element.VR == 'DA':
-        replace_element_date(element)
-    elif element.VR == 'TM':
-        element.value = '000000.00'
-    elif element.VR in ('LO', 'SH', 'PN', 'CS'):
-        element.value = 'Anonymized'
-    elif element.VR == 'UI':
-        replace_element_UID(element)
-    elif element.VR == 'UL':
-        pass
-    elif element.VR == 'IS':
-        element.value = '0'
-    elif element.VR in ('FD', 'FL', 'SS', 'US'):
-        element.value = 0
-    elif element.VR == 'ST':
-        element.value = ''
-    elif element.VR == 'SQ':
-        for sub_dataset in element.value:
-            for sub_element in sub_dataset.elements():
-                replace_element(sub_element)
-    elif element.VR == 'DT':
-        replace_element_date_time(element)
-    else:
+    handler = _replace_element_by_vr.get(element.VR)
+    if handler is None:
         raise NotImplementedError('Not anonymized. VR {} not yet implemented.'.format(element.VR))
+    handler(element)
 
 
 def replace(dataset, tag):
@@ -128,20 +299,10 @@ def empty_element(element):
     - UL: value will be replaced by 0
     - SQ: all subelement will be called with "empty_element"
     """
-    if (element.VR in ('SH', 'PN', 'UI', 'LO', 'CS')):
-        element.value = ''
-    elif element.VR == 'DA':
-        replace_element_date(element)
-    elif element.VR == 'TM':
-        element.value = '000000.00'
-    elif element.VR == 'UL':
-        element.value = 0
-    elif element.VR == 'SQ':
-        for sub_dataset in element.value:
-            for sub_element in sub_dataset.elements():
-                empty_element(sub_element)
-    else:
+    handler = _empty_element_by_vr.get(element.VR)
+    if handler is None:
         raise NotImplementedError('Not anonymized. VR {} not yet implemented.'.format(element.VR))
+    handler(element)
 
 
 def empty(dataset, tag):
@@ -159,9 +320,10 @@ def delete_element(dataset, element):
     Delete the element from the dataset.
     If VR's element is a date, then it will be replaced by 00010101
     """
+    from pydicom.sequence import Sequence
     if element.VR == 'DA':
         replace_element_date(element)
-    elif element.VR == 'SQ' and element.value is type(pydicom.Sequence):
+    elif element.VR == 'SQ' and element.value is type(Sequence):
         for sub_dataset in element.value:
             for sub_element in sub_dataset.elements():
                 delete_element(sub_dataset, sub_element)
@@ -249,6 +411,7 @@ actions_map_name_functions = {
     "delete_or_empty_or_replace": delete_or_empty_or_replace,
     "delete_or_empty_or_replace_UID": delete_or_empty_or_replace_UID,
     "keep": keep,
+    "clean": clean,
     "regexp": regexp
 }
 
@@ -288,8 +451,44 @@ def initialize_actions() -> dict:
     return anonymization_actions
 
 
+# Anonymizers of the module level functions, by rules and delete_private_tags, so that repeated calls with the
+# same rules compile them once
+_ANONYMIZER_CACHE_SIZE = 8
+_anonymizers = OrderedDict()
+_anonymizers_lock = threading.Lock()
+
+
+def get_anonymizer(extra_anonymization_rules: dict = None, delete_private_tags: bool = True):
+    """
+    Anonymizer compiling the rules, shared by the calls with the same rules and flags
+
+    :param extra_anonymization_rules: add more tag's actions
+    :param delete_private_tags: Define if private tags should be delete or not
+    :return engine.Anonymizer
+    """
+    from .engine import Anonymizer
+    try:
+        key = (tuple(extra_anonymization_rules.items()) if extra_anonymization_rules else (), delete_private_tags)
+        hash(key)
+    except TypeError:
+        # Tags or actions which cannot be compared, e.g. a tag given as a list
+        return Anonymizer(extra_anonymization_rules, delete_private_tags)
+
+    with _anonymizers_lock:
+        anonymizer = _anonymizers.get(key)
+        if anonymizer is not None:
+            _anonymizers.move_to_end(key)
+            return anonymizer
+    anonymizer = Anonymizer(extra_anonymization_rules, delete_private_tags)
+    with _anonymizers_lock:
+        _anonymizers[key] = anonymizer
+        if len(_anonymizers) > _ANONYMIZER_CACHE_SIZE:
+            _anonymizers.popitem(last=False)
+    return anonymizer
+
+
 def anonymize_dicom_file(in_file: str, out_file: str, extra_anonymization_rules: dict = None,
-                         delete_private_tags: bool = True) -> None:
+                         delete_private_tags: bool = True, defer_size=None, splice: bool = False) -> None:
     """
     Anonymize a DICOM file by modifying personal tags
 
@@ -299,49 +498,112 @@ def anonymize_dicom_file(in_file: str, out_file: str, extra_anonymization_rules:
     :param out_file: File path or file-like object to write to
     :param extra_anonymization_rules: add more tag's actions
     :param delete_private_tags: Define if private tags should be delete or not
+    :param defer_size: Values larger than this size in bytes are not read in memory but streamed to out_file
+    :param splice: Only re-encode the elements before the Pixel Data and copy the rest of in_file verbatim
+    """
+    get_anonymizer(extra_anonymization_rules, delete_private_tags).anonymize_dicom_file(in_file, out_file, defer_size,
+                                                                                         splice)
+
+
+def anonymize_buffers(buffers: Iterable, extra_anonymization_rules: dict = None, delete_private_tags: bool = True,
+                      as_datasets: bool = False) -> Iterator:
+    """
+    Anonymize DICOM files held in memory (bytes, memoryviews, buffers or file-like objects), as they are consumed
+
+    The rules are compiled once for the whole batch.
+
+    :param buffers: Iterable of file contents
+    :param extra_anonymization_rules: add more tag's actions
+    :param delete_private_tags: Define if private tags should be delete or not
+    :param as_datasets: Yield the anonymized datasets instead of their encoded content
+    """
+    return get_anonymizer(extra_anonymization_rules, delete_private_tags).anonymize_buffers(buffers, as_datasets)
+
+
+# Element numbers of the private creators of a group: (gggg,0010-00FF) reserves the block (gggg,xx00-xxFF)
+_PRIVATE_CREATOR_FIRST = 0x0010
+_PRIVATE_CREATOR_LAST = 0x00FF
+
+
+class PrivateCreatorIndex:
     """
-    dataset = pydicom.dcmread(in_file)
+    Private creators of a dataset, read once instead of scanning the creators of a group for each private tag
+
+    Maps (group, block) to the creator name and (group, creator name) to the block, where the block is the
+    element number of the creator, e.g. 0x0010 for the elements (gggg,1000-10FF).
+
+    :param dataset: Dicom dataset whose private creators are indexed, nested sequences excluded
+    """
+
+    def __init__(self, dataset: 'pydicom.Dataset' = None):
+        self._creators = {}
+        self._blocks = {}
+        if dataset is None:
+            return
+        # Keys of the dataset, the other elements are not converted
+        for key in list(dataset.keys()):
+            group, element = key >> 16, key & 0xFFFF
+            if group & 1 and _PRIVATE_CREATOR_FIRST <= element <= _PRIVATE_CREATOR_LAST:
+                self._add(group, element, dataset[key].value)
+
+    def _add(self, group: int, block: int, creator_name) -> None:
+        self._creators[(group, block)] = creator_name
+        self._blocks.setdefault((group, creator_name), block)
 
-    anonymize_dataset(dataset, extra_anonymization_rules, delete_private_tags)
+    def creator(self, group: int, block: int):
+        """
+        Name of the creator of a block, None if the block has no creator
+        """
+        return self._creators.get((group, block))
 
-    # Store modified image
-    dataset.save_as(out_file)
+    def block(self, group: int, creator_name) -> int:
+        """
+        First block of a creator, None if the creator is not in the group
+        """
+        return self._blocks.get((group, creator_name))
 
 
-def get_private_tag(dataset, tag):
+def get_private_tag(dataset, tag, creator_index: PrivateCreatorIndex = None):
     """
     Get the creator and element from tag
 
     :param dataset: Dicom dataset
     :param tag: Tag from which we want to extract private information
-    :return dictionary with creator of the tag and tag element (which contains element + offset)
+    :param creator_index: Private creators of the dataset, built from the dataset if not given
+    :return dictionary with creator of the tag (group, name and block) and tag element (which contains
+    element + offset)
     """
     element = dataset.get(tag)
 
-    element_value = element.value
     tag_group = element.tag.group
+    element_number = element.tag.element
     # The element is a private creator
-    if element_value in dataset.private_creators(tag_group):
+    if _PRIVATE_CREATOR_FIRST <= element_number <= _PRIVATE_CREATOR_LAST:
         creator = {
             "tagGroup": tag_group,
-            "creatorName": element.value
+            "creatorName": element.value,
+            "block": element_number
         }
         private_element = None
     # The element is a private element with an associated private creator
     else:
+        if creator_index is None:
+            creator_index = PrivateCreatorIndex(dataset)
         # Shift the element tag in order to get the create_tag
         # 0x1009 >> 8 will give 0x0010
-        create_tag_element = element.tag.element >> 8
-        create_tag = pydicom.tag.Tag(tag_group, create_tag_element)
-        create_dataset = dataset.get(create_tag)
+        create_tag_element = element_number >> 8
+        creator_name = creator_index.creator(tag_group, create_tag_element)
+        if creator_name is None:
+            raise KeyError('No private creator for the element {}'.format(tag_to_hex_strings(tag)))
         creator = {
             "tagGroup": tag_group,
-            "creatorName": create_dataset.value
+            "creatorName": creator_name,
+            "block": create_tag_element
         }
         # Define which offset should be applied to the creator to find
         # this element
         # 0x0010 << 8 will give 0x1000
-        offset_from_creator = element.tag.element - (create_tag_element << 8)
+        offset_from_creator = element_number - (create_tag_element << 8)
         private_element = {
             "element": element,
             "offset": offset_from_creator
@@ -353,7 +615,7 @@ def get_private_tag(dataset, tag):
     }
 
 
-def get_private_tags(anonymization_actions: dict, dataset: pydicom.Dataset) -> List[dict]:
+def get_private_tags(anonymization_actions: dict, dataset: 'pydicom.Dataset') -> List[dict]:
     """
     Extract private tag as a list of object with creator and element
 
@@ -362,19 +624,21 @@ def get_private_tags(anonymization_actions: dict, dataset: pydicom.Dataset) -> L
     :return Array of object
     """
     private_tags = []
+    creator_index = PrivateCreatorIndex(dataset)
     for tag, action in anonymization_actions.items():
+        element = None
         try:
             element = dataset.get(tag)
-        except:
-            print("Cannot get element from tag: ", tag_to_hex_strings(tag))
+        except Exception:
+            logger.warning('Cannot get element from tag: %s', tag_to_hex_strings(tag), exc_info=True)
 
         if element and element.tag.is_private:
-            private_tags.append(get_private_tag(dataset, tag))
+            private_tags.append(get_private_tag(dataset, tag, creator_index))
 
     return private_tags
 
 
-def anonymize_dataset(dataset: pydicom.Dataset, extra_anonymization_rules: dict = None,
+def anonymize_dataset(dataset: 'pydicom.Dataset', extra_anonymization_rules: dict = None,
                       delete_private_tags: bool = True) -> None:
     """
     Anonymize a pydicom Dataset by using anonymization rules which links an action to a tag
@@ -383,51 +647,4 @@ def anonymize_dataset(dataset: pydicom.Dataset, extra_anonymization_rules: dict
     :param extra_anonymization_rules: Rules to be applied on the dataset
     :param delete_private_tags: Define if private tags should be delete or not
     """
-    current_anonymization_actions = initialize_actions()
-
-    if extra_anonymization_rules is not None:
-        current_anonymization_actions.update(extra_anonymization_rules)
-
-    private_tags = []
-
-    for tag, action in current_anonymization_actions.items():
-
-        def range_callback(dataset, data_element):
-            if data_element.tag.group & tag[2] == tag[0] and data_element.tag.element & tag[3] == tag[1]:
-                action(dataset, (data_element.tag.group, data_element.tag.element))
-
-        element = None
-
-        # We are in a repeating group
-        if len(tag) > 2:
-            dataset.walk(range_callback)
-        # Individual Tags
-        else:
-            # From : https://github.com/KitwareMedical/dicom-anonymizer/pull/18
-            # The meta header information is located in the `file_meta` dataset
-            # For tags with tag group `0x0002` we thus apply the action to the `file_meta` dataset
-            if tag[0] == 0x0002:
-                # Apply rule to meta information header
-                action(dataset.file_meta, tag)
-            else:
-                action(dataset, tag)
-            try:
-                element = dataset.get(tag)
-            except:
-                print("Cannot get element from tag: ", tag_to_hex_strings(tag))
-
-            # Get private tag to restore it later
-            if element and element.tag.is_private:
-                private_tags.append(get_private_tag(dataset, tag))
-
-    # X - Private tags = (0xgggg, 0xeeee) where 0xgggg is odd
-    if delete_private_tags:
-        dataset.remove_private_tags()
-
-        # Adding back private tags if specified in dictionary
-        for privateTag in private_tags:
-            creator = privateTag["creator"]
-            element = privateTag["element"]
-            block = dataset.private_block(creator["tagGroup"], creator["creatorName"], create=True)
-            if element is not None:
-                block.add_new(element["offset"], element["element"].VR, element["element"].value)
+    get_anonymizer(extra_anonymization_rules, delete_private_tags).anonymize_dataset(dataset)
@@ -0,0 +1,121 @@
+"""
+UID map backends used by get_UID to keep replaced UIDs consistent.
+
+Any object with dict-like `get` and `setdefault` methods can be plugged with
+`simpledicomanonymizer.set_uid_map`. The default is an in-process dict.
+"""
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class SQLiteUIDMap:
+    """
+    Persistent UID map: a bounded in-memory LRU front on top of a SQLite file
+
+    New mappings are committed in batches, and on flush/close. The same file can be used
+    across runs (and processes) so that a study split across several runs keeps the same UIDs.
+
+    :param path: Path to the SQLite file, created if it does not exist
+    :param cache_size: Maximum number of mappings kept in memory
+    :param commit_every: Number of new mappings written before a commit. Use 1 when
+    several processes share the file so that each new mapping is visible to the others.
+    """
+
+    def __init__(self, path: str, cache_size: int = 100000, commit_every: int = 1000):
+        self.path = path
+        self.cache_size = cache_size
+        self.commit_every = commit_every
+
+        self._cache = OrderedDict()
+        self._pending = 0
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS uid_map '
+                                 '(old_uid TEXT PRIMARY KEY, new_uid TEXT NOT NULL) WITHOUT ROWID')
+        self._connection.commit()
+
+    def _remember(self, old_uid: str, new_uid: str) -> None:
+        self._cache[old_uid] = new_uid
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _select(self, old_uid: str):
+        row = self._connection.execute('SELECT new_uid FROM uid_map WHERE old_uid = ?', (old_uid,)).fetchone()
+        return None if row is None else row[0]
+
+    def get(self, old_uid: str, default=None):
+        with self._lock:
+            new_uid = self._cache.get(old_uid)
+            if new_uid is not None:
+                self._cache.move_to_end(old_uid)
+                return new_uid
+
+            new_uid = self._select(old_uid)
+            if new_uid is None:
+                return default
+            self._remember(old_uid, new_uid)
+            return new_uid
+
+    def setdefault(self, old_uid: str, new_uid: str) -> str:
+        """
+        Store new_uid for old_uid unless a mapping already exists, and return the stored one
+        """
+        with self._lock:
+            existing_uid = self.get(old_uid)
+            if existing_uid is not None:
+                return existing_uid
+
+            cursor = self._connection.execute('INSERT OR IGNORE INTO uid_map VALUES (?, ?)', (old_uid, str(new_uid)))
+            if cursor.rowcount == 0:
+                # Another process stored a mapping in the meantime
+                new_uid = self._select(old_uid)
+            else:
+                self._pending += 1
+                if self._pending >= self.commit_every:
+                    self.flush()
+            new_uid = str(new_uid)
+            self._remember(old_uid, new_uid)
+            return new_uid
+
+    def __getitem__(self, old_uid: str) -> str:
+        new_uid = self.get(old_uid)
+        if new_uid is None:
+            raise KeyError(old_uid)
+        return new_uid
+
+    def __setitem__(self, old_uid: str, new_uid: str) -> None:
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO uid_map VALUES (?, ?)', (old_uid, str(new_uid)))
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self.flush()
+            self._remember(old_uid, str(new_uid))
+
+    def __contains__(self, old_uid: str) -> bool:
+        return self.get(old_uid) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM uid_map').fetchone()[0]
+
+    def flush(self) -> None:
+        """
+        Commit the pending mappings to disk
+        """
+        with self._lock:
+            self._connection.commit()
+            self._pending = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
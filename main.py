@@ -1,4 +1,22 @@
-from dicomanonymizer.gui import main
+import multiprocessing
+import os
+
+ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 
 if __name__ == "__main__":
-    main()
+    # Worker processes of the frozen application start from this executable
+    multiprocessing.freeze_support()
+
+    # Show a splash screen as soon as Qt is loaded, the anonymization modules and pydicom are imported behind it
+    from PySide2.QtCore import Qt
+    from PySide2.QtGui import QPixmap
+    from PySide2.QtWidgets import QApplication, QSplashScreen
+
+    app = QApplication([])
+    splash = QSplashScreen(QPixmap(os.path.join(ROOT_PATH, 'images', 'app_icon_128.png')), Qt.WindowStaysOnTopHint)
+    splash.showMessage('Loading...', Qt.AlignBottom | Qt.AlignHCenter)
+    splash.show()
+    app.processEvents()
+
+    from dicomanonymizer.gui import main
+    main(splash)
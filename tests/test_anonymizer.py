@@ -0,0 +1,50 @@
+import pytest
+from pydicom.data import get_testdata_file
+
+from dicomanonymizer.anonymizer import anonymize_in_pool
+from dicomanonymizer.engine import Anonymizer
+from dicomanonymizer.simpledicomanonymizer import set_uid_key
+
+TEST_FILES = ['CT_small.dcm', 'MR_small.dcm', 'rtplan.dcm', 'rtdose.dcm', 'test-SR.dcm', 'liver_1frame.dcm']
+UID_KEY = b'test key'
+
+
+def _paths(folder) -> list:
+    folder.mkdir()
+    return [(get_testdata_file(file_name), str(folder / file_name)) for file_name in TEST_FILES]
+
+
+def _read(paths: list) -> list:
+    contents = []
+    for _, out_file in paths:
+        with open(out_file, 'rb') as out:
+            contents.append(out.read())
+    return contents
+
+
+def _anonymize_serially(anonymizer: Anonymizer, paths: list) -> None:
+    set_uid_key(UID_KEY)
+    try:
+        for in_file, out_file in paths:
+            anonymizer.anonymize_dicom_file(in_file, out_file)
+    finally:
+        set_uid_key(None)
+
+
+@pytest.mark.parametrize('affinity', [None, 'study', 'directory'])
+def test_pool_output_is_the_serial_output(tmp_path, affinity):
+    anonymizer = Anonymizer()
+    serial_paths = _paths(tmp_path / 'serial')
+    _anonymize_serially(anonymizer, serial_paths)
+
+    pool_paths = _paths(tmp_path / 'pool')
+    assert anonymize_in_pool(anonymizer, iter(pool_paths), 2, uid_key=UID_KEY, chunk_size=2, affinity=affinity)
+    assert _read(pool_paths) == _read(serial_paths)
+
+
+def test_pool_without_key_keeps_uids_consistent(tmp_path):
+    # The same input twice in a run, processed by any of the workers, gets the same UIDs
+    paths = _paths(tmp_path / 'first') + _paths(tmp_path / 'second')
+    assert anonymize_in_pool(Anonymizer(), iter(paths), 2, chunk_size=1)
+    contents = _read(paths)
+    assert contents[:len(TEST_FILES)] == contents[len(TEST_FILES):]
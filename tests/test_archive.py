@@ -0,0 +1,62 @@
+import io
+import tarfile
+import zipfile
+
+import pytest
+from pydicom.data import get_testdata_file
+
+from dicomanonymizer.archive import anonymize_archive
+from dicomanonymizer.engine import Anonymizer
+
+
+def _content() -> bytes:
+    with open(get_testdata_file('CT_small.dcm'), 'rb') as dicom_file:
+        return dicom_file.read()
+
+
+def _write_tar(path: str, names: list) -> None:
+    content = _content()
+    with tarfile.open(path, 'w') as tar:
+        for name in names:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+def test_tar_to_folder(tmp_path):
+    _write_tar(str(tmp_path / 'in.tar'), ['study/series/1.dcm', './2.dcm'])
+    anonymize_archive(Anonymizer(), str(tmp_path / 'in.tar'), str(tmp_path / 'out'))
+    assert (tmp_path / 'out' / 'study' / 'series' / '1.dcm').exists()
+    assert (tmp_path / 'out' / '2.dcm').exists()
+
+
+@pytest.mark.parametrize('name', ['../../x.dcm', 'study/../../x.dcm', '/tmp/x.dcm', '..\\x.dcm'])
+def test_tar_member_outside_of_the_folder(tmp_path, name):
+    _write_tar(str(tmp_path / 'in.tar'), [name])
+    with pytest.raises(ValueError, match='Unsafe member name'):
+        anonymize_archive(Anonymizer(), str(tmp_path / 'in.tar'), str(tmp_path / 'a' / 'out'))
+    assert list((tmp_path / 'a' / 'out').iterdir()) == []
+    assert not (tmp_path / 'x.dcm').exists()
+
+
+def test_zip_member_outside_of_the_folder(tmp_path):
+    with zipfile.ZipFile(str(tmp_path / 'in.zip'), 'w') as archive:
+        archive.writestr('../x.dcm', _content())
+    with pytest.raises(ValueError, match='Unsafe member name'):
+        anonymize_archive(Anonymizer(), str(tmp_path / 'in.zip'), str(tmp_path / 'out'))
+    assert not (tmp_path / 'x.dcm').exists()
+
+
+def test_member_which_cannot_be_anonymized(tmp_path, caplog):
+    with zipfile.ZipFile(str(tmp_path / 'in.zip'), 'w') as archive:
+        archive.writestr('1.dcm', _content())
+        archive.writestr('README.txt', b'Not a DICOM file')
+        archive.writestr('2.dcm', _content())
+
+    failed = anonymize_archive(Anonymizer(), str(tmp_path / 'in.zip'), str(tmp_path / 'out.zip'))
+
+    assert failed == 1
+    assert 'README.txt' in caplog.text
+    with zipfile.ZipFile(str(tmp_path / 'out.zip')) as archive:
+        assert archive.namelist() == ['1.dcm', '2.dcm']
+        assert archive.testzip() is None
@@ -0,0 +1,59 @@
+import filecmp
+import shutil
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dicomanonymizer.dicomio import save_dataset
+from dicomanonymizer.engine import Anonymizer
+from dicomanonymizer.simpledicomanonymizer import set_uid_key
+
+
+@pytest.fixture
+def keyed_uids():
+    # Same new UIDs for the same input, so that two runs give the same output
+    set_uid_key(b'test key')
+    yield
+    set_uid_key(None)
+
+
+def test_deferred_values_in_place(tmp_path, keyed_uids):
+    in_file = str(tmp_path / 'CT_small.dcm')
+    out_file = str(tmp_path / 'anonymized.dcm')
+    shutil.copy(get_testdata_file('CT_small.dcm'), in_file)
+    anonymizer = Anonymizer()
+
+    anonymizer.anonymize_dicom_file(in_file, out_file, defer_size=1024)
+    anonymizer.anonymize_dicom_file(in_file, in_file, defer_size=1024)
+
+    assert filecmp.cmp(in_file, out_file, shallow=False)
+    assert [path.name for path in tmp_path.iterdir() if path.suffix == '.tmp'] == []
+
+
+def test_splice_in_place(tmp_path, keyed_uids):
+    in_file = str(tmp_path / 'CT_small.dcm')
+    out_file = str(tmp_path / 'anonymized.dcm')
+    shutil.copy(get_testdata_file('CT_small.dcm'), in_file)
+    anonymizer = Anonymizer()
+    # The Pixel Data is copied from the input file
+    assert anonymizer.read_dicom_file(in_file, splice=True)[1] is not None
+
+    anonymizer.anonymize_dicom_file(in_file, out_file, splice=True)
+    anonymizer.anonymize_dicom_file(in_file, in_file, splice=True)
+
+    assert filecmp.cmp(in_file, out_file, shallow=False)
+
+
+def test_failed_save_keeps_the_output(tmp_path):
+    out_file = tmp_path / 'anonymized.dcm'
+    out_file.write_bytes(b'previous output')
+    dataset = pydicom.dcmread(get_testdata_file('CT_small.dcm'))
+    # Not a number, cannot be written as US
+    dataset.add_new(0x00091002, 'US', 'text')
+
+    with pytest.raises(Exception):
+        save_dataset(dataset, str(out_file))
+
+    assert out_file.read_bytes() == b'previous output'
+    assert [path.name for path in tmp_path.iterdir() if path.suffix == '.tmp'] == []
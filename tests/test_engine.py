@@ -0,0 +1,84 @@
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+from dicomanonymizer.engine import Anonymizer
+from dicomanonymizer.simpledicomanonymizer import keep, set_uid_key
+
+# Nested sequences (rtplan, rtdose, test-SR, liver), private tags (CT_small, MR_small)
+TEST_FILES = ['CT_small.dcm', 'MR_small.dcm', 'rtplan.dcm', 'rtdose.dcm', 'test-SR.dcm', 'liver_1frame.dcm']
+
+
+@pytest.fixture
+def keyed_uids():
+    set_uid_key(b'test key')
+    yield
+    set_uid_key(None)
+
+
+def _anonymize(dataset: Dataset, single_pass: bool, rules: dict = None, delete_private_tags: bool = True) -> Dataset:
+    Anonymizer(rules, delete_private_tags, single_pass).anonymize_dataset(dataset)
+    return dataset
+
+
+def _private_tags(dataset: Dataset) -> set:
+    return {element.tag for element in dataset.iterall() if element.tag.is_private}
+
+
+@pytest.mark.parametrize('file_name', TEST_FILES)
+def test_single_pass_top_level_matches_rules(file_name, keyed_uids):
+    path = get_testdata_file(file_name)
+    by_rules = _anonymize(pydicom.dcmread(path), False)
+    single_pass = _anonymize(pydicom.dcmread(path), True)
+
+    assert by_rules.file_meta == single_pass.file_meta
+    assert list(by_rules.keys()) == list(single_pass.keys())
+    for element in by_rules:
+        if element.VR != 'SQ':
+            assert single_pass[element.tag] == element
+
+
+@pytest.mark.parametrize('file_name', TEST_FILES)
+def test_private_tags_are_deleted_in_both_modes(file_name, keyed_uids):
+    path = get_testdata_file(file_name)
+    assert _private_tags(_anonymize(pydicom.dcmread(path), False)) == set()
+    assert _private_tags(_anonymize(pydicom.dcmread(path), True)) == set()
+
+    kept = _private_tags(pydicom.dcmread(path))
+    assert _private_tags(_anonymize(pydicom.dcmread(path), False, delete_private_tags=False)) == kept
+    assert _private_tags(_anonymize(pydicom.dcmread(path), True, delete_private_tags=False)) == kept
+
+
+def test_single_pass_anonymizes_nested_sequences(keyed_uids):
+    path = get_testdata_file('rtplan.dcm')
+    assert pydicom.dcmread(path).BeamSequence[0].InstitutionName == 'Here'
+    # The rules apply to the top level elements
+    assert _anonymize(pydicom.dcmread(path), False).BeamSequence[0].InstitutionName == 'Here'
+    assert _anonymize(pydicom.dcmread(path), True).BeamSequence[0].InstitutionName == 'Anonymized'
+
+
+def _dataset_with_private_tags() -> Dataset:
+    dataset = Dataset()
+    dataset.file_meta = pydicom.dataset.FileMetaDataset()
+    dataset.PatientName = 'Doe^John'
+    dataset.add_new((0x0009, 0x0010), 'LO', 'ACME 1')
+    dataset.add_new((0x0009, 0x0011), 'LO', 'ACME 2')
+    dataset.add_new((0x0009, 0x1001), 'LO', 'kept')
+    dataset.add_new((0x0009, 0x1002), 'LO', 'deleted')
+    dataset.add_new((0x0009, 0x1101), 'LO', 'deleted')
+    item = Dataset()
+    item.add_new((0x0011, 0x0010), 'LO', 'NESTED')
+    item.add_new((0x0011, 0x1001), 'LO', 'deleted')
+    item.PatientID = '123'
+    dataset.add_new((0x0008, 0x1140), 'SQ', Sequence([item]))
+    return dataset
+
+
+@pytest.mark.parametrize('single_pass', [False, True])
+def test_private_tags_with_a_rule_are_kept(single_pass):
+    dataset = _anonymize(_dataset_with_private_tags(), single_pass, {(0x0009, 0x1001): keep})
+    assert _private_tags(dataset) == {0x00090010, 0x00091001}
+    assert dataset[0x00091001].value == 'kept'
+    assert dataset.PatientName == ''
@@ -0,0 +1,34 @@
+import shutil
+
+from pydicom.data import get_testdata_file
+
+from dicomanonymizer.engine import Anonymizer
+from dicomanonymizer.manifest import RunManifest, anonymize_and_describe
+
+
+def _run(manifest_path: str, paths: list) -> list:
+    anonymizer = Anonymizer()
+    with RunManifest(manifest_path, anonymizer.fingerprint) as manifest:
+        pending = list(manifest.pending(paths))
+        for in_file, out_file in pending:
+            manifest.record(anonymize_and_describe(anonymizer, in_file, out_file))
+    return pending
+
+
+def test_resume_skips_done_files(tmp_path):
+    in_file = str(tmp_path / 'CT_small.dcm')
+    shutil.copy(get_testdata_file('CT_small.dcm'), in_file)
+    paths = [(in_file, str(tmp_path / 'anonymized.dcm'))]
+
+    assert _run(str(tmp_path / 'manifest.db'), paths) == paths
+    assert _run(str(tmp_path / 'manifest.db'), paths) == []
+
+
+def test_resume_to_another_output(tmp_path):
+    in_file = str(tmp_path / 'CT_small.dcm')
+    shutil.copy(get_testdata_file('CT_small.dcm'), in_file)
+    _run(str(tmp_path / 'manifest.db'), [(in_file, str(tmp_path / 'first.dcm'))])
+
+    paths = [(in_file, str(tmp_path / 'second.dcm'))]
+    assert _run(str(tmp_path / 'manifest.db'), paths) == paths
+    assert (tmp_path / 'second.dcm').exists()
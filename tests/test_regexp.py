@@ -0,0 +1,87 @@
+import json
+import pickle
+
+import pydicom
+import pytest
+
+from dicomanonymizer.engine import Anonymizer
+from dicomanonymizer.ruleset import load_ruleset
+from dicomanonymizer.simpledicomanonymizer import merge_actions, regexp
+
+PATIENT_NAME = (0x0010, 0x0010)
+
+
+def _dataset(patient_name: str) -> pydicom.Dataset:
+    dataset = pydicom.Dataset()
+    dataset.file_meta = pydicom.dataset.FileMetaDataset()
+    dataset.PatientName = patient_name
+    return dataset
+
+
+def _chained_rules() -> dict:
+    rules = {}
+    merge_actions(rules, {PATIENT_NAME: regexp({'find': 'a', 'replace': 'b'})})
+    merge_actions(rules, {PATIENT_NAME: regexp({'find': 'b', 'replace': 'c'})})
+    return rules
+
+
+def test_regexp_rules_are_chained():
+    # Each rule is applied to the result of the previous one, whatever the patterns
+    rules = _chained_rules()
+    dataset = _dataset('ab')
+    rules[PATIENT_NAME](dataset, PATIENT_NAME)
+    assert dataset.PatientName == 'cc'
+
+    dataset = _dataset('ab')
+    Anonymizer(rules).anonymize_dataset(dataset)
+    assert dataset.PatientName == 'cc'
+
+    dataset = _dataset('ab')
+    Anonymizer(rules, single_pass=True).anonymize_dataset(dataset)
+    assert dataset.PatientName == 'cc'
+
+
+def test_regexp_rules_with_flags_are_chained():
+    rules = {}
+    merge_actions(rules, {PATIENT_NAME: regexp({'find': '(?i)A', 'replace': 'b'})})
+    merge_actions(rules, {PATIENT_NAME: regexp({'find': 'b', 'replace': 'c'})})
+    dataset = _dataset('ab')
+    Anonymizer(rules).anonymize_dataset(dataset)
+    assert dataset.PatientName == 'cc'
+
+
+def test_regexp_rules_of_a_dictionary_are_chained(tmp_path):
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps({'(0x0010, 0x0010)': {'action': 'regexp', 'find': 'a', 'replace': 'b'}}))
+    rules = load_ruleset(str(path), cache_dir=None)
+    merge_actions(rules, {PATIENT_NAME: regexp({'find': 'b', 'replace': 'c'})})
+    dataset = _dataset('ab')
+    Anonymizer(rules).anonymize_dataset(dataset)
+    assert dataset.PatientName == 'cc'
+
+
+def test_regexp_fingerprint_is_stable():
+    assert Anonymizer(_chained_rules()).fingerprint == Anonymizer(_chained_rules()).fingerprint
+
+
+def test_regexp_is_compiled_once(monkeypatch):
+    action = regexp({'find': 'a', 'replace': 'b'})
+
+    def compile_regexp(options):
+        raise AssertionError('compiled again')
+
+    monkeypatch.setattr('dicomanonymizer.simpledicomanonymizer.compile_regexp', compile_regexp)
+    dataset = _dataset('ab')
+    action(dataset, PATIENT_NAME)
+    assert dataset.PatientName == 'bb'
+    # Sent to the worker processes
+    dataset = _dataset('ab')
+    pickle.loads(pickle.dumps(action))(dataset, PATIENT_NAME)
+    assert dataset.PatientName == 'bb'
+
+
+def test_invalid_regexp_of_a_dictionary(tmp_path):
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps({'(0x0010, 0x0010)': {'action': 'regexp', 'find': '(', 'replace': 'b'}}))
+    with pytest.raises(ValueError, match='invalid regexp'):
+        load_ruleset(str(path), cache_dir=None)
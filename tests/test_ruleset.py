@@ -0,0 +1,32 @@
+import json
+
+import pytest
+
+from dicomanonymizer import simpledicomanonymizer
+from dicomanonymizer.ruleset import load_ruleset, resolve_action
+
+# Action names accepted by the dictionaries before they were compiled: the functions of
+# simpledicomanonymizer applied to (dataset, tag)
+BASELINE_ACTION_NAMES = [
+    'replace', 'empty', 'delete', 'replace_UID', 'empty_or_replace', 'delete_or_empty', 'delete_or_replace',
+    'delete_or_empty_or_replace', 'delete_or_empty_or_replace_UID', 'keep', 'clean',
+]
+
+
+@pytest.mark.parametrize('action_name', BASELINE_ACTION_NAMES)
+def test_baseline_action_names(tmp_path, action_name):
+    assert resolve_action(action_name) is getattr(simpledicomanonymizer, action_name)
+
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps({'(0x0010, 0x0010)': action_name}))
+    for _ in range(2):
+        # Compiled, then loaded from the cache
+        rules = load_ruleset(str(path), cache_dir=str(tmp_path / 'cache'))
+        assert rules == {(0x0010, 0x0010): getattr(simpledicomanonymizer, action_name)}
+
+
+def test_unknown_action_name(tmp_path):
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps({'(0x0010, 0x0010)': 'remove'}))
+    with pytest.raises(ValueError, match='Unknown action'):
+        load_ruleset(str(path), cache_dir=None)
@@ -0,0 +1,61 @@
+import csv
+import shutil
+
+import pydicom
+from pydicom.data import get_testdata_file
+
+from dicomanonymizer.scan import PRIVATE, PRIVATE_CREATOR, REPEATING_GROUP, TAG, scan, write_report
+
+
+def _row(inventory, kind: str, tag: str, private_creator: str = '') -> dict:
+    rows = [row for row in inventory.rows()
+            if (row['kind'], row['tag'], row['private_creator']) == (kind, tag, private_creator)]
+    assert len(rows) == 1
+    return rows[0]
+
+
+def test_counts_of_a_file():
+    inventory = scan(get_testdata_file('CT_small.dcm'))
+    assert (inventory.files, inventory.failed) == (1, 0)
+
+    patient_name = _row(inventory, TAG, '(0010,0010)')
+    assert (patient_name['keyword'], patient_name['action'], patient_name['vrs']) == ('PatientName', 'empty', 'PN')
+    # Also found in a nested sequence
+    assert _row(inventory, TAG, '(0010,0020)')['occurrences'] == 3
+    assert _row(inventory, PRIVATE_CREATOR, '(0009,00xx)', 'GEMS_IDEN_01')['occurrences'] == 1
+    assert _row(inventory, PRIVATE, '(0009,xx01)', 'GEMS_IDEN_01')['vrs'] == 'LO'
+
+
+def test_repeating_group(tmp_path):
+    dataset = pydicom.dcmread(get_testdata_file('CT_small.dcm'))
+    dataset.add_new(0x60003000, 'OW', b'\0\0')
+    dataset.add_new(0x60023000, 'OW', b'\0\0')
+    dataset.save_as(str(tmp_path / 'overlays.dcm'))
+
+    inventory = scan(str(tmp_path / 'overlays.dcm'))
+    rows = [row for row in inventory.rows() if row['kind'] == REPEATING_GROUP]
+    assert [(row['tag'], row['occurrences'], row['vrs']) for row in rows] == [('(60xx,3000)', 2, 'OW')]
+
+
+def test_folder_with_workers(tmp_path):
+    (tmp_path / 'study').mkdir()
+    shutil.copy(get_testdata_file('CT_small.dcm'), str(tmp_path / 'CT_small.dcm'))
+    shutil.copy(get_testdata_file('rtplan.dcm'), str(tmp_path / 'study' / 'rtplan.dcm'))
+    (tmp_path / 'study' / 'README.dcm').write_bytes(b'Not a DICOM file')
+
+    inventory = scan(str(tmp_path))
+    assert (inventory.files, inventory.failed) == (2, 1)
+    # Once in each file
+    assert _row(inventory, TAG, '(0008,0016)')['files'] == 2
+    # Merged from the worker processes
+    assert scan(str(tmp_path), workers=2, chunk_size=1).rows() == inventory.rows()
+
+
+def test_csv_report(tmp_path):
+    inventory = scan(get_testdata_file('rtplan.dcm'))
+    write_report(inventory, str(tmp_path / 'inventory.csv'))
+
+    with open(str(tmp_path / 'inventory.csv'), newline='', encoding='utf-8') as report_file:
+        rows = list(csv.DictReader(report_file))
+    assert len(rows) == len(inventory)
+    assert rows[0] == {key: str(value) for key, value in inventory.rows()[0].items()}
@@ -0,0 +1,46 @@
+import pydicom
+from pydicom.data import get_testdata_file
+
+from dicomanonymizer.scheduler import group_by_directory, group_by_study, pack_groups
+
+
+def _write(path, study_instance_uid: str) -> tuple:
+    dataset = pydicom.dcmread(get_testdata_file('CT_small.dcm'))
+    dataset.StudyInstanceUID = study_instance_uid
+    dataset.save_as(str(path))
+    return str(path), str(path) + '.out'
+
+
+def test_group_by_study(tmp_path):
+    paths = [_write(tmp_path / '{}.dcm'.format(i), study) for i, study in enumerate(['1.1', '1.2', '1.1', '1.1', '1.2'])]
+    (tmp_path / 'README.dcm').write_bytes(b'Not a DICOM file')
+    paths.append((str(tmp_path / 'README.dcm'), ''))
+
+    # Largest study first, files which cannot be read on their own
+    assert list(group_by_study(paths)) == [[paths[0], paths[2], paths[3]], [paths[1], paths[4]], [paths[5]]]
+
+
+def test_group_by_study_reads_a_window_at_a_time(tmp_path):
+    paths = [_write(tmp_path / '{}.dcm'.format(i), '1.1') for i in range(5)]
+    consumed = []
+
+    def discovered():
+        for paths_item in paths:
+            consumed.append(paths_item)
+            yield paths_item
+
+    groups = group_by_study(discovered(), window=2)
+    assert next(groups) == paths[:2]
+    assert len(consumed) == 2
+    assert list(groups) == [paths[2:4], paths[4:]]
+
+
+def test_group_by_directory():
+    paths = [('a/1.dcm', ''), ('a/2.dcm', ''), ('b/1.dcm', ''), ('a/3.dcm', '')]
+    assert list(group_by_directory(paths)) == [paths[:2], paths[2:3], paths[3:]]
+
+
+def test_pack_groups():
+    groups = [[1, 2, 3], [4], [5, 6, 7, 8, 9], [10, 11]]
+    # Groups are not split, a group larger than the task size is a task on its own
+    assert list(pack_groups(groups, 4)) == [[1, 2, 3, 4], [5, 6, 7, 8, 9], [10, 11]]
@@ -0,0 +1,91 @@
+import io
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dicomanonymizer.scp import AnonymizingStorageSCP
+
+
+def _encoded(study_instance_uid: str, sop_instance_uid: str) -> bytes:
+    dataset = pydicom.dcmread(get_testdata_file('CT_small.dcm'))
+    dataset.StudyInstanceUID = study_instance_uid
+    dataset.SOPInstanceUID = sop_instance_uid
+    out_file = io.BytesIO()
+    dataset.save_as(out_file)
+    return out_file.getvalue()
+
+
+def _scp(output_folder: str) -> AnonymizingStorageSCP:
+    # Without pynetdicom: only the writing of the received instances is used
+    scp = AnonymizingStorageSCP.__new__(AnonymizingStorageSCP)
+    scp.output_folder = output_folder
+    return scp
+
+
+def test_write_instance(tmp_path):
+    _scp(str(tmp_path))._write(_encoded('1.2.3', '1.2.3.4'))
+    assert (tmp_path / '1.2.3' / '1.2.3.4.dcm').exists()
+
+
+@pytest.mark.parametrize('study_instance_uid,sop_instance_uid', [
+    ('../../evil', '1.2.3.4'),
+    ('..', '..'),
+    ('1.2.3', '../../../evil'),
+    ('1.2.3', '/tmp/evil'),
+])
+def test_write_instance_with_invalid_uids(tmp_path, study_instance_uid, sop_instance_uid):
+    output_folder = tmp_path / 'a' / 'b' / 'out'
+    _scp(str(output_folder))._write(_encoded(study_instance_uid, sop_instance_uid))
+    written = [path for path in tmp_path.rglob('*.dcm')]
+    assert len(written) == 1
+    assert output_folder in written[0].parents
+
+
+@pytest.fixture
+def storage_scp():
+    # Forward SCP accepting only the CT images, keeping what it receives
+    pynetdicom = pytest.importorskip('pynetdicom')
+    from pynetdicom.sop_class import CTImageStorage
+    received = []
+
+    def handle_store(event):
+        received.append(event.dataset)
+        return 0x0000
+
+    ae = pynetdicom.AE(ae_title='STORE-SCP')
+    ae.add_supported_context(CTImageStorage, pynetdicom.ALL_TRANSFER_SYNTAXES)
+    server = ae.start_server(('127.0.0.1', 0), block=False, evt_handlers=[(pynetdicom.evt.EVT_C_STORE, handle_store)])
+    yield server.server_address, received
+    server.shutdown()
+
+
+def test_forward_instances(tmp_path, storage_scp):
+    pynetdicom = pytest.importorskip('pynetdicom')
+    from dicomanonymizer.engine import Anonymizer
+    forward_address, received = storage_scp
+    scp = AnonymizingStorageSCP(Anonymizer(), forward_address=forward_address, forward_ae_title='STORE-SCP')
+    server = scp.start('127.0.0.1', 0, block=False)
+    try:
+        ct = pydicom.dcmread(get_testdata_file('CT_small.dcm'))
+        mr = pydicom.dcmread(get_testdata_file('MR_small.dcm'))
+        ae = pynetdicom.AE(ae_title='STORE-SCU')
+        for dataset in (ct, mr):
+            ae.add_requested_context(dataset.SOPClassUID, dataset.file_meta.TransferSyntaxUID)
+        association = ae.associate(*server.server_address[:2])
+        assert association.is_established
+        try:
+            assert association.send_c_store(ct).Status == 0x0000
+            # Refused by the forward SCP
+            assert association.send_c_store(mr).Status == 0x0122
+            assert association.send_c_store(ct).Status == 0x0000
+        finally:
+            association.release()
+    finally:
+        scp.stop()
+
+    assert len(received) == 2
+    assert received[0].PatientName != ct.PatientName
+    assert received[0].SOPInstanceUID != ct.SOPInstanceUID
+    assert received[0].SOPInstanceUID == received[1].SOPInstanceUID
+    assert (scp.received, scp.failed) == (3, 1)
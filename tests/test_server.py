@@ -0,0 +1,74 @@
+import io
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dicomanonymizer.engine import Anonymizer
+from dicomanonymizer.server import AnonymizationServer, _format_multipart, _parse_multipart
+
+
+@pytest.fixture
+def server():
+    server = AnonymizationServer(('127.0.0.1', 0), Anonymizer())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _content(file_name: str) -> bytes:
+    with open(get_testdata_file(file_name), 'rb') as dicom_file:
+        return dicom_file.read()
+
+
+def _post(server, body: bytes, content_type: str = 'application/dicom'):
+    url = 'http://{}:{}/anonymize'.format(*server.server_address[:2])
+    request = urllib.request.Request(url, body, {'Content-Type': content_type})
+    with urllib.request.urlopen(request) as response:
+        return response.headers['Content-Type'], response.read()
+
+
+def _assert_anonymized(anonymized: pydicom.Dataset, original: pydicom.Dataset) -> None:
+    assert anonymized.PatientName != original.PatientName
+    assert anonymized.PatientID != original.PatientID
+    assert anonymized.StudyInstanceUID != original.StudyInstanceUID
+    assert anonymized.SOPInstanceUID != original.SOPInstanceUID
+    assert anonymized.PixelData == original.PixelData
+
+
+def test_single_file(server):
+    content_type, body = _post(server, _content('CT_small.dcm'))
+    assert content_type == 'application/dicom'
+    _assert_anonymized(pydicom.dcmread(io.BytesIO(body)), pydicom.dcmread(get_testdata_file('CT_small.dcm')))
+
+
+def test_multipart_uids_consistent_across_requests(server):
+    file_names = ['CT_small.dcm', 'MR_small.dcm']
+    body = _format_multipart([_content(file_name) for file_name in file_names], 'boundary')
+    content_type, response = _post(server, body, 'multipart/related; type="application/dicom"; boundary=boundary')
+    assert content_type.startswith('multipart/related')
+    datasets = [pydicom.dcmread(io.BytesIO(part)) for part in _parse_multipart(content_type, response)]
+    assert len(datasets) == len(file_names)
+    for dataset, file_name in zip(datasets, file_names):
+        _assert_anonymized(dataset, pydicom.dcmread(get_testdata_file(file_name)))
+
+    # The same UIDs are given to the same input in a later request
+    _, body = _post(server, _content('CT_small.dcm'))
+    single = pydicom.dcmread(io.BytesIO(body))
+    assert single.StudyInstanceUID == datasets[0].StudyInstanceUID
+    assert single.SOPInstanceUID == datasets[0].SOPInstanceUID
+
+
+def test_not_a_dicom_file(server):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        _post(server, b'Not a DICOM file')
+    assert error.value.code == 400
+    assert 'InvalidDicomError' in json.loads(error.value.read())['error']
+    assert server.stats.report()['errors'] == 1
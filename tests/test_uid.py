@@ -0,0 +1,34 @@
+import pytest
+from pydicom.uid import UID
+
+from dicomanonymizer.simpledicomanonymizer import DEFAULT_UID_ROOT, generate_keyed_UID, set_uid_key
+
+# 25 characters, the longest root accepted
+LONG_ROOT = '1.2.826.0.1.3680043.9999.'
+
+
+def test_keyed_uids_are_deterministic():
+    assert generate_keyed_UID('1.2.3.4', b'key') == generate_keyed_UID('1.2.3.4', b'key')
+    assert generate_keyed_UID('1.2.3.4', b'key', LONG_ROOT) == generate_keyed_UID('1.2.3.4', b'key', LONG_ROOT)
+
+
+def test_keyed_uids_depend_on_the_key():
+    assert generate_keyed_UID('1.2.3.4', b'key') != generate_keyed_UID('1.2.3.4', b'other key')
+    assert generate_keyed_UID('1.2.3.4', b'key', LONG_ROOT) != generate_keyed_UID('1.2.3.4', b'other key', LONG_ROOT)
+
+
+@pytest.mark.parametrize('root', [DEFAULT_UID_ROOT, LONG_ROOT])
+def test_keyed_uids_do_not_collide(root):
+    old_uids = ['1.2.840.113619.2.55.3.{}'.format(number) for number in range(100000)]
+    new_uids = {generate_keyed_UID(old_uid, b'key', root) for old_uid in old_uids}
+    assert len(new_uids) == len(old_uids)
+    for new_uid in list(new_uids)[:1000]:
+        assert len(new_uid) <= 64 and new_uid.startswith(root) and UID(new_uid).is_valid
+
+
+def test_long_uid_root_is_rejected():
+    root = '1.2.826.0.1.3680043.9999.1234567890.1234567890.'
+    with pytest.raises(ValueError, match='too long'):
+        set_uid_key(b'key', root)
+    with pytest.raises(ValueError, match='too long'):
+        generate_keyed_UID('1.2.3.4', b'key', root)
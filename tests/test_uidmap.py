@@ -0,0 +1,46 @@
+import multiprocessing
+
+import pytest
+
+from dicomanonymizer.simpledicomanonymizer import get_UID, set_uid_map
+from dicomanonymizer.uidmap import SQLiteUIDMap
+
+
+def _map_uids(path: str, old_uids: list) -> list:
+    with SQLiteUIDMap(path, commit_every=1) as uid_map:
+        previous_uid_map = set_uid_map(uid_map)
+        try:
+            return [get_UID(old_uid) for old_uid in old_uids]
+        finally:
+            set_uid_map(previous_uid_map)
+
+
+def test_uids_are_kept_across_runs(tmp_path):
+    path = str(tmp_path / 'uids.db')
+    first_run = _map_uids(path, ['1.2.3', '1.2.4', '1.2.3'])
+    assert first_run[0] == first_run[2] != first_run[1]
+    assert _map_uids(path, ['1.2.4', '1.2.3']) == [first_run[1], first_run[0]]
+
+
+def test_uids_are_kept_across_processes(tmp_path):
+    path = str(tmp_path / 'uids.db')
+    old_uids = ['1.2.{}'.format(number) for number in range(50)]
+    with multiprocessing.Pool(2) as pool:
+        results = pool.starmap(_map_uids, [(path, old_uids), (path, list(reversed(old_uids)))])
+    assert results[0] == list(reversed(results[1]))
+    assert len(set(results[0])) == len(old_uids)
+
+
+def test_least_recently_used_uids_are_evicted(tmp_path):
+    with SQLiteUIDMap(str(tmp_path / 'uids.db'), cache_size=2) as uid_map:
+        uid_map.setdefault('1.1', '9.1')
+        uid_map.setdefault('1.2', '9.2')
+        assert uid_map.get('1.1') == '9.1'
+        uid_map.setdefault('1.3', '9.3')
+        assert list(uid_map._cache) == ['1.1', '1.3']
+        # Evicted mappings are read back from the file
+        assert uid_map.get('1.2') == '9.2'
+        assert uid_map.setdefault('1.2', '0.0') == '9.2'
+        assert len(uid_map) == 3
+        with pytest.raises(KeyError):
+            uid_map['1.4']